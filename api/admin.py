@@ -1,11 +1,203 @@
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Max, Q
+from django.utils.functional import cached_property
 from .models import *
+from . import orders
 
-# Register your models here.
-admin.site.register(Product)
-admin.site.register(Category)
-admin.site.register(Order)
-admin.site.register(OrderItem)
-admin.site.register(Cart)
-admin.site.register(CartItems)
-admin.site.register(Payment)
\ No newline at end of file
+# The admin has to stay usable with millions of orders, carts and payments:
+# - change lists join the related rows they show (list_select_related) instead of a query per row,
+#   and the models' __str__ only use their own columns
+# - foreign keys to big tables are raw id inputs (a dropdown would load the whole table), products
+#   and variants are searched with autocomplete
+# - an unfiltered change list shows an estimated row count instead of running COUNT(*) over the table,
+#   and there is no second count for "N total" (show_full_result_count)
+# - filters are only on indexed columns, searches are exact lookups on unique columns
+# - bulk actions are set-based UPDATEs (api/orders.py), "delete selected" is turned off for the big tables
+
+# below this many rows (estimated) the exact count is cheap enough, can be changed in settings
+DEFAULT_EXACT_COUNT_LIMIT = 10000
+
+
+def estimated_row_count(model):
+    """
+    A cheap guess of how many rows the table has, or None when there is none.
+    PostgreSQL keeps one in pg_class (updated by autovacuum/ANALYZE), elsewhere the highest primary key
+    is read from the index, close to the count for tables where rows are rarely deleted
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+            row = cursor.fetchone()
+        # -1 when the table was never analyzed
+        return int(row[0]) if row and row[0] >= 0 else None
+    return model._default_manager.aggregate(last=Max('pk'))['last']
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for change lists of big tables: without filters or a search the count is an estimate
+    (see estimated_row_count), so the last page can be short or empty. Filtered lists are counted exactly
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate is not None and estimate >= getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', DEFAULT_EXACT_COUNT_LIMIT):
+                return estimate
+        return queryset.count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Base for the admins of tables that grow with the number of customers and orders.
+    search_fields are matched exactly (=) so the search uses their unique indexes instead of LIKE '%term%'
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        match = Q()
+        for field in self.search_fields:
+            match |= Q(**{field: search_term})
+        if search_term.isdigit():
+            match |= Q(pk=int(search_term))
+        return queryset.filter(match), False
+
+    def get_actions(self, request):
+        # deleting thousands of selected rows loads every one of them and everything related for the confirmation page
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    list_display = ('name', 'updated_at')
+    search_fields = ('name',)
+    ordering = ('name',)
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ('name', 'category', 'price', 'is_available', 'unique_code', 'created_at')
+    list_select_related = ('category',)
+    list_filter = ('is_available',)
+    search_fields = ('name', '=unique_code')
+    ordering = ('-pk',)
+    autocomplete_fields = ('category',)
+
+    def get_queryset(self, request):
+        # __str__ shows the category, autocomplete results use it too
+        return super().get_queryset(request).select_related(*self.list_select_related)
+
+
+@admin.register(ProductVariant)
+class ProductVariantAdmin(admin.ModelAdmin):
+    list_display = ('sku', 'product', 'size', 'color', 'stock_quantity', 'is_available')
+    list_select_related = ('product__category',)
+    search_fields = ('=sku', 'product__name')
+    ordering = ('-pk',)
+    autocomplete_fields = ('product',)
+
+    def get_queryset(self, request):
+        # __str__ shows the product name, autocomplete results use it too.
+        # The change list skips list_select_related when the queryset already has a select_related, so it is repeated here
+        return super().get_queryset(request).select_related(*self.list_select_related)
+
+
+class OrderItemInline(admin.TabularInline):
+    # lines are written by checkout, read only here.
+    # Read only fields show the already joined rows, editable widgets would query every selected value
+    model = OrderItem
+    fields = readonly_fields = ('product', 'variant', 'quantity', 'price_at_purchase', 'size', 'color')
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product__category', 'variant__product')
+
+
+@admin.register(Order)
+class OrderAdmin(LargeTableAdmin):
+    list_display = ('order_number', 'customer', 'status', 'payment_status', 'payment_method', 'total_amount', 'order_date')
+    list_select_related = ('customer',)
+    # status and order_date have indexes (order_status_date_idx, order_date_idx), the choices filters need no query
+    list_filter = ('status', ('order_date', admin.DateFieldListFilter))
+    search_fields = ('order_number', 'customer__username')
+    ordering = ('-order_date',)
+    raw_id_fields = ('customer',)
+    inlines = [OrderItemInline]
+    actions = ['mark_shipped', 'cancel_and_restock']
+
+    @admin.action(description='Mark selected orders as shipped')
+    def mark_shipped(self, request, queryset):
+        count = orders.mark_shipped(queryset)
+        self.message_user(request, f'{count} orders marked as shipped.')
+
+    @admin.action(description='Cancel selected orders and restock their items')
+    def cancel_and_restock(self, request, queryset):
+        count = orders.cancel_and_restock(queryset)
+        self.message_user(request, f'{count} orders cancelled and restocked.')
+
+
+@admin.register(OrderItem)
+class OrderItemAdmin(LargeTableAdmin):
+    list_display = ('id', 'order', 'product', 'variant', 'quantity', 'price_at_purchase')
+    list_select_related = ('order', 'product__category', 'variant__product')
+    search_fields = ('order__order_number',)
+    raw_id_fields = ('order',)
+    autocomplete_fields = ('product', 'variant')
+
+
+class CartItemsInline(admin.TabularInline):
+    # lines are changed through the cart API, which keeps the cart totals (api/carts.py), read only here.
+    # Read only fields show the already joined rows, editable widgets would query every selected value
+    model = CartItems
+    fields = readonly_fields = ('product', 'variant', 'quantity', 'size', 'color')
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product__category', 'variant__product')
+
+
+@admin.register(Cart)
+class CartAdmin(LargeTableAdmin):
+    list_display = ('cart_number', 'user', 'line_count', 'item_count', 'subtotal', 'updated_at')
+    list_select_related = ('user',)
+    search_fields = ('cart_number', 'user__username')
+    raw_id_fields = ('user',)
+    # kept up to date by api/carts.py
+    readonly_fields = ('line_count', 'item_count', 'subtotal')
+    inlines = [CartItemsInline]
+
+
+@admin.register(CartItems)
+class CartItemsAdmin(LargeTableAdmin):
+    list_display = ('id', 'cart', 'product', 'variant', 'quantity')
+    list_select_related = ('cart', 'product__category', 'variant__product')
+    search_fields = ('cart__cart_number',)
+    raw_id_fields = ('cart',)
+    autocomplete_fields = ('product', 'variant')
+
+
+@admin.register(Payment)
+class PaymentAdmin(LargeTableAdmin):
+    list_display = ('id', 'order', 'amount', 'status', 'stripe_payment_intent_id', 'created_at')
+    list_select_related = ('order',)
+    search_fields = ('stripe_payment_intent_id', 'order__order_number')
+    raw_id_fields = ('order',)
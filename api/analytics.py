@@ -0,0 +1,241 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from .models import Order, OrderItem, DailySales, DailyProductSales
+
+# Sales rollups: DailySales (orders and revenue per day, payment method and payment status) and
+# DailyProductSales (the same per product, with units). They change by deltas:
+# - place_order calls add_orders() for the new order
+# - payment status changes run inside order_changes(), which takes the orders' share out of the rollups
+#   before the change and puts it back after (apply_transitions, and Order.save() through api/signals.py)
+# - deleted orders are taken out by remove_orders() (api/signals.py)
+# Orders made any other way (bulk inserts, imports) aren't counted until `python manage.py backfill_analytics`.
+
+ORDER_KEY = ('day', 'payment_method', 'payment_status')
+PRODUCT_KEY = ('day', 'product_id', 'payment_method', 'payment_status')
+# reports cover this many days when the request doesn't say
+DEFAULT_DAYS = 30
+
+
+def order_rows(order_ids):
+    """
+    {(day, payment_method, payment_status): {'orders': n, 'revenue': amount}} for the orders, from one query
+    """
+    rows = (Order.objects.filter(id__in=order_ids)
+            .values('payment_method', 'payment_status', day=TruncDate('order_date'))
+            .annotate(order_count=Count('id'), amount=Sum('total_amount')))
+    return {
+        (row['day'], row['payment_method'], row['payment_status']): {'orders': row['order_count'], 'revenue': row['amount']}
+        for row in rows
+    }
+
+
+def product_rows(order_ids):
+    """
+    {(day, product_id, payment_method, payment_status): {'orders', 'units', 'revenue', 'category_id'}} for the items
+    of the orders, from one query
+    """
+    rows = (OrderItem.objects.filter(order_id__in=order_ids)
+            .values(
+                'product_id',
+                day=TruncDate('order__order_date'),
+                method=F('order__payment_method'),
+                status=F('order__payment_status'),
+                category=F('product__category_id'),
+            )
+            .annotate(
+                order_count=Count('order_id', distinct=True),
+                unit_count=Sum('quantity'),
+                amount=Sum(ExpressionWrapper(F('quantity') * F('price_at_purchase'), output_field=DecimalField(max_digits=14, decimal_places=2))),
+            ))
+    return {
+        (row['day'], row['product_id'], row['method'], row['status']): {
+            'orders': row['order_count'], 'units': row['unit_count'], 'revenue': row['amount'], 'category_id': row['category'],
+        }
+        for row in rows
+    }
+
+
+def difference(after, before):
+    """
+    after - before for every key, keys whose numbers don't change are left out
+    """
+    deltas = {}
+    for key in set(after) | set(before):
+        new, old = after.get(key, {}), before.get(key, {})
+        delta = {
+            name: Decimal(new.get(name) or 0) - Decimal(old.get(name) or 0) if name == 'revenue' else (new.get(name) or 0) - (old.get(name) or 0)
+            for name in ('orders', 'units', 'revenue') if name in new or name in old
+        }
+        if any(delta.values()):
+            if 'category_id' in new or 'category_id' in old:
+                delta['category_id'] = new.get('category_id', old.get('category_id'))
+            deltas[key] = delta
+    return deltas
+
+
+def apply_deltas(model, key_fields, deltas):
+    """
+    Add the deltas ({key: {field: amount}}) to the rollup rows, creating missing rows.
+    One INSERT ... ON CONFLICT DO UPDATE for all of them on SQLite and PostgreSQL, a row at a time elsewhere
+    """
+    if not deltas:
+        return
+    sums = [name for name in ('orders', 'units', 'revenue') if any(name in delta for delta in deltas.values())]
+    extra = ['category_id'] if model is DailyProductSales else []
+    rows = [
+        [*key, *(delta.get(name, 0) for name in sums), *(delta.get(name) for name in extra)]
+        for key, delta in deltas.items()
+    ]
+
+    if connection.vendor in ('sqlite', 'postgresql'):
+        table = connection.ops.quote_name(model._meta.db_table)
+        quote = connection.ops.quote_name
+        columns = [model._meta.get_field(name).column for name in (*key_fields, *sums, *extra)]
+        updates = [f'{quote(column)} = {table}.{quote(column)} + EXCLUDED.{quote(column)}' for column in sums]
+        updates += [f'{quote(column)} = EXCLUDED.{quote(column)}' for column in extra]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {table} ({', '.join(quote(column) for column in columns)}) "
+                f"VALUES ({', '.join(['%s'] * len(columns))}) "
+                f"ON CONFLICT ({', '.join(quote(model._meta.get_field(name).column) for name in key_fields)}) "
+                f"DO UPDATE SET {', '.join(updates)}",
+                rows,
+            )
+        return
+
+    for key, delta in deltas.items():
+        lookup = dict(zip(key_fields, key))
+        model.objects.get_or_create(**lookup)
+        changes = {name: F(name) + delta[name] for name in sums if name in delta}
+        changes.update({name: delta[name] for name in extra})
+        model.objects.filter(**lookup).update(**changes)
+
+
+def apply_changes(order_before, order_after, product_before, product_after):
+    apply_deltas(DailySales, ORDER_KEY, difference(order_after, order_before))
+    apply_deltas(DailyProductSales, PRODUCT_KEY, difference(product_after, product_before))
+    if order_before:
+        # rows that lost all their orders to another status, only the days that changed are looked at
+        days = {key[0] for key in order_before}
+        DailySales.objects.filter(day__in=days, orders__lte=0).delete()
+        DailyProductSales.objects.filter(day__in=days, orders__lte=0).delete()
+
+
+def add_orders(order_ids):
+    """
+    Count new orders (with their items already saved) in the rollups
+    """
+    order_ids = list(order_ids)
+    with transaction.atomic():
+        apply_changes({}, order_rows(order_ids), {}, product_rows(order_ids))
+
+
+def remove_orders(order_ids):
+    """
+    Take orders out of the rollups, before they are deleted
+    """
+    order_ids = list(order_ids)
+    with transaction.atomic():
+        apply_changes(order_rows(order_ids), {}, product_rows(order_ids), {})
+
+
+@contextmanager
+def order_changes(order_ids):
+    """
+    Wrap changes to the payment status or payment method of existing orders:
+        with order_changes(order_ids):
+            Order.objects.filter(id__in=order_ids).update(payment_status='paid')
+    """
+    order_ids = list(order_ids)
+    with transaction.atomic():
+        order_before, product_before = order_rows(order_ids), product_rows(order_ids)
+        yield
+        apply_changes(order_before, order_rows(order_ids), product_before, product_rows(order_ids))
+
+
+def backfill(chunk_size=5000, stdout=None):
+    """
+    Rebuild both rollups from every order, chunk_size orders at a time (each chunk in its own transaction).
+    Orders that change while this runs can be counted twice, run it when the shop is quiet.
+    Returns the number of orders processed
+    """
+    with transaction.atomic():
+        DailySales.objects.all().delete()
+        DailyProductSales.objects.all().delete()
+
+    total = 0
+    last_id = 0
+    while True:
+        ids = list(Order.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        add_orders(ids)
+        total += len(ids)
+        last_id = ids[-1]
+        if stdout:
+            stdout.write(f"{total} orders")
+    return total
+
+
+# Reports for the dashboard endpoints (AnalyticsView in api/views.py), every one is a single query over the rollups
+
+def sales_filters(params, today=None):
+    """
+    Filters from the query string: start and end (YYYY-MM-DD, default the last 30 days), payment_status, payment_method.
+    Raises ValueError for bad dates
+    """
+    today = today or timezone.localdate()
+    start = parse_date(params.get('start') or '') if params.get('start') else today - timedelta(days=DEFAULT_DAYS - 1)
+    end = parse_date(params.get('end') or '') if params.get('end') else today
+    if start is None or end is None:
+        raise ValueError("start and end must be dates like 2025-01-31")
+    filters = {'day__gte': start, 'day__lte': end}
+    for name in ('payment_status', 'payment_method'):
+        if params.get(name):
+            filters[name] = params[name]
+    return filters
+
+
+def money(value):
+    # like the serializers' DecimalFields: a string with two decimals
+    return f'{Decimal(value or 0):.2f}'
+
+
+def daily_totals(filters):
+    rows = (DailySales.objects.filter(**filters).values('day')
+            .annotate(order_count=Sum('orders'), amount=Sum('revenue')).order_by('day'))
+    return [{'day': row['day'], 'orders': row['order_count'], 'revenue': money(row['amount'])} for row in rows]
+
+
+def category_totals(filters):
+    rows = (DailyProductSales.objects.filter(**filters).values('day', 'category_id', 'category__name')
+            .annotate(unit_count=Sum('units'), amount=Sum('revenue')).order_by('day', 'category__name'))
+    return [
+        {'day': row['day'], 'category_id': row['category_id'], 'category': row['category__name'], 'units': row['unit_count'], 'revenue': money(row['amount'])}
+        for row in rows
+    ]
+
+
+def top_products(filters, limit=10):
+    rows = (DailyProductSales.objects.filter(**filters).values('product_id', 'product__name')
+            .annotate(order_count=Sum('orders'), unit_count=Sum('units'), amount=Sum('revenue'))
+            .order_by('-amount', 'product_id')[:limit])
+    return [
+        {'product_id': row['product_id'], 'product': row['product__name'], 'orders': row['order_count'], 'units': row['unit_count'], 'revenue': money(row['amount'])}
+        for row in rows
+    ]
+
+
+def payment_totals(filters):
+    rows = (DailySales.objects.filter(**filters).values('payment_method', 'payment_status')
+            .annotate(order_count=Sum('orders'), amount=Sum('revenue')).order_by('payment_method', 'payment_status'))
+    return [
+        {'payment_method': row['payment_method'], 'payment_status': row['payment_status'], 'orders': row['order_count'], 'revenue': money(row['amount'])}
+        for row in rows
+    ]
@@ -0,0 +1,151 @@
+import json
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework.exceptions import AuthenticationFailed
+from .authentication import CachedTokenAuthentication
+from .checkout import place_order, CheckoutError
+from .gateways import get_gateway, GatewayError, GatewayRejected
+from .models import Order, Payment, Cart
+from .payments import apply_transitions, idempotency_key, apayment_attempt, FINAL_PAYMENT_STATUSES
+from .serializers import PaymentSerializer, CheckoutSerializer
+
+# Async versions of the payment and checkout endpoints, for running under ASGI (project/asgi.py, e.g. uvicorn).
+# While a request waits for the payment gateway the worker serves other requests, so one worker process can hold
+# hundreds of slow gateway calls instead of one per thread. The ORM is sync only: short database sections run
+# through the ORM's async methods (aget, aget_or_create...) or sync_to_async.
+# DRF views can't be async, these are plain Django views that answer like their DRF versions in api/views.py.
+# They accept token authentication only (so no CSRF check is needed).
+
+
+def token_required(view):
+    """
+    Authenticate the request with the API token like the DRF views do, answer 401 without a valid one
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            result = await sync_to_async(CachedTokenAuthentication().authenticate)(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({"detail": str(e.detail)}, status=401)
+        if result is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+        request.user = result[0]
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def json_body(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+# POST /api/async/payment/ {"order_id": 1}
+@csrf_exempt
+@require_POST
+@token_required
+async def create_payment(request):
+    data = json_body(request)
+    if data is None:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    try:
+        order = await Order.objects.aget(id=data.get('order_id'), customer=request.user)
+    except (Order.DoesNotExist, ValueError, TypeError):
+        return JsonResponse({"error": "Order not found"})
+
+    # same idempotency as PaymentView.create: a retry for the same order and amount gets the same payment
+    key = idempotency_key(order, await apayment_attempt(order))
+    payment = await Payment.objects.filter(idempotency_key=key).afirst()
+    if payment is None:
+        try:
+            intent = await get_gateway(order.payment_method).acreate_payment(order, key)
+        except GatewayRejected as e:
+            # the order can't be paid this way (cash on delivery, a declined card...)
+            return JsonResponse({"error": str(e)}, status=400)
+        except GatewayError as e:
+            return JsonResponse({"error": str(e)}, status=502)
+
+        payment, created = await Payment.objects.aget_or_create(
+            idempotency_key=key,
+            defaults={
+                'order': order,
+                'stripe_payment_intent_id': intent['id'],
+                'amount': order.total_amount,
+                'client_secret': intent['client_secret'],
+            }
+        )
+
+    response_data = PaymentSerializer(payment).data
+    response_data['client_secret'] = payment.client_secret
+    return JsonResponse(response_data)
+
+
+# POST /api/async/payment/{id}/confirm/
+@csrf_exempt
+@require_POST
+@token_required
+async def confirm_payment(request, pk):
+    try:
+        payment = await Payment.objects.select_related('order').aget(pk=pk, order__customer=request.user)
+    except Payment.DoesNotExist:
+        return JsonResponse({"detail": "No Payment matches the given query."}, status=404)
+
+    if not settings.STRIPE_WEBHOOK_SECRET and payment.status not in FINAL_PAYMENT_STATUSES:
+        try:
+            status = await get_gateway(payment.order.payment_method).apayment_status(payment.stripe_payment_intent_id)
+        except GatewayRejected as e:
+            # e.g. the payment method has no gateway
+            return JsonResponse({"error": str(e)}, status=400)
+        except GatewayError as e:
+            return JsonResponse({"error": str(e)}, status=502)
+        await sync_to_async(apply_transitions)({payment.stripe_payment_intent_id: f'payment_intent.{status}'})
+        payment = await Payment.objects.select_related('order').aget(pk=payment.pk)
+
+    if payment.status == 'completed':
+        return JsonResponse({
+            "success": True,
+            "message": "Payment confirmed successfully",
+            "order_status": payment.order.status
+        })
+    return JsonResponse({"error": f"Payment not completed. Status: {payment.status}"})
+
+
+# POST /api/async/cart/checkout/ {"shipping_address": "123st ktm", "payment_method": "mastercard"}
+@csrf_exempt
+@require_POST
+@token_required
+async def checkout(request):
+    data = json_body(request)
+    if data is None:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    serializer = CheckoutSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors)
+
+    try:
+        # the checkout transaction runs in a thread, the confirmation email is only queued
+        # (the send_queued_emails worker sends it), so nothing here waits on SMTP
+        order = await sync_to_async(place_order)(
+            request.user, serializer.validated_data['shipping_address'], serializer.validated_data['payment_method'],
+        )
+    except Cart.DoesNotExist:
+        return JsonResponse({"error": "Cart not found"})
+    except CheckoutError as e:
+        return JsonResponse({"error": e.message, "failed_items": e.failed_items})
+    except Exception as e:
+        return JsonResponse({"error": f"Checkout failed: {str(e)}"})
+
+    return JsonResponse({
+        "success": True,
+        "message": "Order created successfully",
+        "order_number": order.order_number,
+        "total_amount": str(order.total_amount),
+        "order_id": order.id
+    })
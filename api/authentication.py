@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+
+class LocalTTLCache:
+    """
+    Small thread-safe LRU cache with a time to live, private to this process
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+local_tokens = LocalTTLCache(
+    max_size=getattr(settings, 'AUTH_TOKEN_LOCAL_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'AUTH_TOKEN_LOCAL_CACHE_SECONDS', 5),
+)
+
+
+# the only user columns kept in the caches, never the password hash or personal details.
+# Any other field of request.user is loaded from the database the first time it is used
+CACHED_USER_FIELDS = ('id', 'username', 'is_active', 'is_staff')
+
+
+def token_cache_key(key):
+    # never use the raw token as a cache key, it would show up in cache dumps and monitoring
+    return 'auth:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def invalidate_token(key):
+    """
+    Forget a cached token, called when a token is deleted (logout) or its user changes.
+    The shared cache is cleared right away; other processes drop their local copy
+    within AUTH_TOKEN_LOCAL_CACHE_SECONDS
+    """
+    cache_key = token_cache_key(key)
+    local_tokens.delete(cache_key)
+    cache.delete(cache_key)
+
+
+def cached_user(values):
+    """
+    A User like a User.objects.only(*CACHED_USER_FIELDS) row, the fields not in values are deferred.
+    from_db wants the values in the order of the model's fields
+    """
+    fields = [field.attname for field in get_user_model()._meta.concrete_fields if field.attname in values]
+    return get_user_model().from_db(None, fields, [values[field] for field in fields])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that doesn't hit the database on every request. Lookups go to a per-process
+    LRU first, then the shared cache (CACHES['default']), and only then to the Token + User join
+    """
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        cached = local_tokens.get(cache_key)
+        if cached is None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                local_tokens.set(cache_key, cached)
+        if cached is None:
+            user, token = super().authenticate_credentials(key)
+            cached = tuple(getattr(user, field) for field in CACHED_USER_FIELDS)
+            cache.set(cache_key, cached, getattr(settings, 'AUTH_TOKEN_CACHE_SECONDS', 300))
+            local_tokens.set(cache_key, cached)
+
+        # new objects on every request, so a view changing request.user doesn't change other requests
+        user = cached_user(dict(zip(CACHED_USER_FIELDS, cached)))
+        if not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        token = self.get_model().from_db(None, ['key', 'user_id'], [key, user.id])
+        token.user = user
+        return user, token
@@ -0,0 +1,388 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.db import connection, connections
+from django.test import Client, AsyncClient
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from .models import User, Category, Product, ProductVariant, Cart, Order, OrderItem, Payment
+from . import gateways
+
+DEFAULT_VOLUMES = {'categories': 10, 'products': 1000, 'users': 50, 'orders': 2000}
+
+# endpoint name -> weight, roughly what the shop sees: mostly browsing, a few carts, fewer checkouts
+DEFAULT_MIX = {
+    'catalog': 55,
+    'product_list': 5,
+    'product_detail': 10,
+    'add_to_cart': 20,
+    'orders': 5,
+    'checkout': 5,
+}
+
+
+def seed(volumes=None):
+    """
+    Fill the database with categories, products (with a few variants each), users (with carts) and past orders using bulk inserts.
+    Returns the users, every one of them can log in with password 'benchmark'
+    """
+    volumes = {**DEFAULT_VOLUMES, **(volumes or {})}
+    categories = Category.objects.bulk_create([
+        Category(name=f'Category {i}', description='benchmark') for i in range(volumes['categories'])
+    ])
+    sizes = [choice for choice, label in Product.SIZE_CHOICES]
+    colors = ['black', 'white', 'red', 'blue', 'green']
+    products = Product.objects.bulk_create([
+        Product(
+            name=f'Product {i}', description='benchmark product', price=Decimal(random.randint(500, 5000)),
+            category=categories[i % len(categories)],
+        )
+        for i in range(volumes['products'])
+    ])
+    variants = ProductVariant.objects.bulk_create([
+        # plenty of stock so checkouts in the run don't fail on stock
+        ProductVariant(product=product, size=size, color=colors[i % len(colors)], stock_quantity=1_000_000)
+        for i, product in enumerate(products)
+        for size in sizes[:1 + i % len(sizes)]
+    ])
+
+    users = []
+    for i in range(volumes['users']):
+        user = User(username=f'bench{i}', email=f'bench{i}@example.com')
+        user.set_password('benchmark')
+        users.append(user)
+    users = User.objects.bulk_create(users)
+    Cart.objects.bulk_create([Cart(user=user) for user in users])
+
+    orders = Order.objects.bulk_create([
+        Order(
+            customer=users[i % len(users)], status='delivered', total_amount=0, shipping_address='benchmark',
+            payment_status='paid', payment_method='cod',
+        )
+        for i in range(volumes['orders'])
+    ])
+    sold = [variants[(i * 7) % len(variants)] for i in range(len(orders))]
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order, product=variant.product, variant=variant, quantity=1,
+            price_at_purchase=variant.product.price, size=variant.size, color=variant.color,
+        )
+        for order, variant in zip(orders, sold)
+    ])
+    return users
+
+
+class Scenario:
+    """
+    The requests of the mix, every method does one request through the DRF test client and returns the response
+    """
+    def __init__(self, users, variants):
+        self.users = users
+        self.variants = variants
+        self.local = threading.local()
+
+    def client(self):
+        # every thread logs in as one user, so concurrent carts and checkouts don't step on each other
+        if not hasattr(self.local, 'client'):
+            self.local.client = APIClient()
+            self.local.user = random.choice(self.users)
+            self.local.client.force_authenticate(self.local.user)
+        return self.local.client
+
+    def catalog(self):
+        params = random.choice(['', '?category=Category 1', '?size=medium&ordering=price', '?min_price=1000&max_price=3000'])
+        return self.client().get(f'/api/products/catalog/{params}')
+
+    def product_list(self):
+        return self.client().get('/api/products/')
+
+    def product_detail(self):
+        return self.client().get(f'/api/products/{random.choice(self.variants).product_id}/')
+
+    def add_to_cart(self):
+        variant = random.choice(self.variants)
+        return self.client().post('/api/cart/add-to-cart/', {
+            'product_code': variant.product.unique_code, 'quantity': 1, 'size': variant.size, 'color': variant.color,
+        }, format='json')
+
+    def orders(self):
+        return self.client().get('/api/orders/')
+
+    def checkout(self):
+        # includes the add-to-cart needed to have something to check out, in the timing and the query count
+        client = self.client()
+        variant = random.choice(self.variants)
+        client.post('/api/cart/add-to-cart/', {
+            'product_code': variant.product.unique_code, 'quantity': 1, 'size': variant.size, 'color': variant.color,
+        }, format='json')
+        return client.post('/api/cart/checkout/', {'shipping_address': 'benchmark', 'payment_method': 'cod'}, format='json')
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def is_error(response):
+    # the API answers most errors with 200 and an "error" key
+    if response.status_code >= 400:
+        return True
+    data = getattr(response, 'data', None)
+    return isinstance(data, dict) and 'error' in data
+
+
+def run(mix=None, requests=500, concurrency=1, seed_value=0):
+    """
+    Replay `requests` requests picked from `mix` ({endpoint: weight}) with `concurrency` threads.
+    Returns the report: overall throughput plus count, errors, p50/p95/p99 latency (ms) and average queries per endpoint
+    """
+    mix = mix or DEFAULT_MIX
+    random.seed(seed_value)
+    scenario = Scenario(list(User.objects.filter(username__startswith='bench')), list(ProductVariant.objects.select_related('product')))
+    plan = random.choices(list(mix), weights=list(mix.values()), k=requests)
+    samples = {name: [] for name in mix}
+    lock = threading.Lock()
+
+    def do_request(name):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            try:
+                failed = is_error(getattr(scenario, name)())
+            except Exception:
+                # the test client re-raises server errors (e.g. "database is locked" under concurrency)
+                failed = True
+            elapsed = time.perf_counter() - started
+        with lock:
+            samples[name].append((elapsed, len(queries), failed))
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for name in plan:
+            do_request(name)
+    else:
+        def worker(name):
+            try:
+                do_request(name)
+            finally:
+                # threads get their own connections, don't leave them open
+                connections.close_all()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, plan))
+    wall_seconds = time.perf_counter() - started
+
+    endpoints = {}
+    for name, rows in samples.items():
+        if not rows:
+            continue
+        latencies = [row[0] * 1000 for row in rows]
+        endpoints[name] = {
+            'count': len(rows),
+            'errors': sum(1 for row in rows if row[2]),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'avg_queries': round(sum(row[1] for row in rows) / len(rows), 2),
+            'max_queries': max(row[1] for row in rows),
+        }
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(requests / wall_seconds, 2) if wall_seconds else 0,
+        'endpoints': endpoints,
+    }
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Compare a report with a stored one. Returns a list of regressions: p95 latency more than
+    `tolerance` (20%) slower, or more queries than before. Query counts are exact, latency is noisy
+    """
+    regressions = []
+    for name, current in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if not before:
+            continue
+        if current['max_queries'] > before['max_queries']:
+            regressions.append(f"{name}: {before['max_queries']} -> {current['max_queries']} queries")
+        if before['p95_ms'] and current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {current['p95_ms']}ms")
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(report, path):
+    with open(path, 'w') as baseline_file:
+        json.dump(report, baseline_file, indent=2)
+
+
+class GatewayStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every Stripe PaymentIntent call after server.delay seconds, like a slow payment gateway.
+    The intents stay in 'requires_action', so every confirm asks the gateway again
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.reply(self.path.split('?')[0].rstrip('/').split('/')[-1])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply(f'pi_stub_{random.getrandbits(32)}')
+
+    def reply(self, intent_id):
+        time.sleep(self.server.delay)
+        if self.server.status >= 400:
+            # a Stripe error answer, e.g. 400 for a refused call or 500 for an outage
+            body = json.dumps({'error': {'type': 'api_error' if self.server.status >= 500 else 'invalid_request_error', 'message': 'stub error'}}).encode()
+        else:
+            body = json.dumps({'id': intent_id, 'object': 'payment_intent', 'status': 'requires_action', 'client_secret': f'{intent_id}_secret'}).encode()
+        self.server.calls += 1
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GatewayStub(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 would refuse connections when hundreds of calls start at once
+    request_queue_size = 1024
+
+    def __init__(self, delay, status=200):
+        super().__init__(('127.0.0.1', 0), GatewayStubHandler)
+        self.delay = delay
+        self.status = status
+        self.calls = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def handle_error(self, request, client_address):
+        # a client that timed out hangs up before the answer is written, that's expected here
+        pass
+
+
+def seed_payments(count):
+    """
+    count users with a token and one card order with a pending payment each. Returns [(token, payment id)]
+    """
+    users = User.objects.bulk_create([User(username=f'payer{i}', password='!') for i in range(count)])
+    tokens = Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+    orders = Order.objects.bulk_create([
+        Order(customer=user, status='pending', total_amount=100, shipping_address='benchmark', payment_status='pending', payment_method='visa')
+        for user in users
+    ])
+    payments = Payment.objects.bulk_create([
+        Payment(order=order, stripe_payment_intent_id=f'pi_bench_{order.id}', amount=order.total_amount)
+        for order in orders
+    ])
+    return [(token.key, payment.id) for token, payment in zip(tokens, payments)]
+
+
+def latency_report(name, latencies, errors, wall_seconds):
+    latencies = [latency * 1000 for latency in latencies]
+    return {
+        'server': name,
+        'requests': len(latencies),
+        'errors': errors,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(latencies) / wall_seconds, 2) if wall_seconds else 0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+    }
+
+
+def run_wsgi_confirmations(plan, threads):
+    """
+    The sync PaymentView.confirm through the WSGI handler from `threads` threads, like one WSGI worker with that many threads
+    """
+    latencies = []
+    errors = []
+
+    def confirm(item):
+        token, payment_id = item
+        started = time.perf_counter()
+        try:
+            response = Client().post(f'/api/payment/{payment_id}/confirm/', headers={'Authorization': f'Token {token}'})
+            failed = response.status_code >= 400
+        except Exception:
+            failed = True
+        finally:
+            connections.close_all()
+        latencies.append(time.perf_counter() - started)
+        errors.append(failed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(confirm, plan))
+    return latency_report(f'wsgi ({threads} threads)', latencies, sum(errors), time.perf_counter() - started)
+
+
+async def run_asgi_confirmations(plan, concurrency):
+    """
+    The async confirm view through the ASGI handler on one event loop, with up to `concurrency` requests in flight
+    """
+    latencies = []
+    errors = []
+    slots = asyncio.Semaphore(concurrency)
+    client = AsyncClient()
+
+    async def confirm(item):
+        token, payment_id = item
+        async with slots:
+            started = time.perf_counter()
+            try:
+                response = await client.post(f'/api/async/payment/{payment_id}/confirm/', headers={'Authorization': f'Token {token}'})
+                failed = response.status_code >= 400
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            errors.append(failed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(confirm(item) for item in plan))
+    return latency_report(f'asgi (concurrency {concurrency})', latencies, sum(errors), time.perf_counter() - started)
+
+
+def compare_servers(requests=400, threads=8, concurrency=200, gateway_delay=0.2, payments=50):
+    """
+    Payment confirmations against a local gateway stub that takes gateway_delay seconds per call,
+    once through the sync view under WSGI and once through the async view under ASGI.
+    Returns [wsgi report, asgi report]
+    """
+    seeded = seed_payments(payments)
+    plan = [random.choice(seeded) for _ in range(requests)]
+    stub = GatewayStub(gateway_delay)
+    try:
+        # confirm asks the gateway (instead of waiting for webhooks) only without a webhook secret
+        with override_settings(STRIPE_API_BASE=stub.url, STRIPE_SECRET_KEY='sk_test_benchmark', STRIPE_WEBHOOK_SECRET=''):
+            # new gateway objects for the stub's address, and for the event loop the async client will belong to
+            gateways._gateways.clear()
+            wsgi = run_wsgi_confirmations(plan, threads)
+            gateways._gateways.clear()
+            asgi = asyncio.run(run_asgi_confirmations(plan, concurrency))
+            gateways._gateways.clear()
+    finally:
+        stub.shutdown()
+        stub.server_close()
+    return [wsgi, asgi]
@@ -0,0 +1,194 @@
+from decimal import Decimal
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum, Count, OuterRef, Subquery, Value, DecimalField, PositiveIntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Cart, CartItems, Product, ProductVariant
+from .inventory import reserved_quantities, reserved_elsewhere, available_stock, is_sellable
+
+# Cart.line_count, item_count and subtotal are only correct if cart items are changed through these helpers
+# (or refresh_cart_totals is run afterwards)
+
+
+def find_variants(lines):
+    """
+    Look up the variants for a list of (code, size, color) in one query. code is either a product unique_code,
+    then size and color pick the variant (color is matched case-insensitively), or a variant sku when no size
+    or color is given. Returns {(code, size, color): variant} for the lines that were found
+    """
+    lines = set(lines)
+    codes = {code for code, size, color in lines}
+    # the product codes go in a subquery, a join inside the OR would make the database scan every variant
+    products = Product.objects.filter(unique_code__in=codes)
+    variants = list(ProductVariant.objects.select_related('product').filter(Q(sku__in=codes) | Q(product__in=products)))
+    by_sku = {variant.sku: variant for variant in variants}
+    by_option = {(variant.product.unique_code, variant.size, variant.color.lower()): variant for variant in variants}
+    product_codes = {variant.product.unique_code for variant in variants}
+
+    found = {}
+    for code, size, color in lines:
+        # variants made by migration 0013 have their old product code as sku, which can be the code of the
+        # grouped product too, so a line with a size or color for a product code only matches by its options
+        if (size or color) and code in product_codes:
+            variant = by_option.get((code, size, (color or '').lower()))
+        else:
+            variant = by_sku.get(code) or by_option.get((code, size, (color or '').lower()))
+        if variant is not None:
+            found[(code, size, color)] = variant
+    return found
+
+
+def add_item(cart, variant, quantity, check_stock=False):
+    """
+    Add quantity of a product variant to the cart, merging into the existing line.
+    The line is changed with an F() increment so two requests at the same time (double click) both count,
+    and the cart totals are moved by the same amount in one UPDATE.
+    With check_stock the line can't grow past the variant's stock minus what other carts have reserved,
+    for an existing line that check is part of the UPDATE so it costs no extra query.
+    Returns the cart line with the new quantity and its cart with the new totals, both read back in one query,
+    or None when check_stock found too little stock (then nothing changed)
+    """
+    line = {'cart': cart, 'variant': variant}
+    with transaction.atomic():
+        lines = CartItems.objects.filter(**line)
+        if check_stock:
+            lines = lines.filter(quantity__lte=Value(variant.stock_quantity - quantity) - reserved_elsewhere(variant, cart))
+        new_line = False
+        if not lines.update(quantity=F('quantity') + quantity):
+            # no line yet, or a line that would go over the stock (then creating it fails below)
+            if check_stock and available_stock(variant, exclude_cart=cart) < quantity:
+                return None
+            try:
+                # savepoint, so losing the race to create the line doesn't break the outer transaction
+                with transaction.atomic():
+                    CartItems.objects.create(
+                        product_id=variant.product_id, size=variant.size, color=variant.color, quantity=quantity, **line,
+                    )
+                new_line = True
+            except IntegrityError:
+                # the line exists (someone else may have created it just now), the unique_cart_line constraint stopped a duplicate
+                if not lines.update(quantity=F('quantity') + quantity):
+                    return None
+
+        Cart.objects.filter(pk=cart.pk).update(
+            line_count=F('line_count') + (1 if new_line else 0),
+            item_count=F('item_count') + quantity,
+            subtotal=F('subtotal') + variant.product.price * quantity,
+            updated_at=timezone.now(),
+        )
+        return CartItems.objects.select_related('cart').get(**line)
+
+
+def clear_cart(cart):
+    """
+    Remove every item of the cart and zero its totals
+    """
+    cart.cart_items.all().delete()
+    Cart.objects.filter(pk=cart.pk).update(line_count=0, item_count=0, subtotal=Decimal('0'), updated_at=timezone.now())
+
+
+def refresh_cart_totals(carts):
+    """
+    Recalculate the totals of every cart in the carts queryset from its items (with current prices)
+    in a single UPDATE. Used when prices change and to repair carts edited by hand
+    """
+    items = CartItems.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    return carts.update(
+        line_count=Coalesce(Subquery(items.annotate(total=Count('id')).values('total')), Value(0), output_field=PositiveIntegerField()),
+        item_count=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')), Value(0), output_field=PositiveIntegerField()),
+        subtotal=Coalesce(
+            Subquery(items.annotate(total=Sum(F('quantity') * F('product__price'), output_field=DecimalField(max_digits=12, decimal_places=2))).values('total')),
+            Value(Decimal('0')),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        # update() skips auto_now, and the cart's ETag (api/conditional.py) relies on it
+        updated_at=timezone.now(),
+    )
+
+
+def apply_operations(cart, operations):
+    """
+    Apply a list of validated cart operations (see CartOperationSerializer) in one transaction:
+    one query for all variants, one for the cart's existing lines, then at most one bulk insert,
+    one bulk update, one delete and one totals update, no matter how many operations there are.
+    Operations that fail (unknown variant, not available, not enough stock) are skipped and reported,
+    the rest are applied. Returns one result per operation, in order
+    """
+    results = [{"index": index, "op": op['op'], "product_code": op['product_code'], "size": op['size'], "color": op['color']}
+               for index, op in enumerate(operations)]
+
+    with transaction.atomic():
+        variants = find_variants((op['product_code'], op['size'], op['color']) for op in operations)
+        # lock the lines so a single add-to-cart running at the same time waits instead of being overwritten
+        lines = {
+            line.variant_id: line
+            for line in CartItems.objects.select_for_update().filter(cart=cart, variant__in=[variant.id for variant in variants.values()])
+        }
+        existing = {variant_id: line.quantity for variant_id, line in lines.items()}
+        quantities = dict(existing)
+        by_id = {}
+
+        # work out the new quantity of every line
+        for op, result in zip(operations, results):
+            variant = variants.get((op['product_code'], op['size'], op['color']))
+            if variant is None:
+                result['error'] = f"Product with code {op['product_code']} in {op['size']}/{op['color']} does not exist"
+                continue
+            by_id[variant.id] = variant
+            if op['op'] == 'remove' or (op['op'] == 'update' and op['quantity'] == 0):
+                quantities[variant.id] = 0
+            elif not is_sellable(variant):
+                result['error'] = f"{variant.product.name} is not available"
+                continue
+            elif op['op'] == 'add':
+                quantities[variant.id] = quantities.get(variant.id, 0) + op['quantity']
+            else:
+                quantities[variant.id] = op['quantity']
+            result['variant_id'] = variant.id
+            result['sku'] = variant.sku
+
+        # check stock per variant, the same way checkout does.
+        # When a line would go over what is available and grew, it keeps its old quantity
+        reserved = reserved_quantities(quantities.keys(), exclude_cart=cart)
+        short = {}
+        for variant_id, quantity in quantities.items():
+            available = max(by_id[variant_id].stock_quantity - reserved.get(variant_id, 0), 0)
+            if quantity > available and quantity > existing.get(variant_id, 0):
+                short[variant_id] = available
+                quantities[variant_id] = existing.get(variant_id, 0)
+        for result in results:
+            if result.get('variant_id') in short:
+                result['error'] = f"{by_id[result['variant_id']].product.name} only has {short[result['variant_id']]} pieces left"
+
+        to_create, to_update, to_delete = [], [], []
+        for variant_id, quantity in quantities.items():
+            line = lines.get(variant_id)
+            if line is None:
+                if quantity:
+                    variant = by_id[variant_id]
+                    to_create.append(CartItems(cart=cart, product_id=variant.product_id, variant=variant,
+                                               size=variant.size, color=variant.color, quantity=quantity))
+            elif quantity == 0:
+                to_delete.append(line.id)
+            elif quantity != line.quantity:
+                line.quantity = quantity
+                to_update.append(line)
+
+        if to_create:
+            CartItems.objects.bulk_create(to_create)
+        if to_update:
+            CartItems.objects.bulk_update(to_update, ['quantity'])
+        if to_delete:
+            CartItems.objects.filter(id__in=to_delete).delete()
+        if to_create or to_update or to_delete:
+            refresh_cart_totals(Cart.objects.filter(pk=cart.pk))
+
+    for result in results:
+        variant_id = result.pop('variant_id', None)
+        if 'error' in result:
+            result['success'] = False
+            result.pop('sku', None)
+        else:
+            result['success'] = True
+            result['quantity'] = quantities[variant_id]
+    return results
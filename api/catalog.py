@@ -0,0 +1,98 @@
+import hashlib
+from decimal import Decimal, InvalidOperation
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from .models import ProductVariant
+
+CATALOG_VERSION_KEY = 'catalog:version'
+# the version is bumped on every product/category change, this is just an upper bound on staleness
+# for changes that skip signals (queryset.update())
+CATALOG_CACHE_SECONDS = 5 * 60
+
+ORDERING_FIELDS = ['id', '-id', 'price', '-price', 'created_at', '-created_at']
+
+
+class CatalogPagination(CursorPagination):
+    # cursor pagination never counts or skips rows, so page 1000 costs the same as page 1
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = request.query_params.get('ordering')
+        if ordering is None:
+            return (self.ordering,)
+        if ordering not in ORDERING_FIELDS:
+            raise ValidationError({"ordering": f"Must be one of {', '.join(ORDERING_FIELDS)}"})
+        if ordering.lstrip('-') == 'id':
+            return (ordering,)
+        # add the id so rows with the same price/date always come out in the same order
+        return (ordering, '-id' if ordering.startswith('-') else 'id')
+
+
+def _decimal_param(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: "A valid number is required."})
+
+
+def filter_products(queryset, params):
+    """
+    Apply the catalog filters from the query string:
+    ?category=<name>&size=<size>&color=<color>&min_price=<n>&max_price=<n>&is_available=true|false
+    """
+    if params.get('category'):
+        queryset = queryset.filter(category__name=params['category'])
+    if params.get('size') or params.get('color'):
+        # products that have an available variant in that size and color, without duplicating product rows
+        variants = ProductVariant.objects.filter(product=OuterRef('pk'), is_available=True)
+        if params.get('size'):
+            variants = variants.filter(size=params['size'])
+        if params.get('color'):
+            variants = variants.filter(color__iexact=params['color'])
+        queryset = queryset.filter(Exists(variants))
+
+    min_price = _decimal_param(params, 'min_price')
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+    max_price = _decimal_param(params, 'max_price')
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+
+    is_available = params.get('is_available')
+    if is_available is not None:
+        queryset = queryset.filter(is_available=is_available.lower() in ('1', 'true', 'yes'))
+    return queryset
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # add() so two workers starting at the same time don't both reset it
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Make every cached catalog page stale at once. Old entries are never read again and just expire
+    """
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 1, timeout=None)
+
+
+def catalog_cache_key(params):
+    # same filters in a different order are the same query, so sort them before hashing
+    shape = '&'.join(f'{key}={value}' for key, value in sorted(params.lists()))
+    digest = hashlib.md5(shape.encode()).hexdigest()
+    return f'catalog:v{catalog_version()}:{digest}'
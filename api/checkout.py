@@ -0,0 +1,124 @@
+from django.db import transaction
+from .models import Cart, Order, OrderItem
+from . import inventory, analytics
+from .carts import clear_cart
+from .outbox import queue_order_confirmation
+from .catalog import bump_catalog_version
+
+
+class CheckoutError(Exception):
+    """
+    Raised when a cart can't be turned into an order.
+    failed_items has one entry per cart line that failed so the client can fix all of them at once
+    """
+    def __init__(self, message, failed_items=None):
+        super().__init__(message)
+        self.message = message
+        self.failed_items = failed_items or []
+
+
+def _line_failure(cart_item, reason, stock_left=None):
+    return {
+        "cart_item_id": cart_item.id,
+        "product_code": cart_item.product.unique_code,
+        "sku": cart_item.variant.sku,
+        "product": cart_item.product.name,
+        "size": cart_item.size,
+        "color": cart_item.color,
+        "quantity": cart_item.quantity,
+        "stock_left": stock_left,
+        "error": reason,
+    }
+
+
+def validate_cart_items(cart_items, short):
+    """
+    Turn the variants that are short ({variant_id: available}, see inventory.shortages)
+    into the list of failed cart lines
+    """
+    failed_items = []
+    for item in cart_items:
+        if item.variant_id not in short:
+            continue
+        product = item.product
+        if not inventory.is_sellable(item.variant):
+            failed_items.append(_line_failure(item, f"{product.name} is no longer available"))
+        else:
+            stock_left = short[item.variant_id]
+            failed_items.append(_line_failure(
+                item,
+                f"Not enough stock for {product.name} stock left {stock_left}",
+                stock_left=stock_left,
+            ))
+    return failed_items
+
+
+def place_order(user, shipping_address, payment_method):
+    """
+    Turn the user's cart into an order with a fixed number of queries no matter how big the cart is:
+    cart + items (2), variant locks (1), reservations (1), order insert (1), order items bulk insert (1),
+    stock update (1), reservation release (1), cart clear (2), email job (1), sales rollups (4).
+    Raises Cart.DoesNotExist when the user has no cart and CheckoutError when any line fails.
+    """
+    with transaction.atomic():
+        # 1. Get user's cart and all its items in one go
+        cart = Cart.objects.get(user=user)
+        cart_items = list(cart.cart_items.all())
+        if not cart_items:
+            raise CheckoutError("Cart is empty")
+
+        # 2. Lock the variants (always in the same order) so nobody can sell them under us,
+        # then validate against the stock other carts are holding, collecting every bad line
+        quantities = inventory.cart_quantities(cart_items)
+        variants = inventory.lock_variants(quantities.keys())
+        for item in cart_items:
+            item.variant = variants[item.variant_id]
+            item.product = item.variant.product
+        short = inventory.shortages(quantities, variants, inventory.reserved_quantities(quantities.keys(), exclude_cart=cart))
+        if short:
+            raise CheckoutError("Some items in your cart can't be ordered", validate_cart_items(cart_items, short))
+
+        total_amount = sum(item.quantity * item.product.price for item in cart_items)
+
+        # 3. Create order
+        order = Order.objects.create(
+            customer=user,
+            status='pending',
+            total_amount=total_amount,
+            shipping_address=shipping_address,
+            payment_method=payment_method,
+            payment_status='pending'
+        )
+
+        # 4. Convert cart items to order items with a single insert
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=item.product,
+                variant=item.variant,
+                quantity=item.quantity,
+                price_at_purchase=item.product.price,
+                size=item.variant.size,
+                color=item.variant.color
+            )
+            for item in cart_items
+        ])
+
+        # 5. Update inventory with a single conditional update, the condition is a safety net
+        # for databases where the row lock above is a no-op
+        if inventory.decrement_stock(quantities) != len(quantities):
+            raise CheckoutError("Stock changed while checking out, please try again")
+        # update() doesn't send save signals, so refresh the cached catalog ourselves once stock really changed
+        transaction.on_commit(bump_catalog_version)
+
+        # 6. The order now owns the stock, drop the cart's reservations and clear cart
+        inventory.release_cart(cart)
+        clear_cart(cart)
+
+        # 7. Queue the confirmation email, the send_queued_emails worker sends it after we commit
+        queue_order_confirmation(order)
+
+        # 8. Count the order in the sales rollups (api/analytics.py)
+        analytics.add_orders([order.id])
+
+    return order
@@ -0,0 +1,125 @@
+import hashlib
+from functools import partial
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from .catalog import catalog_version
+from .replicas import read_from_primary
+
+# Conditional GET (ETag / Last-Modified, answered with 304 Not Modified) and Cache-Control per route.
+# A view describes what it would return with a cheap query (timestamps and counters, see the *_version
+# functions below) instead of loading and serializing it. When the client already has that version
+# the response is a bodiless 304 and the serializer never runs.
+# Cache-Control comes from CACHE_CONTROL in settings ({'<url name>': 'public, max-age=60'}), so a CDN
+# can answer catalog traffic; routes not listed get 'no-cache' (always revalidate, usually a cheap 304).
+
+DEFAULT_CACHE_CONTROL = 'no-cache'
+
+
+def make_etag(parts):
+    """
+    Strong ETag from the values that make up a version
+    """
+    return '"' + hashlib.sha256(repr(parts).encode()).hexdigest()[:32] + '"'
+
+
+def latest(*timestamps):
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return max(timestamps) if timestamps else None
+
+
+def product_version(products):
+    """
+    (etag parts, last modified) of the first product of the queryset, or None when there is none.
+    One query over the product, its category, variants and image renditions
+    """
+    row = (products.prefetch_related(None).order_by().values('id', 'updated_at', 'category__updated_at')
+           .annotate(variants_updated=Max('variants__updated_at'), variant_count=Count('variants', distinct=True),
+                     renditions_created=Max('renditions__created_at'), rendition_count=Count('renditions', distinct=True))
+           .first())
+    if row is None:
+        return None
+    last_modified = latest(row['updated_at'], row['category__updated_at'], row['variants_updated'], row['renditions_created'])
+    # counts catch deleted variants and renditions, which leave no timestamp behind
+    return ('product', *row.values()), last_modified
+
+
+def row_version(queryset, fields, with_catalog=False):
+    """
+    (etag parts, last modified) from some columns of the first row of the queryset, or None when there is none.
+    with_catalog for responses that also show product data (names, prices), they change with the catalog version.
+    Last-Modified is only sent when the row's own updated_at covers everything in the response
+    """
+    row = queryset.prefetch_related(None).order_by().values_list(*fields).first()
+    if row is None:
+        return None
+    parts = (queryset.model._meta.label, *row)
+    if with_catalog:
+        return (*parts, catalog_version()), None
+    return parts, row[fields.index('updated_at')] if 'updated_at' in fields else None
+
+
+def rows_version(queryset):
+    """
+    (etag parts, None) of a list of rows with updated_at that show product data, from one aggregate query
+    """
+    summary = queryset.prefetch_related(None).order_by().aggregate(count=Count('id'), last=Max('updated_at'))
+    return (queryset.model._meta.label, summary['count'], summary['last'], catalog_version()), None
+
+
+def catalog_list_version(name):
+    """
+    Product and category lists change with the catalog version, bumped on every product, variant,
+    category and image change (api/catalog.py), so this costs no query at all
+    """
+    return (name, catalog_version()), None
+
+
+class ConditionalMixin:
+    """
+    For viewsets: answer_conditionally(request, version, build) returns a 304 when the client's
+    If-None-Match / If-Modified-Since matches the version, and otherwise the response build() makes.
+    Either way the response gets ETag, Last-Modified and Cache-Control headers
+    """
+    def answer_conditionally(self, request, version, build, primary=False):
+        """
+        primary=True builds the response from the primary database, for versions that aren't read from the rows
+        themselves (catalog_list_version): a lagging replica would send old rows under the new ETag
+        """
+        if primary:
+            build = partial(self.build_from_primary, build)
+        if version is None:
+            # nothing to compare (e.g. not found), the normal view answers
+            return build()
+        parts, last_modified = version
+        etag = make_etag(parts)
+        # whole seconds, like the Last-Modified header (and django.views.decorators.http.condition)
+        last_modified = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = build()
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            view = request.resolver_match.view_name if request.resolver_match else None
+            patch_cache_control(response, **cache_control(view))
+        return response
+
+    def build_from_primary(self, build):
+        with read_from_primary():
+            return build()
+
+
+def cache_control(view):
+    """
+    The CACHE_CONTROL policy of a url name as keyword arguments for patch_cache_control
+    """
+    policy = getattr(settings, 'CACHE_CONTROL', {}).get(view, DEFAULT_CACHE_CONTROL)
+    directives = {}
+    for directive in policy.split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.replace('-', '_')] = value or True
+    return directives
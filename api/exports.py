@@ -0,0 +1,126 @@
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from .models import ProductVariant
+
+EXPORT_CHUNK_SIZE = 1000
+
+ORDER_CSV_HEADER = [
+    'order_number', 'order_date', 'customer', 'status', 'payment_status', 'payment_method',
+    'total_amount', 'shipping_address', 'product_code', 'product', 'size', 'color', 'quantity', 'price_at_purchase',
+]
+
+
+class Echo:
+    # csv.writer wants a file, this one just hands back what is written so we can yield it
+    def write(self, value):
+        return value
+
+
+def iter_orders(queryset):
+    # iterator() with chunk_size keeps only one chunk of orders (and their prefetched items) in memory at a time
+    return queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def orders_to_csv(queryset):
+    """
+    Yield the orders as CSV, one line per order item
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(ORDER_CSV_HEADER)
+    for order in iter_orders(queryset):
+        for item in order.items.all():
+            yield writer.writerow([
+                order.order_number, order.order_date.isoformat(), order.customer.username, order.status,
+                order.payment_status, order.payment_method, order.total_amount, order.shipping_address,
+                item.product.unique_code, item.product.name, item.size, item.color, item.quantity, item.price_at_purchase,
+            ])
+
+
+def orders_to_ndjson(queryset):
+    """
+    Yield the orders as newline delimited JSON, one order (with its items) per line
+    """
+    for order in iter_orders(queryset):
+        yield json.dumps({
+            'order_number': order.order_number,
+            'order_date': order.order_date,
+            'customer': order.customer.username,
+            'status': order.status,
+            'payment_status': order.payment_status,
+            'payment_method': order.payment_method,
+            'total_amount': order.total_amount,
+            'shipping_address': order.shipping_address,
+            'items': [
+                {
+                    'product_code': item.product.unique_code,
+                    'product': item.product.name,
+                    'size': item.size,
+                    'color': item.color,
+                    'quantity': item.quantity,
+                    'price_at_purchase': item.price_at_purchase,
+                }
+                for item in order.items.all()
+            ],
+        }, cls=DjangoJSONEncoder) + '\n'
+
+
+# Products, in the format `import_products` reads back (api/imports.py).
+# A product with variants has a row per variant, its own columns repeated on each
+PRODUCT_CSV_HEADER = ['unique_code', 'name', 'description', 'price', 'category', 'is_available', 'image', 'sku', 'size', 'color', 'stock_quantity']
+
+
+def iter_products(queryset):
+    # with chunk_size, iterator() prefetches the variants of each chunk of products in one query
+    return (queryset
+            .select_related('category')
+            .prefetch_related(Prefetch('variants', queryset=ProductVariant.objects.order_by('id')))
+            .order_by('id')
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE))
+
+
+def product_row(product):
+    return {
+        'unique_code': product.unique_code,
+        'name': product.name,
+        'description': product.description,
+        'price': product.price,
+        'category': product.category.name if product.category else '',
+        'is_available': product.is_available,
+        'image': product.image.name or '',
+    }
+
+
+def product_rows(product):
+    """
+    The product's row, or one row per variant
+    """
+    row = product_row(product)
+    variants = product.variants.all()
+    if not variants:
+        return [row]
+    return [
+        dict(row, sku=variant.sku, size=variant.size, color=variant.color, stock_quantity=variant.stock_quantity)
+        for variant in variants
+    ]
+
+
+def products_to_csv(queryset):
+    """
+    Yield the products as CSV, one line per product or variant with the category by name and the image's storage path
+    """
+    writer = csv.DictWriter(Echo(), fieldnames=PRODUCT_CSV_HEADER)
+    yield writer.writeheader()
+    for product in iter_products(queryset):
+        for row in product_rows(product):
+            yield writer.writerow(row)
+
+
+def products_to_ndjson(queryset):
+    """
+    Yield the products as newline delimited JSON, one product or variant per line
+    """
+    for product in iter_products(queryset):
+        for row in product_rows(product):
+            yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
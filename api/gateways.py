@@ -0,0 +1,311 @@
+import threading
+import time
+import requests
+import stripe
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+try:
+    import httpx
+except ImportError:
+    # only the async payment views (api/async_views.py) need it, without it their gateway calls run in a thread
+    httpx = None
+
+
+class GatewayError(Exception):
+    """
+    Raised when a payment gateway call fails or the gateway can't be used for a payment method
+    """
+
+
+class GatewayUnavailable(GatewayError):
+    """
+    Raised without calling the gateway while its circuit breaker is open
+    """
+
+
+class GatewayRejected(GatewayError):
+    """
+    Raised when the gateway answered but refused the call (4xx: a declined card, a bad amount...).
+    The gateway itself is fine, so these don't count toward the circuit breaker
+    """
+
+
+def is_outage(error):
+    """
+    True when an error means the gateway is down or overloaded: connection errors, timeouts,
+    rate limits and 5xx responses. Only these open the circuit breaker
+    """
+    if isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError)):
+        return True
+    if isinstance(error, stripe.StripeError):
+        return (error.http_status or 0) >= 500
+    # anything else came from the HTTP client (timeouts, refused connections...) before there was an answer
+    return True
+
+
+class CircuitBreaker:
+    """
+    Stops calling a gateway after `failure_threshold` failures in a row, so a dead gateway fails fast
+    instead of tying up a worker for the full timeout on every request. After `reset_seconds` one call
+    is let through, if it works the breaker closes again
+    """
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'half-open':
+                # let this one call through and keep everyone else out until we know how it went
+                self.opened_at = time.monotonic()
+            return state != 'open'
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                # a failed trial call while half-open opens the breaker for another reset_seconds
+                self.opened_at = time.monotonic()
+
+
+class GatewayMetrics:
+    """
+    Call count, error count and latency per (gateway, operation), kept in memory for this process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def record(self, gateway, operation, seconds, ok):
+        with self.lock:
+            stats = self.calls.setdefault((gateway, operation), {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['errors'] += 0 if ok else 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: dict(stats) for key, stats in self.calls.items()}
+
+
+metrics = GatewayMetrics()
+
+
+class PaymentGateway:
+    """
+    Base class for payment gateways. Subclasses implement _create_payment and _payment_status,
+    the public methods add the circuit breaker and the latency metrics around them.
+    acreate_payment and apayment_status are the async versions, they run the sync methods in a thread
+    unless the subclass implements _acreate_payment/_apayment_status with an async HTTP client
+    """
+    name = None
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            failure_threshold=getattr(settings, 'PAYMENT_GATEWAY_FAILURE_THRESHOLD', 5),
+            reset_seconds=getattr(settings, 'PAYMENT_GATEWAY_RESET_SECONDS', 30),
+        )
+
+    def _failed(self, operation, started, error):
+        """
+        Record a failed call and return the GatewayError to raise for it
+        """
+        metrics.record(self.name, operation, time.perf_counter() - started, ok=False)
+        if not is_outage(error):
+            # the gateway answered, so it is up: a refused trial call closes a half-open breaker
+            self.breaker.record_success()
+            return GatewayRejected(f"{self.name} {operation} was refused: {error}")
+        self.breaker.record_failure()
+        return GatewayError(f"{self.name} {operation} failed: {error}")
+
+    def _call(self, operation, func, *args):
+        if not self.breaker.allow():
+            raise GatewayUnavailable(f"{self.name} is unavailable, try again shortly")
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception as e:
+            raise self._failed(operation, started, e) from e
+        self.breaker.record_success()
+        metrics.record(self.name, operation, time.perf_counter() - started, ok=True)
+        return result
+
+    async def _acall(self, operation, func, *args):
+        if not self.breaker.allow():
+            raise GatewayUnavailable(f"{self.name} is unavailable, try again shortly")
+        started = time.perf_counter()
+        try:
+            result = await func(*args)
+        except Exception as e:
+            raise self._failed(operation, started, e) from e
+        self.breaker.record_success()
+        metrics.record(self.name, operation, time.perf_counter() - started, ok=True)
+        return result
+
+    def create_payment(self, order, idempotency_key):
+        """
+        Start a payment for the order. Returns {'id': ..., 'client_secret': ..., 'status': ...}
+        """
+        return self._call('create_payment', self._create_payment, order, idempotency_key)
+
+    def payment_status(self, payment_id):
+        """
+        Current status of a payment at the gateway (for Stripe: the PaymentIntent status)
+        """
+        return self._call('payment_status', self._payment_status, payment_id)
+
+    async def acreate_payment(self, order, idempotency_key):
+        return await self._acall('create_payment', self._acreate_payment, order, idempotency_key)
+
+    async def apayment_status(self, payment_id):
+        return await self._acall('payment_status', self._apayment_status, payment_id)
+
+    def _create_payment(self, order, idempotency_key):
+        raise NotImplementedError
+
+    def _payment_status(self, payment_id):
+        raise NotImplementedError
+
+    async def _acreate_payment(self, order, idempotency_key):
+        return await sync_to_async(self._create_payment, thread_sensitive=False)(order, idempotency_key)
+
+    async def _apayment_status(self, payment_id):
+        return await sync_to_async(self._payment_status, thread_sensitive=False)(payment_id)
+
+
+def pooled_session():
+    # one keep-alive connection pool per process, instead of a new TLS handshake per call
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=getattr(settings, 'PAYMENT_GATEWAY_POOL_SIZE', 20),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class StripeGateway(PaymentGateway):
+    name = 'stripe'
+
+    def __init__(self):
+        super().__init__()
+        base_addresses = {}
+        if getattr(settings, 'STRIPE_API_BASE', None):
+            # e.g. http://localhost:12111 for a local stripe-mock server
+            base_addresses['api'] = settings.STRIPE_API_BASE
+        connect_timeout = getattr(settings, 'PAYMENT_GATEWAY_CONNECT_TIMEOUT', 3)
+        read_timeout = getattr(settings, 'PAYMENT_GATEWAY_READ_TIMEOUT', 10)
+        self.client = stripe.StripeClient(
+            settings.STRIPE_SECRET_KEY or '',
+            http_client=stripe.RequestsClient(
+                timeout=(connect_timeout, read_timeout),
+                session=pooled_session(),
+                # the *_async calls go through httpx, its connection pool belongs to the event loop of the ASGI worker
+                async_fallback_client=stripe.HTTPXClient(timeout=httpx.Timeout(read_timeout, connect=connect_timeout)) if httpx else None,
+            ),
+            base_addresses=base_addresses or None,
+            # retries are safe because every create call carries an idempotency key
+            max_network_retries=1,
+        )
+
+    def intent_params(self, order):
+        return {
+            'amount': int(order.total_amount * 100),
+            'currency': 'usd',
+            'metadata': {
+                'order_id': order.id,
+                'customer_id': order.customer_id,
+            },
+        }
+
+    def _create_payment(self, order, idempotency_key):
+        intent = self.client.v1.payment_intents.create(
+            params=self.intent_params(order),
+            options={'idempotency_key': idempotency_key},
+        )
+        return {'id': intent.id, 'client_secret': intent.client_secret, 'status': intent.status}
+
+    def _payment_status(self, payment_id):
+        return self.client.v1.payment_intents.retrieve(payment_id).status
+
+    async def _acreate_payment(self, order, idempotency_key):
+        if httpx is None:
+            return await super()._acreate_payment(order, idempotency_key)
+        intent = await self.client.v1.payment_intents.create_async(
+            params=self.intent_params(order),
+            options={'idempotency_key': idempotency_key},
+        )
+        return {'id': intent.id, 'client_secret': intent.client_secret, 'status': intent.status}
+
+    async def _apayment_status(self, payment_id):
+        if httpx is None:
+            return await super()._apayment_status(payment_id)
+        intent = await self.client.v1.payment_intents.retrieve_async(payment_id)
+        return intent.status
+
+
+class UnsupportedGateway(PaymentGateway):
+    # eSewa and ConnectIPS are listed in Order.PAYMENT_METHOD but not integrated yet
+    def __init__(self, name):
+        self.name = name
+        super().__init__()
+
+    def create_payment(self, order, idempotency_key):
+        raise GatewayRejected(f"{self.name} payments are not supported yet")
+
+    def payment_status(self, payment_id):
+        raise GatewayRejected(f"{self.name} payments are not supported yet")
+
+    async def acreate_payment(self, order, idempotency_key):
+        raise GatewayRejected(f"{self.name} payments are not supported yet")
+
+    async def apayment_status(self, payment_id):
+        raise GatewayRejected(f"{self.name} payments are not supported yet")
+
+
+# Order.payment_method -> gateway name. Cash on delivery doesn't go through a gateway
+GATEWAY_FOR_PAYMENT_METHOD = {
+    'visa': 'stripe',
+    'mastercard': 'stripe',
+    'esewa': 'esewa',
+    'connectips': 'connectips',
+}
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway(payment_method):
+    """
+    The gateway for an order's payment_method. Gateways are made once per process so the
+    connection pool and the circuit breaker are shared by every request
+    """
+    name = GATEWAY_FOR_PAYMENT_METHOD.get(payment_method)
+    if name is None:
+        # e.g. cash on delivery: a request problem, not a gateway failure
+        raise GatewayRejected(f"{payment_method} orders are paid on delivery, they have no online payment")
+    with _gateways_lock:
+        if name not in _gateways:
+            _gateways[name] = StripeGateway() if name == 'stripe' else UnsupportedGateway(name)
+        return _gateways[name]
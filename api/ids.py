@@ -0,0 +1,148 @@
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+# digits first, then upper case, then lower case: this is ASCII order, so codes of the
+# same length sort the same way as the numbers they encode (new codes always sort last)
+BASE62_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+CODE_LENGTH = 11  # 62**11 > 2**63, every 63 bit id fits
+
+
+def base62_encode(number, length=CODE_LENGTH):
+    chars = []
+    while number:
+        number, remainder = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[remainder])
+    return ''.join(reversed(chars)).rjust(length, '0')
+
+
+def base62_decode(code):
+    number = 0
+    for char in code:
+        number = number * 62 + BASE62_ALPHABET.index(char)
+    return number
+
+
+def checksum_char(code):
+    # weighted sum, so swapping two characters (the most common typo) changes the checksum
+    total = sum((position + 1) * BASE62_ALPHABET.index(char) for position, char in enumerate(code))
+    return BASE62_ALPHABET[total % 62]
+
+
+def lock_file(handle):
+    """
+    Take an exclusive lock on an open file without waiting, raises OSError when another process holds it.
+    The operating system drops the lock when the process exits, even when it crashes
+    """
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def claim_process_slot(slots, directory=None):
+    """
+    A number in range(slots) no other running process on this machine holds, kept until this process exits.
+    Each slot is a lock file in directory (ID_SLOT_DIR, a folder in the temp directory by default).
+    Returns (slot, open file), the file has to stay open to keep the slot
+    """
+    directory = directory or getattr(settings, 'ID_SLOT_DIR', None) or os.path.join(tempfile.gettempdir(), 'kazi-id-slots')
+    os.makedirs(directory, exist_ok=True)
+    for slot in range(slots):
+        handle = open(os.path.join(directory, f'slot-{slot}.lock'), 'a+')
+        try:
+            lock_file(handle)
+        except OSError:
+            handle.close()
+            continue
+        return slot, handle
+    raise RuntimeError(f"All {slots} id slots in {directory} are taken, run fewer processes per host")
+
+
+class SnowflakeGenerator:
+    """
+    Time ordered 63 bit ids: 41 bits of milliseconds since EPOCH_MS, 10 bits of worker id, 12 bits of sequence.
+    Every worker can make 4096 ids per millisecond without talking to the database, and two workers
+    can never make the same id as long as they have different worker ids.
+    The worker id is the host (ID_HOST_ID setting, 0-31, one per machine or container, required unless DEBUG) and a process slot (0-31)
+    claimed with a lock file when the generator is made, so every process on a host gets its own
+    """
+    EPOCH_MS = 1735689600000  # 2025-01-01 UTC
+    HOST_BITS = 5
+    PROCESS_BITS = 5
+    WORKER_BITS = HOST_BITS + PROCESS_BITS
+    SEQUENCE_BITS = 12
+    MAX_HOST_ID = (1 << HOST_BITS) - 1
+    MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+    MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+    def __init__(self, worker_id=None, clock=None):
+        self.slot_file = None
+        if worker_id is None:
+            host_id = getattr(settings, 'ID_HOST_ID', None)
+            if host_id in (None, ''):
+                if not settings.DEBUG:
+                    # a silent default would give two hosts with the same process slot the same ids
+                    raise ImproperlyConfigured(f"Set ID_HOST_ID to a different number (0-{self.MAX_HOST_ID}) for every machine or container")
+                host_id = 0
+            host_id = int(host_id)
+            if not 0 <= host_id <= self.MAX_HOST_ID:
+                raise ImproperlyConfigured(f"ID_HOST_ID must be between 0 and {self.MAX_HOST_ID}")
+            slot, self.slot_file = claim_process_slot(1 << self.PROCESS_BITS)
+            worker_id = (host_id << self.PROCESS_BITS) | slot
+        if not 0 <= int(worker_id) <= self.MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {self.MAX_WORKER_ID}")
+        self.worker_id = int(worker_id)
+        self.clock = clock or (lambda: int(time.time() * 1000))
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            now = self.clock()
+            if now < self.last_ms:
+                # the clock went backwards (NTP), keep counting from the last time we used
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & self.MAX_SEQUENCE
+                if self.sequence == 0:
+                    # used all 4096 ids of this millisecond, borrow the next one instead of waiting
+                    now = self.last_ms + 1
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return ((now - self.EPOCH_MS) << (self.WORKER_BITS + self.SEQUENCE_BITS)) | (self.worker_id << self.SEQUENCE_BITS) | self.sequence
+
+    def generate(self):
+        code = base62_encode(self.next_id())
+        return code + checksum_char(code)
+
+
+_generator = None
+_generator_pid = None
+
+
+def get_generator():
+    """
+    The generator from the ID_GENERATOR setting, one per process (a forked worker gets its own, with its own slot)
+    """
+    global _generator, _generator_pid
+    if _generator is None or _generator_pid != os.getpid():
+        generator_class = import_string(getattr(settings, 'ID_GENERATOR', 'api.ids.SnowflakeGenerator'))
+        _generator = generator_class()
+        _generator_pid = os.getpid()
+    return _generator
+
+
+def generate_code():
+    """
+    Default for Order.order_number, Cart.cart_number and Product.unique_code
+    """
+    return get_generator().generate()
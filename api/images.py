@@ -0,0 +1,154 @@
+import hashlib
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from .models import ImageJob, ImageRendition
+from .catalog import bump_catalog_version
+from .renditions import render, DEFAULT_WIDTHS, DEFAULT_FORMATS, DEFAULT_QUALITY
+
+RENDITION_DIR = 'products/renditions/'
+# retry after 1, 2, 4 ... minutes, a job claimed by a worker that died is picked up again after the lease
+RETRY_BASE_SECONDS = 60
+CLAIM_LEASE_SECONDS = 10 * 60
+
+
+def queue_renditions(product):
+    """
+    Ask the process_images worker to make renditions of the product's current image
+    """
+    return ImageJob.objects.create(product=product, source=product.image.name)
+
+
+def queue_renditions_for(products):
+    """
+    queue_renditions for many products with one insert, e.g. after an import
+    """
+    return ImageJob.objects.bulk_create([ImageJob(product=product, source=product.image.name) for product in products])
+
+
+def store_rendition(data, format):
+    """
+    Save the rendition under a name made from a hash of its bytes, an identical file is stored once
+    """
+    name = f"{RENDITION_DIR}{hashlib.sha256(data).hexdigest()[:32]}.{'jpg' if format == 'jpeg' else format}"
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name
+
+
+def claim_jobs(batch_size):
+    """
+    Claim up to batch_size due jobs for this worker, moving them to 'processing' with a lease
+    so several workers can run side by side
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(ImageJob.objects
+                   .select_for_update(skip_locked=True)
+                   .filter(status__in=['pending', 'processing'], next_attempt_at__lte=now)
+                   .order_by('next_attempt_at')
+                   .values_list('id', flat=True)[:batch_size])
+        ImageJob.objects.filter(id__in=ids).update(
+            status='processing',
+            next_attempt_at=now + timedelta(seconds=CLAIM_LEASE_SECONDS),
+        )
+    return list(ImageJob.objects.filter(id__in=ids).select_related('product'))
+
+
+def save_renditions(job, renditions):
+    """
+    Replace the product's renditions with the new ones in one transaction
+    """
+    rows = [
+        ImageRendition(product=job.product, source=job.source, width=width, height=height, format=format, file=store_rendition(data, format))
+        for width, height, format, data in renditions
+    ]
+    with transaction.atomic():
+        # only the rows go, the files stay: other products can share a file with the same content
+        ImageRendition.objects.filter(product=job.product).delete()
+        ImageRendition.objects.bulk_create(rows)
+
+
+def process_jobs(jobs, pool=None):
+    """
+    Make the renditions of the claimed jobs. The resizing runs in pool (a concurrent.futures executor,
+    process_images uses a process pool so every CPU is used) or inline without one.
+    Failed jobs are retried with backoff until IMAGE_MAX_ATTEMPTS, then marked failed.
+    Returns (done, failed) counts
+    """
+    if not jobs:
+        return 0, 0
+    max_attempts = getattr(settings, 'IMAGE_MAX_ATTEMPTS', 3)
+    done = failed = 0
+    now = timezone.now()
+
+    options = (
+        getattr(settings, 'IMAGE_RENDITION_WIDTHS', DEFAULT_WIDTHS),
+        getattr(settings, 'IMAGE_RENDITION_FORMATS', DEFAULT_FORMATS),
+        getattr(settings, 'IMAGE_RENDITION_QUALITY', DEFAULT_QUALITY),
+    )
+    results = {}
+    for job in jobs:
+        job.attempts += 1
+        if job.product.image.name != job.source:
+            # the image was replaced or removed since, a newer job (if any) takes care of it
+            results[job.id] = None
+            continue
+        try:
+            with job.product.image.open('rb') as original:
+                data = original.read()
+        except Exception as e:
+            results[job.id] = e
+            continue
+        results[job.id] = pool.submit(render, data, *options) if pool else data
+
+    for job in jobs:
+        result = results[job.id]
+        try:
+            if isinstance(result, Exception):
+                raise result
+            if result is not None:
+                save_renditions(job, result.result() if pool else render(result, *options))
+        except Exception as e:
+            failed += 1
+            job.last_error = str(e)
+            if job.attempts >= max_attempts:
+                job.status = 'failed'
+            else:
+                job.status = 'pending'
+                job.next_attempt_at = now + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+        else:
+            done += 1
+            job.status = 'done'
+            job.finished_at = timezone.now()
+            job.last_error = ''
+
+    ImageJob.objects.bulk_update(jobs, ['status', 'attempts', 'next_attempt_at', 'last_error', 'finished_at'])
+    if done:
+        # cached catalog pages still list the old image urls
+        bump_catalog_version()
+    return done, failed
+
+
+def drain_image_jobs(batch_size=20, pool=None):
+    """
+    Process one batch of image jobs. Returns (done, failed)
+    """
+    return process_jobs(claim_jobs(batch_size), pool)
+
+
+def rendition_urls(product, request=None):
+    """
+    {format: {width: url}} for the renditions of the product's current image, from the prefetched renditions.
+    Empty until the worker has processed the image
+    """
+    urls = {}
+    for rendition in product.renditions.all():
+        if rendition.source != product.image.name:
+            continue
+        url = rendition.file.url
+        urls.setdefault(rendition.format, {})[str(rendition.width)] = request.build_absolute_uri(url) if request else url
+    return urls
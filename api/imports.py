@@ -0,0 +1,218 @@
+import csv
+import json
+from itertools import islice
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import as_serializer_error
+from .models import Product, ProductVariant, Category, Cart
+from .serializers import ProductImportSerializer
+from .ids import generate_code
+from .search import index_products
+from .images import queue_renditions_for
+from .carts import refresh_cart_totals
+from .catalog import bump_catalog_version
+
+# Bulk product import from CSV or newline delimited JSON (the format exports.products_to_csv/ndjson write).
+# Rows are read from the file a chunk at a time, so memory stays the same however big the file is. Per chunk:
+# validate every row (ProductImportSerializer), look the new category names up in one query,
+# then insert or update all the products by unique_code with one INSERT ... ON CONFLICT DO UPDATE,
+# and their variants (rows with a size) by product, size and color with another.
+# Bulk writes send no save signals, so the chunk then does what they would have done: index the products
+# for search, queue renditions of changed images and refresh the carts holding products that changed.
+# Bad rows are reported with their line number and skipped, the rest of the file is still imported.
+
+IMPORT_CHUNK_SIZE = 1000
+# errors kept for the report, the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ('csv', 'ndjson')
+# columns replaced when the unique_code already exists, created_at is kept
+UPDATE_FIELDS = ['name', 'description', 'price', 'category', 'is_available', 'image', 'updated_at']
+# a variant is found by product, size and color, only its stock is replaced
+VARIANT_UPDATE_FIELDS = ['stock_quantity', 'updated_at']
+
+
+def guess_format(filename):
+    """
+    'csv' or 'ndjson' from a file name, None when the extension is neither
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'csv':
+        return 'csv'
+    if extension in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    return None
+
+
+def read_rows(stream, file_format):
+    """
+    Yield (line number, row dict) from a text stream, rows that aren't a JSON object come as (line number, None)
+    """
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # CSV has no null, an empty cell is a value left out (extra cells end up under the None key)
+            yield reader.line_num, {name: value for name, value in row.items() if name and value not in ('', None)}
+        return
+
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def add_error(report, line, errors, unique_code=None):
+    report['error_count'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line, 'unique_code': unique_code, 'errors': errors})
+
+
+def resolve_categories(names, categories, create):
+    """
+    Add the ids of the category names to categories ({name: id}, kept for the whole import) with one query.
+    Missing categories are created when create is True. Names used by several categories get the oldest one
+    """
+    names = set(names) - set(categories)
+    if not names:
+        return
+    for category_id, name in Category.objects.filter(name__in=names).order_by('-id').values_list('id', 'name'):
+        categories[name] = category_id
+    missing = names - set(categories)
+    if missing and create:
+        Category.objects.bulk_create([Category(name=name) for name in sorted(missing)])
+        categories.update({name: category_id for category_id, name in Category.objects.filter(name__in=missing).values_list('id', 'name')})
+
+
+def upsert_variants(variants, product_ids, report):
+    """
+    Create the variants ({(unique_code, size, color): (line, row data)}) or replace their stock,
+    with one INSERT ... ON CONFLICT DO UPDATE. product_ids is {unique_code: id} of the imported products.
+    A sku that doesn't match the variant's own, or belongs to another variant, is reported and its row skipped
+    """
+    rows = [(line, product_ids[code], data) for (code, size, color), (line, data) in variants.items() if code in product_ids]
+    existing = {
+        (product_id, size, color): sku
+        for product_id, size, color, sku in ProductVariant.objects
+        .filter(product_id__in={product_id for line, product_id, data in rows})
+        .values_list('product_id', 'size', 'color', 'sku')
+    }
+    taken = set(ProductVariant.objects.filter(sku__in=[data['sku'] for line, product_id, data in rows if 'sku' in data]).values_list('sku', flat=True))
+
+    new_variants = []
+    for line, product_id, data in rows:
+        current = existing.get((product_id, data['size'], data['color']))
+        sku = data.get('sku')
+        if current and sku and sku != current:
+            add_error(report, line, {'sku': [f"This size and color already has the sku {current}"]}, sku)
+            continue
+        if not current and sku in taken:
+            add_error(report, line, {'sku': [f"{sku} is used by another variant"]}, sku)
+            continue
+        sku = current or sku or generate_code()
+        taken.add(sku)
+        new_variants.append(ProductVariant(
+            product_id=product_id,
+            sku=sku,
+            size=data['size'],
+            color=data['color'],
+            stock_quantity=data['stock_quantity'],
+        ))
+        if current:
+            report['variants_updated'] += 1
+        else:
+            report['variants_created'] += 1
+    ProductVariant.objects.bulk_create(new_variants, update_conflicts=True, unique_fields=['product', 'size', 'color'], update_fields=VARIANT_UPDATE_FIELDS)
+
+
+def import_chunk(rows, categories, create_categories, report):
+    # validate. Variant rows repeat their product's columns, the product gets the ones of its last row.
+    # The last row wins when a product without variants, or a variant, is repeated.
+    # One serializer checks every row (like many=True does), making a serializer per row copies all its fields each time
+    serializer = ProductImportSerializer()
+    valid = {}
+    variants = {}
+    for line, row in rows:
+        report['rows'] += 1
+        if row is None:
+            add_error(report, line, {'row': ['Not a JSON object']})
+            continue
+        try:
+            data = serializer.run_validation(row)
+        except ValidationError as e:
+            add_error(report, line, as_serializer_error(e), row.get('unique_code'))
+            continue
+        code = data.get('unique_code') or generate_code()
+        if 'size' in data:
+            variant = (code, data['size'], data['color'])
+            if variant in variants:
+                add_error(report, variants[variant][0], {'size': [f'Repeated on line {line}, that line was imported']}, code)
+            variants[variant] = (line, data)
+        elif code in valid and 'size' not in valid[code][1]:
+            add_error(report, valid[code][0], {'unique_code': [f'Repeated on line {line}, that line was imported']}, code)
+        valid[code] = (line, data)
+
+    with transaction.atomic():
+        resolve_categories([data['category'] for line, data in valid.values() if data.get('category')], categories, create_categories)
+        products = []
+        skipped = {}
+        for code, (line, data) in valid.items():
+            category = data.get('category')
+            if category and category not in categories:
+                add_error(report, line, {'category': [f"Unknown category '{category}'"]}, code)
+                skipped[code] = line
+                continue
+            products.append(Product(
+                unique_code=code,
+                name=data['name'],
+                description=data['description'],
+                price=data['price'],
+                category_id=categories.get(category) if category else None,
+                is_available=data['is_available'],
+                image=data['image'],
+            ))
+        # the other variant rows of a skipped product are skipped with it, each one is reported
+        for (code, size, color), (line, data) in variants.items():
+            if code in skipped and line != skipped[code]:
+                add_error(report, line, {'unique_code': [f"Not imported, the product was skipped (see line {skipped[code]})"]}, code)
+        if not products:
+            return
+
+        codes = [product.unique_code for product in products]
+        existing = dict(Product.objects.filter(unique_code__in=codes).values_list('unique_code', 'image'))
+        Product.objects.bulk_create(products, update_conflicts=True, unique_fields=['unique_code'], update_fields=UPDATE_FIELDS)
+
+        # what the Product save signals would have done (api/signals.py)
+        saved = list(Product.objects.select_related('category').filter(unique_code__in=codes))
+        if variants:
+            upsert_variants(variants, {product.unique_code: product.id for product in saved}, report)
+        index_products(saved)
+        queue_renditions_for([product for product in saved if product.image and product.image.name != existing.get(product.unique_code)])
+        updated_ids = [product.id for product in saved if product.unique_code in existing]
+        if updated_ids:
+            refresh_cart_totals(Cart.objects.filter(cart_items__product_id__in=updated_ids).distinct())
+
+    report['created'] += len(products) - len(existing)
+    report['updated'] += len(existing)
+
+
+def import_products(rows, chunk_size=IMPORT_CHUNK_SIZE, create_categories=False):
+    """
+    Create or update products from (line number, row dict) pairs, e.g. read_rows(file, 'csv').
+    Each chunk of chunk_size rows is its own transaction. Returns a report:
+    {'rows': n, 'created': n, 'updated': n, 'variants_created': n, 'variants_updated': n,
+     'error_count': n, 'errors': [{'line', 'unique_code', 'errors'}]}
+    """
+    report = {'rows': 0, 'created': 0, 'updated': 0, 'variants_created': 0, 'variants_updated': 0, 'error_count': 0, 'errors': []}
+    categories = {}
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        import_chunk(chunk, categories, create_categories, report)
+    # the catalog pages and ETags change once, after the whole import
+    transaction.on_commit(bump_catalog_version)
+    return report
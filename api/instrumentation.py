@@ -0,0 +1,259 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from .gateways import metrics as gateway_metrics
+
+logger = logging.getLogger('api.instrumentation')
+
+# Per-request cost (query count, database time, serializer time, latency) per view, kept in histograms
+# in this process. GET /metrics/ shows them in the Prometheus text format; with several worker processes
+# every process has its own numbers, so scrape each one (or sum them in Prometheus)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+DEFAULT_QUERY_BUDGET = 30
+# at most this many statements are kept per request for the budget warning
+MAX_RECORDED_QUERIES = 500
+
+_current = ContextVar('request_stats', default=None)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like a Prometheus histogram
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class RequestMetrics:
+    """
+    Histograms per (metric, view, method), safe to use from several threads
+    """
+    METRICS = {
+        'api_request_duration_seconds': ('Total time to answer the request', LATENCY_BUCKETS),
+        'api_request_db_queries': ('Database queries run by the request', QUERY_BUCKETS),
+        'api_request_db_seconds': ('Time spent waiting on the database', LATENCY_BUCKETS),
+        'api_request_serializer_seconds': ('Time spent turning objects into response data (includes queries it causes)', LATENCY_BUCKETS),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.over_budget = Counter()
+
+    def record(self, view, method, stats, duration, budget_exceeded):
+        values = {
+            'api_request_duration_seconds': duration,
+            'api_request_db_queries': stats.queries,
+            'api_request_db_seconds': stats.db_seconds,
+            'api_request_serializer_seconds': stats.serializer_seconds,
+        }
+        with self.lock:
+            for name, value in values.items():
+                key = (name, view, method)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.METRICS[name][1])
+                self.histograms[key].observe(value)
+            if budget_exceeded:
+                self.over_budget[(view, method)] += 1
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.over_budget.clear()
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, (help_text, buckets) in self.METRICS.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, view, method), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    labels = f'view="{view}",method="{method}"'
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+            lines.append('# HELP api_request_over_query_budget_total Requests that ran more queries than their budget')
+            lines.append('# TYPE api_request_over_query_budget_total counter')
+            for (view, method), count in sorted(self.over_budget.items()):
+                lines.append(f'api_request_over_query_budget_total{{view="{view}",method="{method}"}} {count}')
+
+        lines.append('# HELP api_gateway_calls_total Payment gateway calls')
+        lines.append('# TYPE api_gateway_calls_total counter')
+        lines.append('# HELP api_gateway_errors_total Failed payment gateway calls')
+        lines.append('# TYPE api_gateway_errors_total counter')
+        lines.append('# HELP api_gateway_seconds_total Time spent in payment gateway calls')
+        lines.append('# TYPE api_gateway_seconds_total counter')
+        for (gateway, operation), stats in sorted(gateway_metrics.snapshot().items()):
+            labels = f'gateway="{gateway}",operation="{operation}"'
+            lines.append(f'api_gateway_calls_total{{{labels}}} {stats["count"]}')
+            lines.append(f'api_gateway_errors_total{{{labels}}} {stats["errors"]}')
+            lines.append(f'api_gateway_seconds_total{{{labels}}} {stats["total_seconds"]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = RequestMetrics()
+
+
+class RequestStats:
+    """
+    What one request cost so far. Filled by record_query and the serializer mixin
+    """
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.serializer_depth = 0
+        self.statements = []
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every database connection (see track_queries), adds the query to the
+    current request's stats. The stats live in a ContextVar, so queries an async view runs through
+    sync_to_async in another thread still count for its request
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_seconds += time.perf_counter() - started
+        stats.queries += 1
+        if len(stats.statements) < MAX_RECORDED_QUERIES:
+            stats.statements.append(sql)
+
+
+def track_queries(connection):
+    # called for every new connection (api/signals.py)
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class TimedSerializerMixin:
+    """
+    Adds the time a serializer spends in to_representation to the current request's stats.
+    Only the outermost serializer counts, nested serializers run inside its time
+    """
+    def to_representation(self, instance):
+        stats = _current.get()
+        if stats is None:
+            return super().to_representation(instance)
+        stats.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            stats.serializer_depth -= 1
+            if stats.serializer_depth == 0:
+                stats.serializer_seconds += time.perf_counter() - started
+
+
+def fingerprint(sql):
+    """
+    The shape of a statement without its values, so the same query with different ids counts as one
+    """
+    sql = sql.replace('%s', '?')
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', sql)
+    sql = re.sub(r'\s+', ' ', sql)
+    return sql.strip()
+
+
+def query_budget(view):
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    return budgets.get(view, getattr(settings, 'QUERY_BUDGET_DEFAULT', DEFAULT_QUERY_BUDGET))
+
+
+class InstrumentationMiddleware:
+    """
+    Measures every request and warns (logger 'api.instrumentation') when a view runs more queries than
+    its budget: QUERY_BUDGETS = {'<url name>': n}, QUERY_BUDGET_DEFAULT for the rest.
+    The warning lists the most repeated statement shapes, an N+1 shows up as one shape run N times.
+    Works under WSGI and ASGI, async views aren't pushed into a thread because of it
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            # streaming responses (order export) run most of their queries after this, those aren't counted
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, stats, time.perf_counter() - started)
+        return response
+
+    def record(self, request, stats, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name if match else None) or 'unmatched'
+        budget = query_budget(view)
+        exceeded = stats.queries > budget
+        metrics.record(view, request.method, stats, duration, exceeded)
+        if exceeded:
+            repeated = Counter(fingerprint(sql) for sql in stats.statements).most_common(5)
+            logger.warning(
+                "%s %s (%s) ran %d queries, budget is %d. Most repeated:\n%s",
+                request.method, request.path, view, stats.queries, budget,
+                '\n'.join(f'{count} x {sql}' for sql, count in repeated),
+            )
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    """
+    GET /metrics/ for Prometheus. Staff only: scrape it with a staff user's token
+    (authorization: {type: Token, credentials: <token>} in the scrape config)
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,166 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Sum, Subquery, Value, IntegerField, PositiveIntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import ProductVariant, StockReservation
+
+# how long a cart entering checkout keeps its stock, can be changed in settings
+DEFAULT_RESERVATION_MINUTES = 15
+
+
+def reservation_ttl():
+    return timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_MINUTES', DEFAULT_RESERVATION_MINUTES))
+
+
+def cart_quantities(cart_items):
+    """
+    Sum the quantity per variant for a list of cart items: {variant_id: quantity}
+    """
+    quantities = defaultdict(int)
+    for item in cart_items:
+        quantities[item.variant_id] += item.quantity
+    return dict(quantities)
+
+
+def lock_variants(variant_ids):
+    """
+    Lock the variant rows with SELECT ... FOR UPDATE and return them as {id: variant}, with their product.
+    Rows are always locked in primary key order so two checkouts sharing variants
+    wait for each other instead of deadlocking. Checkouts with no variants in common don't block at all.
+    Only the variant rows are locked, editing the product doesn't wait for checkouts.
+    Must be called inside transaction.atomic()
+    """
+    variants = (ProductVariant.objects.select_for_update(of=('self',)).select_related('product')
+                .filter(pk__in=variant_ids).order_by('pk'))
+    return {variant.pk: variant for variant in variants}
+
+
+def reserved_quantities(variant_ids, exclude_cart=None):
+    """
+    Stock held by unexpired reservations for each variant in one query: {variant_id: quantity}.
+    Reservations of exclude_cart are left out, a cart never competes with itself
+    """
+    reservations = StockReservation.objects.filter(variant_id__in=variant_ids, expires_at__gt=timezone.now())
+    if exclude_cart is not None:
+        reservations = reservations.exclude(cart=exclude_cart)
+    totals = reservations.values('variant_id').annotate(total=Sum('quantity'))
+    return {row['variant_id']: row['total'] for row in totals}
+
+
+def reserved_elsewhere(variant, cart):
+    """
+    Stock of the variant held by the unexpired reservations of other carts, as an expression
+    to use inside another query (e.g. the conditional UPDATE of carts.add_item). 0 when there are none
+    """
+    reservations = (StockReservation.objects.filter(variant=variant, expires_at__gt=timezone.now()).exclude(cart=cart)
+                    .order_by().values('variant').annotate(total=Sum('quantity')).values('total'))
+    return Coalesce(Subquery(reservations), Value(0), output_field=IntegerField())
+
+
+def available_stock(variant, exclude_cart=None):
+    """
+    Stock that can still be promised to a cart: stock_quantity minus what other carts are holding
+    """
+    reserved = reserved_quantities([variant.pk], exclude_cart=exclude_cart).get(variant.pk, 0)
+    return max(variant.stock_quantity - reserved, 0)
+
+
+def is_sellable(variant):
+    return variant.is_available and variant.product.is_available
+
+
+def shortages(quantities, variants, reserved):
+    """
+    Compare wanted quantities against locked variants and return {variant_id: available}
+    for every variant that can't be given out (unavailable variants or products have 0 available)
+    """
+    short = {}
+    for variant_id, quantity in quantities.items():
+        variant = variants.get(variant_id)
+        if variant is None or not is_sellable(variant):
+            short[variant_id] = 0
+            continue
+        available = max(variant.stock_quantity - reserved.get(variant_id, 0), 0)
+        if available < quantity:
+            short[variant_id] = available
+    return short
+
+
+def reserve_cart(cart, cart_items, ttl=None):
+    """
+    Hold stock for every variant in the cart until now + ttl.
+    Any older reservation of the cart is replaced. Returns {variant_id: available} for the variants
+    that couldn't be reserved; when that is not empty nothing is reserved.
+    """
+    quantities = cart_quantities(cart_items)
+    expires_at = timezone.now() + (ttl or reservation_ttl())
+    with transaction.atomic():
+        variants = lock_variants(quantities.keys())
+        short = shortages(quantities, variants, reserved_quantities(quantities.keys(), exclude_cart=cart))
+        if short:
+            return short
+
+        StockReservation.objects.filter(cart=cart).delete()
+        StockReservation.objects.bulk_create([
+            StockReservation(variant_id=variant_id, cart=cart, quantity=quantity, expires_at=expires_at)
+            for variant_id, quantity in quantities.items()
+        ])
+    return {}
+
+
+def release_cart(cart):
+    """
+    Drop every reservation of the cart, e.g. after the order was created or the cart was abandoned
+    """
+    return StockReservation.objects.filter(cart=cart).delete()[0]
+
+
+def expire_reservations(now=None):
+    """
+    Delete all reservations that are past their expiry with a single DELETE and return how many were removed
+    """
+    return StockReservation.objects.filter(expires_at__lte=now or timezone.now()).delete()[0]
+
+
+def decrement_stock(quantities):
+    """
+    Take stock for every variant in one UPDATE.
+    quantities is {variant_id: quantity}. Each row is only touched if it still has enough stock
+    and is still available, so if the number of updated rows is smaller than the number of
+    variants someone else got there first and the caller has to roll back.
+    Returns the number of rows updated.
+    """
+    if not quantities:
+        return 0
+    enough_stock = Q()
+    for variant_id, quantity in quantities.items():
+        enough_stock |= Q(pk=variant_id, stock_quantity__gte=quantity)
+
+    return ProductVariant.objects.filter(enough_stock, is_available=True).update(
+        stock_quantity=Case(
+            *[When(pk=variant_id, then=F('stock_quantity') - quantity)
+              for variant_id, quantity in quantities.items()],
+            default=F('stock_quantity'),
+            output_field=PositiveIntegerField(),
+        )
+    )
+
+
+def restock(quantities):
+    """
+    Put stock back for every variant in one UPDATE, e.g. for cancelled orders.
+    quantities is {variant_id: quantity}. Returns the number of rows updated
+    """
+    if not quantities:
+        return 0
+    return ProductVariant.objects.filter(pk__in=quantities.keys()).update(
+        stock_quantity=Case(
+            *[When(pk=variant_id, then=F('stock_quantity') + quantity)
+              for variant_id, quantity in quantities.items()],
+            default=F('stock_quantity'),
+            output_field=PositiveIntegerField(),
+        )
+    )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api.analytics import backfill
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the daily sales rollups from every order, a chunk of orders at a time. "
+            "Orders that change while it runs can be counted twice, so run it when the shop is quiet")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Orders per chunk, each chunk is one transaction")
+
+    def handle(self, *args, **options):
+        total = backfill(chunk_size=options['chunk_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {total} orders"))
@@ -0,0 +1,59 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment, setup_databases, teardown_databases
+from api import benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Seed a throwaway test database and replay a request mix against checkout, cart, catalog and orders, "
+            "reporting throughput, p50/p95/p99 latency and query counts per endpoint")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=benchmarks.DEFAULT_VOLUMES['products'])
+        parser.add_argument('--categories', type=int, default=benchmarks.DEFAULT_VOLUMES['categories'])
+        parser.add_argument('--users', type=int, default=benchmarks.DEFAULT_VOLUMES['users'])
+        parser.add_argument('--orders', type=int, default=benchmarks.DEFAULT_VOLUMES['orders'])
+        parser.add_argument('--requests', type=int, default=500, help="Number of requests to replay")
+        parser.add_argument('--concurrency', type=int, default=1, help="Threads sending requests at the same time")
+        parser.add_argument('--mix', help='Request mix as JSON, e.g. \'{"catalog": 80, "checkout": 20}\'')
+        parser.add_argument('--save-baseline', metavar='PATH', help="Store the report as a baseline")
+        parser.add_argument('--baseline', metavar='PATH', help="Compare with a stored baseline and fail on regressions")
+        parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed p95 slowdown against the baseline (0.2 = 20%%)")
+
+    def handle(self, *args, **options):
+        mix = json.loads(options['mix']) if options['mix'] else None
+        unknown = set(mix or {}) - set(benchmarks.DEFAULT_MIX)
+        if unknown:
+            raise CommandError(f"Unknown endpoints in mix: {', '.join(sorted(unknown))}")
+
+        # never touch the real database, everything happens in a test database that is dropped afterwards
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            benchmarks.seed({name: options[name] for name in benchmarks.DEFAULT_VOLUMES})
+            report = benchmarks.run(mix, requests=options['requests'], concurrency=options['concurrency'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.print_report(report)
+        if options['save_baseline']:
+            benchmarks.save_baseline(report, options['save_baseline'])
+            self.stdout.write(f"Baseline saved to {options['save_baseline']}")
+        if options['baseline']:
+            regressions = benchmarks.compare(report, benchmarks.load_baseline(options['baseline']), options['tolerance'])
+            if regressions:
+                raise CommandError("Regressions against baseline:\n  " + "\n  ".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline"))
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['requests']} requests, concurrency {report['concurrency']}, "
+            f"{report['wall_seconds']}s, {report['throughput_rps']} req/s"
+        )
+        self.stdout.write(f"{'endpoint':<16}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+        for name, stats in report['endpoints'].items():
+            self.stdout.write(
+                f"{name:<16}{stats['count']:>7}{stats['errors']:>8}{stats['p50_ms']:>10}"
+                f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['avg_queries']:>9}"
+            )
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment, teardown_test_environment, setup_databases, teardown_databases
+from api import benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Compare payment confirmation throughput of the sync view under WSGI with the async view under ASGI, "
+            "against a local payment gateway stub that answers slowly")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=400, help="Confirmations to send to each server")
+        parser.add_argument('--threads', type=int, default=8, help="WSGI worker threads")
+        parser.add_argument('--concurrency', type=int, default=200, help="Requests in flight at once on the ASGI event loop")
+        parser.add_argument('--gateway-delay-ms', type=int, default=200, help="How long the gateway stub takes per call")
+        parser.add_argument('--payments', type=int, default=50, help="Users with a pending payment to confirm")
+
+    def handle(self, *args, **options):
+        # never touch the real database, everything happens in a test database that is dropped afterwards
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            reports = benchmarks.compare_servers(
+                requests=options['requests'],
+                threads=options['threads'],
+                concurrency=options['concurrency'],
+                gateway_delay=options['gateway_delay_ms'] / 1000,
+                payments=options['payments'],
+            )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"Gateway stub answers in {options['gateway_delay_ms']}ms")
+        self.stdout.write(f"{'server':<28}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for report in reports:
+            self.stdout.write(
+                f"{report['server']:<28}{report['requests']:>9}{report['errors']:>8}"
+                f"{report['throughput_rps']:>10}{report['p50_ms']:>10}{report['p95_ms']:>10}"
+            )
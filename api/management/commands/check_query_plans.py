@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from api.query_plans import HOT_QUERIES, full_scans
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN every hot query in api/query_plans.py and fail if any of them does a full table scan"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help="Print the full plan of every query")
+
+    def handle(self, *args, **options):
+        failures = []
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # on a small database Postgres prefers a seq scan even when a good index exists,
+                # turn it off for this transaction so we see whether an index *can* be used
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            for name, build_query in HOT_QUERIES.items():
+                plan = build_query().explain()
+                scanned = full_scans(plan)
+                if options['verbose_plans']:
+                    self.stdout.write(f"{name}:\n{plan}\n")
+                if scanned:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(f"FULL SCAN  {name} ({', '.join(scanned)})"))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f"ok         {name}"))
+
+        if failures:
+            raise CommandError(f"{len(failures)} hot queries do a full table scan: {', '.join(failures)}")
@@ -0,0 +1,29 @@
+import sqlite3
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.replicas import replica_aliases
+
+
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database over every SQLite replica, to try replica routing locally (SQLite doesn't replicate)"
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES['default']
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError("The primary database is not SQLite, real replicas are kept in sync by the database server")
+
+        source = sqlite3.connect(primary['NAME'])
+        try:
+            for alias in replica_aliases():
+                replica = settings.DATABASES[alias]
+                if replica['ENGINE'] != 'django.db.backends.sqlite3':
+                    continue
+                target = sqlite3.connect(replica['NAME'])
+                try:
+                    # the backup API copies a consistent snapshot even while the primary is being written to
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(self.style.SUCCESS(f"Copied {primary['NAME']} to {alias} ({replica['NAME']})"))
+        finally:
+            source.close()
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api.inventory import expire_reservations
+
+
+class Command(BaseCommand):
+    help = "Delete expired stock reservations so their stock can be sold again (run it from cron every minute or so)"
+
+    def handle(self, *args, **options):
+        removed = expire_reservations()
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} expired reservations"))
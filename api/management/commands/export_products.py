@@ -0,0 +1,26 @@
+import sys
+from django.core.management.base import BaseCommand
+from api.exports import products_to_csv, products_to_ndjson
+from api.imports import FORMATS
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = "Write every product as CSV or newline delimited JSON, a chunk of products at a time (import_products reads it back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', help="File to write, standard output by default")
+
+    def handle(self, *args, **options):
+        rows = products_to_csv if options['format'] == 'csv' else products_to_ndjson
+        if options['output']:
+            stream = open(options['output'], 'w', encoding='utf-8', newline='')
+        else:
+            stream = sys.stdout
+        try:
+            for line in rows(Product.objects.all()):
+                stream.write(line)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
@@ -0,0 +1,32 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from api.imports import import_products, read_rows, guess_format, IMPORT_CHUNK_SIZE, FORMATS
+
+
+class Command(BaseCommand):
+    help = ("Create or update products from a CSV or newline delimited JSON file (the format export_products writes). "
+            "Products are matched by unique_code, categories by name. Bad rows are reported and skipped")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, .csv, .ndjson or .jsonl")
+        parser.add_argument('--format', choices=FORMATS, help="File format, by default from the file extension")
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help="Rows per chunk, each chunk is one transaction")
+        parser.add_argument('--create-categories', action='store_true', help="Create categories that don't exist yet instead of rejecting their rows")
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or guess_format(options['path'])
+        if file_format is None:
+            raise CommandError("Can't tell the format from the file name, pass --format csv or --format ndjson")
+
+        # utf-8-sig skips the byte order mark spreadsheet programs put in front of CSV files
+        with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+            report = import_products(read_rows(stream, file_format), chunk_size=options['chunk_size'], create_categories=options['create_categories'])
+
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {json.dumps(error['errors'])}")
+        if report['error_count'] > len(report['errors']):
+            self.stderr.write(f"... and {report['error_count'] - len(report['errors'])} more errors")
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['rows']} rows: {report['created']} products created, {report['updated']} updated, "
+            f"{report['variants_created']} variants created, {report['variants_updated']} updated, {report['error_count']} errors"
+        ))
@@ -0,0 +1,47 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.core.management.base import BaseCommand
+from api.images import drain_image_jobs
+
+
+class Command(BaseCommand):
+    help = "Make the resized WebP/JPEG renditions of uploaded product images, resizing in a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20, help="Images claimed per batch")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Resizing processes (default: one per CPU)")
+        parser.add_argument('--loop', action='store_true', help="Keep running and poll for new images instead of exiting once there are none")
+        parser.add_argument('--sleep', type=float, default=5, help="Seconds to wait between polls when there is nothing to do (with --loop)")
+
+    def handle(self, *args, **options):
+        total_done = total_failed = 0
+        pool = ProcessPoolExecutor(max_workers=options['workers'])
+        try:
+            while True:
+                try:
+                    done, failed = drain_image_jobs(options['batch_size'], pool)
+                except Exception as e:
+                    if not options['loop']:
+                        raise
+                    # e.g. the database restarting, the claimed jobs are picked up again once their lease runs out
+                    self.stderr.write(f"Processing failed: {e}")
+                    if isinstance(e, BrokenProcessPool):
+                        # a resizing process was killed (out of memory...), the pool can't be used anymore
+                        pool.shutdown(wait=False)
+                        pool = ProcessPoolExecutor(max_workers=options['workers'])
+                    time.sleep(options['sleep'])
+                    continue
+                total_done += done
+                total_failed += failed
+                if done or failed:
+                    self.stdout.write(f"Processed {done} images, {failed} failed")
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+        finally:
+            pool.shutdown()
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {total_done} processed, {total_failed} failed"))
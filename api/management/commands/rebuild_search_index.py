@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Index every product for search again, e.g. after products were bulk imported (bulk inserts skip the signals)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        indexed = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} products"))
@@ -0,0 +1,36 @@
+import time
+from django.core.management.base import BaseCommand
+from api.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = "Send queued emails (order confirmations) in batches over a single SMTP connection per batch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Emails sent per SMTP connection")
+        parser.add_argument('--loop', action='store_true', help="Keep running and poll the outbox instead of exiting once it is empty")
+        parser.add_argument('--sleep', type=float, default=5, help="Seconds to wait between polls when the outbox is empty (with --loop)")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total_sent = total_failed = 0
+        while True:
+            try:
+                sent, failed = drain_outbox(batch_size)
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                # e.g. the database restarting, the claimed jobs are picked up again once their lease runs out
+                self.stderr.write(f"Sending failed: {e}")
+                time.sleep(options['sleep'])
+                continue
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} emails, {failed} failed")
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {total_sent} sent, {total_failed} failed"))
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:55
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_cart_lines(apps, schema_editor):
+    # add_to_cart could race and create the same line twice, fold them into one before the unique constraint
+    CartItems = apps.get_model('api', 'CartItems')
+    duplicates = (CartItems.objects
+                  .values('cart_id', 'product_id', 'size', 'color')
+                  .annotate(lines=Count('id'), keep=Min('id'), total=Sum('quantity'))
+                  .filter(lines__gt=1))
+    for line in duplicates:
+        same_line = CartItems.objects.filter(cart_id=line['cart_id'], product_id=line['product_id'], size=line['size'], color=line['color'])
+        same_line.filter(id=line['keep']).update(quantity=line['total'])
+        same_line.exclude(id=line['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_emailjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_lines, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', '-order_date'], name='order_customer_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['order_date'], name='order_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['stripe_payment_intent_id'], name='payment_intent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_available', True)), fields=['category', 'price'], name='product_available_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_available', '-created_at'], name='product_available_new_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitems',
+            constraint=models.UniqueConstraint(fields=('cart', 'product', 'size', 'color'), name='unique_cart_line'),
+        ),
+    ]
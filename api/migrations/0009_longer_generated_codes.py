@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:56
+
+import api.ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='cart_number',
+            field=models.CharField(default=api.ids.generate_code, max_length=12, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(default=api.ids.generate_code, max_length=12, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='unique_code',
+            field=models.CharField(default=api.ids.generate_code, max_length=12, unique=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:02
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, F, OuterRef, PositiveIntegerField, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('api', 'Cart')
+    CartItems = apps.get_model('api', 'CartItems')
+    items = CartItems.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    money = DecimalField(max_digits=12, decimal_places=2)
+    Cart.objects.update(
+        line_count=Coalesce(Subquery(items.annotate(total=Count('id')).values('total')), Value(0), output_field=PositiveIntegerField()),
+        item_count=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')), Value(0), output_field=PositiveIntegerField()),
+        subtotal=Coalesce(Subquery(items.annotate(total=Sum(F('quantity') * F('product__price'), output_field=money)).values('total')), Value(Decimal('0')), output_field=money),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_stripe_webhooks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='line_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_cart_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:05
+
+import api.ids
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_cart_totals'),
+    ]
+
+    operations = [
+        # lines are merged per variant in 0013, the constraint comes back on (cart, variant) in 0014
+        migrations.RemoveConstraint(
+            model_name='cartitems',
+            name='unique_cart_line',
+        ),
+        migrations.CreateModel(
+            name='ProductVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sku', models.CharField(default=api.ids.generate_code, max_length=12, unique=True)),
+                ('size', models.CharField(choices=[('small', 'S'), ('medium', 'M'), ('large', 'L'), ('extra-large', 'XL')], max_length=20)),
+                ('color', models.CharField(blank=True, max_length=50)),
+                ('stock_quantity', models.PositiveIntegerField(default=0)),
+                ('is_available', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='api.product')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cartitems',
+            name='variant',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='api.productvariant'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='variant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.productvariant'),
+        ),
+        migrations.AddField(
+            model_name='stockreservation',
+            name='variant',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='api.productvariant'),
+        ),
+        migrations.AddConstraint(
+            model_name='productvariant',
+            constraint=models.UniqueConstraint(fields=('product', 'size', 'color'), name='unique_product_variant'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:06
+
+from django.db import migrations
+from django.db.models import Count, F, Min, Sum
+
+
+def group_products_into_variants(apps, schema_editor):
+    # Every size/color of a garment used to be its own Product. Products with the same name, category
+    # and price become variants of the oldest one; the other products are removed.
+    # Each variant's sku is the old product's unique_code, so codes customers already have keep working
+    Product = apps.get_model('api', 'Product')
+    ProductVariant = apps.get_model('api', 'ProductVariant')
+    CartItems = apps.get_model('api', 'CartItems')
+    OrderItem = apps.get_model('api', 'OrderItem')
+    StockReservation = apps.get_model('api', 'StockReservation')
+    Cart = apps.get_model('api', 'Cart')
+
+    # reservations are only held for a few minutes, carts reserve again at checkout
+    StockReservation.objects.all().delete()
+
+    # (name, category, price) -> groups of products, a group never has the same size and color twice
+    groups = {}
+    primary_of = {}
+    variant_of = {}
+    for product in Product.objects.order_by('id').iterator(chunk_size=1000):
+        key = (product.size, product.color or '')
+        same_garment = groups.setdefault((product.name, product.category_id, product.price), [])
+        group = next((group for group in same_garment if key not in group['variants']), None)
+        if group is None:
+            group = {'primary': product.id, 'variants': set()}
+            same_garment.append(group)
+        group['variants'].add(key)
+        primary_of[product.id] = group['primary']
+        variant_of[product.id] = ProductVariant(
+            product_id=group['primary'], sku=product.unique_code, size=product.size, color=product.color or '',
+            stock_quantity=product.stock_quantity, is_available=product.is_available,
+        )
+    ProductVariant.objects.bulk_create(variant_of.values(), batch_size=1000)
+    ids = dict(ProductVariant.objects.values_list('sku', 'id'))
+    for variant in variant_of.values():
+        variant.id = ids[variant.sku]
+
+    # point cart and order lines at the variant they were for and at the grouped product.
+    # Cart lines take size and color from their variant (they were free text before)
+    lines = list(CartItems.objects.only('id', 'product_id'))
+    for line in lines:
+        variant = variant_of[line.product_id]
+        line.product_id, line.variant_id, line.size, line.color = primary_of[line.product_id], variant.id, variant.size, variant.color
+    CartItems.objects.bulk_update(lines, ['product_id', 'variant_id', 'size', 'color'], batch_size=1000)
+    lines = list(OrderItem.objects.only('id', 'product_id'))
+    for line in lines:
+        line.product_id, line.variant_id = primary_of[line.product_id], variant_of[line.product_id].id
+    OrderItem.objects.bulk_update(lines, ['product_id', 'variant_id'], batch_size=1000)
+
+    # two lines of the same cart can now be for the same variant, fold them into one
+    duplicates = (CartItems.objects
+                  .values('cart_id', 'variant_id')
+                  .annotate(lines=Count('id'), keep=Min('id'), total=Sum('quantity'))
+                  .filter(lines__gt=1))
+    for line in duplicates:
+        same_line = CartItems.objects.filter(cart_id=line['cart_id'], variant_id=line['variant_id'])
+        same_line.filter(id=line['keep']).update(quantity=line['total'])
+        same_line.exclude(id=line['keep']).delete()
+        Cart.objects.filter(id=line['cart_id']).update(line_count=F('line_count') - (line['lines'] - 1))
+
+    Product.objects.exclude(id__in=set(primary_of.values())).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_productvariant'),
+    ]
+
+    operations = [
+        migrations.RunPython(group_products_into_variants, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_group_product_variants'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='stockreservation',
+            name='unique_reservation_per_cart_product',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='color',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='size',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='stock_quantity',
+        ),
+        migrations.RemoveField(
+            model_name='stockreservation',
+            name='product',
+        ),
+        migrations.AlterField(
+            model_name='cartitems',
+            name='variant',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.productvariant'),
+        ),
+        migrations.AlterField(
+            model_name='stockreservation',
+            name='variant',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='api.productvariant'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitems',
+            constraint=models.UniqueConstraint(fields=('cart', 'variant'), name='unique_cart_line'),
+        ),
+        migrations.AddConstraint(
+            model_name='stockreservation',
+            constraint=models.UniqueConstraint(fields=('variant', 'cart'), name='unique_reservation_per_cart_variant'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:30
+
+from django.db import migrations
+
+# The index is a plain table per database, not a model. This is a copy of the SQL api/search.py used when the
+# migration was written, so later changes to api/search.py can't change what this migration does.
+# `python manage.py rebuild_search_index` fills the index with the current code.
+SEARCH_TABLE = 'api_product_search'
+BATCH_SIZE = 1000
+
+CREATE = {
+    'sqlite': [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "name, category, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    ],
+    'postgresql': [
+        f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+        "product_id bigint PRIMARY KEY REFERENCES api_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+        "document tsvector NOT NULL)",
+        f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING GIN (document)",
+    ],
+}
+INSERT = {
+    'sqlite': f"INSERT INTO {SEARCH_TABLE} (rowid, name, category, description) VALUES (%s, %s, %s, %s)",
+    'postgresql': (
+        f"INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (%s, "
+        "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+        "setweight(to_tsvector('simple', %s), 'C')) ON CONFLICT (product_id) DO NOTHING"
+    ),
+}
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in CREATE:
+        # other databases search without an index
+        return
+    Product = apps.get_model('api', 'Product')
+    rows = Product.objects.order_by('id').values_list('id', 'name', 'category__name', 'description')
+    with schema_editor.connection.cursor() as cursor:
+        for statement in CREATE[vendor]:
+            cursor.execute(statement)
+        # one batch of products in memory at a time
+        batch = []
+        for product_id, name, category, description in rows.iterator(chunk_size=BATCH_SIZE):
+            batch.append((product_id, name, category or '', description))
+            if len(batch) == BATCH_SIZE:
+                cursor.executemany(INSERT[vendor], batch)
+                batch = []
+        if batch:
+            cursor.executemany(INSERT[vendor], batch)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in CREATE:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_variant_stock'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,13 +1,16 @@
 from django.db import models
 from django.contrib.auth import get_user_model
-from .utils import generate_random_code
+from .ids import generate_code
 from django.core.validators import FileExtensionValidator
+from django.utils import timezone
 # Create your models here.
 User = get_user_model()
 
 class Category(models.Model):
     name = models.CharField(max_length=100, null=False)
     description = models.TextField(blank=True)
+    # part of the ETag of categories and of the products in them (api/conditional.py)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -23,19 +26,44 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True)
-    size = models.CharField(choices=SIZE_CHOICES)
-    color = models.CharField(null=True, blank=False)
-    stock_quantity = models.PositiveIntegerField()
+    # sizes, colors and stock are per variant, see ProductVariant
     is_available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    # if you use generate_random_code(), it would call the function once when the model is loaded and use the same value for every new instance
-    unique_code = models.CharField(default=generate_random_code, unique=True, max_length=6)
+    # if you use generate_code(), it would call the function once when the model is loaded and use the same value for every new instance
+    # old 6 character codes are kept as they are, new ones are 12 characters (see api/ids.py)
+    unique_code = models.CharField(default=generate_code, unique=True, max_length=12)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # the shop only lists available products, so the index only holds those rows
+            models.Index(fields=['category', 'price'], condition=models.Q(is_available=True), name='product_available_cat_idx'),
+            models.Index(fields=['is_available', '-created_at'], name='product_available_new_idx'),
+        ]
+
     def __str__(self):
         return f'{self.category}: {self.name}'
 
+class ProductVariant(models.Model):
+    # One size/color of a product (a SKU). Stock is kept per variant, so a stock check is a single row
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='variants')
+    sku = models.CharField(default=generate_code, unique=True, max_length=12)
+    size = models.CharField(max_length=20, choices=Product.SIZE_CHOICES)
+    color = models.CharField(max_length=50, blank=True)
+    stock_quantity = models.PositiveIntegerField(default=0)
+    is_available = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'size', 'color'], name='unique_product_variant'),
+        ]
+
+    def __str__(self):
+        return f'{self.product.name} ({self.size}, {self.color})'
+
 class Order(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -58,7 +86,7 @@ class Order(models.Model):
         ('connectips', 'ConnectIPS'),
     )
     customer = models.ForeignKey(User, on_delete=models.CASCADE)
-    order_number = models.CharField(default=generate_random_code, unique=True, max_length=6)
+    order_number = models.CharField(default=generate_code, unique=True, max_length=12)
     order_date = models.DateTimeField(auto_now_add=True)
     status = models.CharField(choices=STATUS_CHOICES)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
@@ -66,38 +94,62 @@ class Order(models.Model):
     payment_status = models.CharField(choices=PAYMENT_CHOICES)
     payment_method = models.CharField(choices=PAYMENT_METHOD)
 
+    class Meta:
+        indexes = [
+            # listing a user's orders, newest first
+            models.Index(fields=['customer', '-order_date'], name='order_customer_date_idx'),
+            models.Index(fields=['order_date'], name='order_date_idx'),
+            # the admin's status filter, newest first
+            models.Index(fields=['status', '-order_date'], name='order_status_date_idx'),
+        ]
+
     def __str__(self):
-        return f"Order #{self.order_number} by {self.customer.username}"
+        # only this row's columns, showing orders in lists (the admin, logs) must not query the customer of each one
+        return f"Order #{self.order_number} by user {self.customer_id}"
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # the variant that was sold, size/color below are kept as they were at purchase time
+    variant = models.ForeignKey(ProductVariant, on_delete=models.SET_NULL, null=True, blank=True)
     quantity = models.PositiveIntegerField()
     price_at_purchase = models.DecimalField(max_digits=10, decimal_places=2)
     size = models.CharField(max_length=20)
     color = models.CharField(max_length=50)
 
     def __str__(self):
-        return f"{self.quantity} x {self.product.name} in Order #{self.order.order_number}"
+        return f"{self.quantity} x product {self.product_id} in order {self.order_id}"
 
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    cart_number = models.CharField(default=generate_random_code, unique=True, max_length=6)
+    cart_number = models.CharField(default=generate_code, unique=True, max_length=12)
+    # kept up to date by api/carts.py when items are added or removed, so showing the cart badge needs no aggregation
+    line_count = models.PositiveIntegerField(default=0)
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
 
     def __str__(self):
-        return f'Cart number: {self.cart_number} of User: {self.user}'
+        return f'Cart number: {self.cart_number} of User: {self.user_id}'
 
 class CartItems(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='cart_items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    # copied from the variant so cart pages don't need to join it
     size = models.CharField(max_length=20)
     color = models.CharField(max_length=50)
 
+    class Meta:
+        constraints = [
+            # one line per product variant in a cart, add_to_cart merges quantities into it
+            models.UniqueConstraint(fields=['cart', 'variant'], name='unique_cart_line'),
+        ]
+
     def __str__(self):
-        return f' {self.product} of {self.cart}'
+        return f'{self.quantity} x variant {self.variant_id} in cart {self.cart_id}'
     
 class Payment(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
@@ -105,6 +157,166 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
+    # sent to Stripe with the create call, a retried create for the same order and amount reuses this payment
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    client_secret = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['stripe_payment_intent_id'], name='payment_intent_idx'),
+        ]
+
+    def __str__(self):
+        return f'Payment of Order:{self.order_id} Amount:{self.amount} and ID:{self.stripe_payment_intent_id}'
+
+class StockReservation(models.Model):
+    # Stock held for a cart while it goes through checkout, so two carts can't both be promised the last piece
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, related_name='reservations')
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['variant', 'cart'], name='unique_reservation_per_cart_variant'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.variant_id} held for cart {self.cart_id} until {self.expires_at}'
+
+
+class EmailJob(models.Model):
+    # Outbox of emails waiting to be sent by the send_queued_emails worker, so checkout never waits on SMTP
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+    KIND_CHOICES = (
+        ('order_confirmation', 'Order confirmation'),
+    )
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='email_jobs')
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES, default='order_confirmation')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # the worker only picks up jobs whose next_attempt_at has passed, this is how retries back off
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='emailjob_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} email for Order #{self.order_id} ({self.status})'
+
+
+
+class ImageRendition(models.Model):
+    # A resized copy of Product.image made by the process_images worker. Files are named after a hash of
+    # their content so they never change and can be cached forever
+    FORMAT_CHOICES = (
+        ('webp', 'WebP'),
+        ('jpeg', 'JPEG'),
+    )
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='renditions')
+    # the Product.image name it was made from, renditions of a replaced image are not shown
+    source = models.CharField(max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    file = models.FileField(upload_to='products/renditions/', max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'width', 'format'], name='unique_product_rendition'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} {self.width}px {self.format}'
+
+
+class ImageJob(models.Model):
+    # Queue of uploaded product images waiting for their renditions, so uploads never wait on resizing
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='image_jobs')
+    source = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='imagejob_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'Renditions of {self.source} ({self.status})'
+
+
+class StripeEvent(models.Model):
+    # Every webhook event we received, the unique event_id is what makes Stripe's retries harmless
+    event_id = models.CharField(max_length=100, unique=True)
+    type = models.CharField(max_length=100)
+    payment_intent_id = models.CharField(max_length=100, blank=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.type} ({self.event_id})'
+
+class DailySales(models.Model):
+    # Orders and revenue per day, payment method and payment status, kept up to date by api/analytics.py
+    # so dashboards never have to scan the orders
+    day = models.DateField()
+    payment_method = models.CharField(max_length=20)
+    payment_status = models.CharField(max_length=20)
+    orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'payment_method', 'payment_status'], name='unique_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.payment_method}/{self.payment_status}: {self.orders} orders'
+
+
+class DailyProductSales(models.Model):
+    # Revenue, units and orders per day, product, payment method and payment status (api/analytics.py).
+    # category is the product's category at its latest sale that day
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_sales')
+    payment_method = models.CharField(max_length=20)
+    payment_status = models.CharField(max_length=20)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product', 'payment_method', 'payment_status'], name='unique_daily_product_sales'),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'category'], name='dailyproductsales_category_idx'),
+        ]
 
     def __str__(self):
-        return f'Payment of Order:{self.order} Amount:{self.amount} and ID:{self.stripe_payment_intent_id}'
\ No newline at end of file
+        return f'{self.day} product {self.product_id} {self.payment_method}/{self.payment_status}: {self.units} units'
@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models import Sum
+from .models import Order, OrderItem
+from . import inventory
+from .catalog import bump_catalog_version
+
+# Bulk order changes for staff (the actions in api/admin.py). Each one is a few set-based
+# UPDATEs however many orders are selected, never a save() per order.
+# Only the order status changes, so the sales rollups (keyed by payment status) stay as they are.
+
+SHIPPABLE_STATUSES = ['pending', 'processing']
+CANCELLABLE_STATUSES = ['pending', 'processing']
+# orders cancelled per transaction, keeps the IN lists and the locks small when thousands are selected
+CANCEL_CHUNK_SIZE = 500
+
+
+def mark_shipped(orders):
+    """
+    Move the pending and processing orders of a queryset to shipped with one UPDATE.
+    Returns how many orders changed
+    """
+    return orders.filter(status__in=SHIPPABLE_STATUSES).update(status='shipped')
+
+
+def cancel_and_restock(orders, chunk_size=CANCEL_CHUNK_SIZE):
+    """
+    Cancel the pending and processing orders of a queryset and put their items back in stock.
+    Works through the orders chunk_size at a time: lock the chunk, one UPDATE for the orders,
+    one query for the quantities per variant and one UPDATE for the stock.
+    Orders that are already shipped, delivered or cancelled are skipped, so running it twice restocks nothing.
+    Returns how many orders were cancelled
+    """
+    cancelled = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            # locked in primary key order, like the variants in checkout
+            order_ids = list(orders.filter(pk__gt=last_id, status__in=CANCELLABLE_STATUSES)
+                             .select_for_update(of=('self',)).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not order_ids:
+                break
+            Order.objects.filter(pk__in=order_ids).update(status='cancelled')
+            # lines whose variant was deleted have nothing to go back to
+            quantities = dict(OrderItem.objects.filter(order_id__in=order_ids, variant__isnull=False)
+                              .order_by().values('variant_id').annotate(total=Sum('quantity'))
+                              .values_list('variant_id', 'total'))
+            inventory.restock(quantities)
+            # update() doesn't send save signals, refresh the cached catalog once the stock is back
+            if quantities:
+                transaction.on_commit(bump_catalog_version)
+        cancelled += len(order_ids)
+        last_id = order_ids[-1]
+    return cancelled
@@ -0,0 +1,119 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from .models import EmailJob, OrderItem
+from .utils import build_order_confirmation_email, get_order_link
+
+# retry after 1, 2, 4, 8 ... minutes, capped at an hour
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 60 * 60
+# a job claimed by a worker that died is picked up again after this long
+CLAIM_LEASE_SECONDS = 5 * 60
+
+
+def queue_order_confirmation(order):
+    """
+    Record an order confirmation email in the outbox.
+    Called inside the checkout transaction so the job is saved together with the order (or not at all)
+    """
+    return EmailJob.objects.create(order=order, kind='order_confirmation')
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+def claim_jobs(batch_size):
+    """
+    Claim up to batch_size due jobs for this worker and return them with everything needed to render the emails.
+    Claimed rows are moved to 'sending' with a lease, so several workers can drain the outbox side by side
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = (EmailJob.objects
+               .select_for_update(skip_locked=True)
+               .filter(status__in=['pending', 'sending'], next_attempt_at__lte=now)
+               .order_by('next_attempt_at')
+               .values_list('id', flat=True)[:batch_size])
+        ids = list(due)
+        EmailJob.objects.filter(id__in=ids).update(
+            status='sending',
+            next_attempt_at=now + timedelta(seconds=CLAIM_LEASE_SECONDS),
+        )
+
+    items = OrderItem.objects.select_related('product')
+    return list(EmailJob.objects
+                .filter(id__in=ids)
+                .select_related('order__customer')
+                .prefetch_related(Prefetch('order__items', queryset=items)))
+
+
+def record_failure(job, error, now):
+    """
+    Count a failed attempt: try again later with exponential backoff, or give up after EMAIL_MAX_ATTEMPTS
+    """
+    job.attempts += 1
+    job.last_error = str(error)
+    if job.attempts >= getattr(settings, 'EMAIL_MAX_ATTEMPTS', 5):
+        job.status = 'failed'
+    else:
+        job.status = 'pending'
+        job.next_attempt_at = now + retry_delay(job.attempts)
+
+
+def send_jobs(jobs, connection=None):
+    """
+    Send the claimed jobs over one SMTP connection and record the outcome of each job with a single bulk update.
+    Failed jobs are rescheduled with exponential backoff until EMAIL_MAX_ATTEMPTS, then marked failed.
+    When the SMTP server can't be reached every job counts as failed, so they back off too.
+    Returns (sent, failed) counts.
+    """
+    if not jobs:
+        return 0, 0
+    connection = connection or get_connection()
+    sent = failed = 0
+    now = timezone.now()
+
+    # open the connection once for the whole batch instead of once per email
+    try:
+        connection.open()
+    except Exception as e:
+        for job in jobs:
+            record_failure(job, e, now)
+        EmailJob.objects.bulk_update(jobs, ['status', 'attempts', 'next_attempt_at', 'last_error'])
+        return 0, len(jobs)
+
+    try:
+        for job in jobs:
+            try:
+                email = build_order_confirmation_email(job.order, get_order_link(job.order))
+                email.connection = connection
+                email.send()
+            except Exception as e:
+                failed += 1
+                record_failure(job, e, now)
+            else:
+                job.attempts += 1
+                sent += 1
+                job.status = 'sent'
+                job.sent_at = timezone.now()
+                job.last_error = ''
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            # the emails are out, a failed QUIT must not stop them being recorded as sent
+            pass
+
+    EmailJob.objects.bulk_update(jobs, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return sent, failed
+
+
+def drain_outbox(batch_size=100):
+    """
+    Send one batch from the outbox. Returns (sent, failed)
+    """
+    return send_jobs(claim_jobs(batch_size))
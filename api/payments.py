@@ -0,0 +1,121 @@
+import json
+import stripe
+from django.db import transaction
+from django.utils import timezone
+from .models import Payment, Order, StripeEvent
+from . import analytics
+
+# what each payment_intent event means for the Payment and the Order:
+# (payment status, order payment_status, order status or None to leave it alone)
+PAYMENT_TRANSITIONS = {
+    'payment_intent.processing': ('processing', 'processing', None),
+    'payment_intent.payment_failed': ('failed', 'pending', None),
+    'payment_intent.canceled': ('cancelled', 'cancelled', None),
+    'payment_intent.succeeded': ('completed', 'paid', 'processing'),
+}
+# Stripe doesn't promise to deliver events in order, so when several events arrive for the same intent
+# the one furthest along wins, and a payment that is completed or cancelled never moves again
+EVENT_RANK = {event_type: rank for rank, event_type in enumerate(PAYMENT_TRANSITIONS)}
+FINAL_PAYMENT_STATUSES = ['completed', 'cancelled']
+# payments that can't be paid any more, paying the order again takes a new intent
+DEAD_PAYMENT_STATUSES = ['failed', 'cancelled']
+
+
+def record_events(events):
+    """
+    Save webhook events (parsed JSON dicts). Events we have already seen are skipped,
+    so Stripe resending an event is harmless. Returns how many events were new
+    """
+    event_ids = [event['id'] for event in events]
+    known = set(StripeEvent.objects.filter(event_id__in=event_ids).values_list('event_id', flat=True))
+    new_events = [
+        StripeEvent(
+            event_id=event['id'],
+            type=event['type'],
+            payment_intent_id=event.get('data', {}).get('object', {}).get('id', '') if event['type'].startswith('payment_intent.') else '',
+            payload=event,
+        )
+        for event in events if event['id'] not in known
+    ]
+    # ignore_conflicts covers the same event arriving twice at the same moment
+    StripeEvent.objects.bulk_create(new_events, ignore_conflicts=True)
+    return len(new_events)
+
+
+def apply_transitions(target):
+    """
+    Move payments and their orders to the state of an event type, target is {payment_intent_id: event_type}.
+    Runs one UPDATE for payments and one for orders per event type, payments that are already
+    completed or cancelled are left alone so replaying an old event changes nothing
+    """
+    intents_by_type = {}
+    for intent_id, event_type in target.items():
+        if event_type in PAYMENT_TRANSITIONS:
+            intents_by_type.setdefault(event_type, []).append(intent_id)
+
+    for event_type, intent_ids in intents_by_type.items():
+        payment_status, order_payment_status, order_status = PAYMENT_TRANSITIONS[event_type]
+        payments = Payment.objects.filter(stripe_payment_intent_id__in=intent_ids).exclude(status__in=FINAL_PAYMENT_STATUSES)
+        order_ids = list(payments.values_list('order_id', flat=True))
+        payments.update(status=payment_status)
+
+        order_changes = {'payment_status': order_payment_status}
+        if order_status:
+            order_changes['status'] = order_status
+        # update() skips signals, move the orders to their new payment status in the sales rollups ourselves
+        with analytics.order_changes(order_ids):
+            Order.objects.filter(id__in=order_ids).exclude(payment_status='paid').update(**order_changes)
+
+
+def process_pending_events():
+    """
+    Apply every unprocessed payment_intent event with one UPDATE per target state for payments
+    and one for orders, then mark the events processed. Safe to run again, returns how many events were handled
+    """
+    with transaction.atomic():
+        events = list(StripeEvent.objects
+                      .select_for_update(skip_locked=True)
+                      .filter(processed_at__isnull=True)
+                      .order_by('id'))
+        if not events:
+            return 0
+
+        # keep only the strongest event per payment intent
+        target = {}
+        for event in events:
+            if event.type not in PAYMENT_TRANSITIONS or not event.payment_intent_id:
+                continue
+            current = target.get(event.payment_intent_id)
+            if current is None or EVENT_RANK[event.type] > EVENT_RANK[current]:
+                target[event.payment_intent_id] = event.type
+
+        apply_transitions(target)
+        StripeEvent.objects.filter(id__in=[event.id for event in events]).update(processed_at=timezone.now())
+    return len(events)
+
+
+def parse_webhook(payload, signature, secret):
+    """
+    Check the Stripe-Signature header and return the event as a dict.
+    Raises ValueError for a bad payload and stripe.error.SignatureVerificationError for a bad signature
+    """
+    stripe.Webhook.construct_event(payload, signature, secret)
+    return json.loads(payload)
+
+
+def payment_attempt(order):
+    """
+    1 for the first try at paying the order, one more for every payment of it that failed or was cancelled
+    """
+    return Payment.objects.filter(order=order, status__in=DEAD_PAYMENT_STATUSES).count() + 1
+
+
+async def apayment_attempt(order):
+    return await Payment.objects.filter(order=order, status__in=DEAD_PAYMENT_STATUSES).acount() + 1
+
+
+def idempotency_key(order, attempt=1):
+    # the same order with the same amount is the same payment, a new amount needs a new intent,
+    # and so does a new attempt after the last payment failed or was cancelled
+    key = f'order-{order.id}-{int(order.total_amount * 100)}'
+    return key if attempt == 1 else f'{key}-{attempt}'
@@ -0,0 +1,9 @@
+from rest_framework.permissions import BasePermission, SAFE_METHODS
+
+
+class IsStaffOrReadOnly(BasePermission):
+    """
+    Anyone can read, only staff users can create, change or delete
+    """
+    def has_permission(self, request, view):
+        return request.method in SAFE_METHODS or bool(request.user and request.user.is_staff)
@@ -0,0 +1,39 @@
+import re
+from django.db.models import Q
+from django.utils import timezone
+from .models import Product, ProductVariant, Order, OrderItem, Payment, CartItems, StockReservation, EmailJob, DailySales, DailyProductSales
+
+# The queries the API runs on every request/checkout. check_query_plans runs EXPLAIN on each one
+# and fails when any of them reads a whole table. Add new hot queries here when you add an endpoint.
+# The values don't need to exist, only the shape of the query matters.
+HOT_QUERIES = {
+    'cart line lookup (add_to_cart)': lambda: CartItems.objects.filter(cart_id=1, variant_id=1),
+    'user orders newest first (orders list)': lambda: Order.objects.filter(customer_id=1).order_by('-order_date'),
+    'orders by status newest first (admin)': lambda: Order.objects.filter(status='pending').order_by('-order_date'),
+    'payment by stripe intent': lambda: Payment.objects.filter(stripe_payment_intent_id='pi_123'),
+    'available products in category (catalog)': lambda: Product.objects.filter(category_id=1, is_available=True).order_by('price'),
+    'variant by sku or product code (add_to_cart)': lambda: ProductVariant.objects.filter(Q(sku__in=['ABC123']) | Q(product__in=Product.objects.filter(unique_code__in=['ABC123']))),
+    'variants of a product (variant matrix)': lambda: ProductVariant.objects.filter(product_id=1).order_by('id'),
+    'active reservations of variants (checkout)': lambda: StockReservation.objects.filter(variant_id__in=[1, 2], expires_at__gt=timezone.now()),
+    'due email jobs (send_queued_emails)': lambda: EmailJob.objects.filter(status='pending', next_attempt_at__lte=timezone.now()),
+    'items of orders (sales rollups)': lambda: OrderItem.objects.filter(order_id__in=[1, 2]).values('product_id', 'order__payment_status'),
+    'daily sales in a date range (analytics)': lambda: DailySales.objects.filter(day__gte='2025-01-01', day__lte='2025-01-31'),
+    'product sales in a date range (analytics)': lambda: DailyProductSales.objects.filter(day__gte='2025-01-01', day__lte='2025-01-31'),
+}
+
+# SQLite prints "SCAN api_order" for a full table scan and "SCAN api_order USING INDEX ..." for an index scan,
+# PostgreSQL prints "Seq Scan on api_order"
+FULL_SCAN_PATTERNS = [
+    re.compile(r'\bSCAN (?P<table>\w+)(?! USING (?:COVERING )?INDEX)\s*$', re.MULTILINE),
+    re.compile(r'Seq Scan on (?P<table>\w+)'),
+]
+
+
+def full_scans(plan):
+    """
+    Return the tables that a query plan (the text from QuerySet.explain()) reads in full
+    """
+    tables = []
+    for pattern in FULL_SCAN_PATTERNS:
+        tables += [match.group('table') for match in pattern.finditer(plan)]
+    return tables
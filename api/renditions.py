@@ -0,0 +1,52 @@
+from io import BytesIO
+from PIL import Image, ImageOps, ExifTags
+
+# Pure Pillow code for api/images.py. It doesn't import Django, so the worker pool processes
+# can run it without setting Django up
+
+DEFAULT_WIDTHS = [160, 320, 640, 1280]
+DEFAULT_FORMATS = ['webp', 'jpeg']
+DEFAULT_QUALITY = 80
+
+PIL_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def rendition_widths(original_width, widths):
+    # never upscale, an image smaller than every width gets one rendition at its own size
+    return [width for width in widths if width <= original_width] or [original_width]
+
+
+def render(data, widths=DEFAULT_WIDTHS, formats=DEFAULT_FORMATS, quality=DEFAULT_QUALITY):
+    """
+    Resize an image (the bytes of the original file) to every width in every format.
+    Returns a list of (width, height, format, bytes)
+    """
+    image = Image.open(BytesIO(data))
+    # phones store portrait photos sideways with an EXIF orientation of 5-8 (a quarter turn),
+    # the width people see is then the stored height
+    rotated = image.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8)
+    shown_width, shown_height = (image.height, image.width) if rotated else image.size
+    widths = sorted(rendition_widths(shown_width, widths), reverse=True)
+    # let the JPEG decoder scale down while reading, much faster than decoding a 6000px photo in full.
+    # The draft size is in stored pixels, turned like the file is
+    draft_size = (widths[0], max(1, shown_height * widths[0] // shown_width))
+    image.draft('RGB', draft_size[::-1] if rotated else draft_size)
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    renditions = []
+    # biggest first, every smaller size is made from the previous one
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+        for format in formats:
+            output = image
+            if format == 'jpeg' and has_alpha:
+                # JPEG has no transparency, put the image on white
+                output = Image.new('RGB', image.size, 'white')
+                output.paste(image, mask=image.getchannel('A'))
+            buffer = BytesIO()
+            output.save(buffer, PIL_FORMATS[format], quality=quality, optimize=True)
+            renditions.append((width, height, format, buffer.getvalue()))
+    return renditions
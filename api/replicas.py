@@ -0,0 +1,151 @@
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+# Read replica routing. Configure replicas with DATABASE_REPLICA_URLS (see project/settings.py).
+# Only GET/HEAD/OPTIONS requests read from a replica, and only for the catalog and order tables.
+# Everything else (writes, carts, stock, auth, background workers and management commands)
+# uses the primary ('default').
+# A client that just wrote something (e.g. checked out) reads from the primary for
+# READ_REPLICA_STICKY_SECONDS so it sees its own order even while the replicas catch up.
+# Responses tagged or cached under the catalog version (api/catalog.py) read from the primary too:
+# the version moves as soon as a write commits, a lagging replica would store old rows under the new version.
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# models that may be read from a replica: 'app_label.model_name'
+REPLICA_MODELS = {
+    'api.category', 'api.product', 'api.productvariant', 'api.imagerendition',
+    'api.order', 'api.orderitem',
+}
+
+_use_replicas = ContextVar('use_replicas', default=False)
+
+
+@contextmanager
+def read_from_primary():
+    """
+    Reads inside the block go to the primary, whatever the request is
+    """
+    token = _use_replicas.set(False)
+    try:
+        yield
+    finally:
+        _use_replicas.reset(token)
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias != 'default']
+
+
+def client_key(request):
+    """
+    Who made the request, without a database lookup: the token (or session) they sent, hashed
+    """
+    credential = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credential:
+        return None
+    return 'db:pinned:' + hashlib.sha256(credential.encode()).hexdigest()
+
+
+def pin_to_primary(request):
+    """
+    Send this client's reads to the primary for READ_REPLICA_STICKY_SECONDS
+    """
+    key = client_key(request)
+    if key:
+        cache.set(key, 1, getattr(settings, 'READ_REPLICA_STICKY_SECONDS', 10))
+
+
+def is_pinned(request):
+    key = client_key(request)
+    return bool(key) and cache.get(key) is not None
+
+
+async def apin_to_primary(request):
+    key = client_key(request)
+    if key:
+        await cache.aset(key, 1, getattr(settings, 'READ_REPLICA_STICKY_SECONDS', 10))
+
+
+async def ais_pinned(request):
+    key = client_key(request)
+    return bool(key) and await cache.aget(key) is not None
+
+
+class ReplicaRouter:
+    """
+    Database router: reads of REPLICA_MODELS go to a random replica while ReplicaMiddleware allows it,
+    everything else goes to the primary. Migrations only run on the primary
+    """
+    def db_for_read(self, model, **hints):
+        if not _use_replicas.get():
+            return 'default'
+        if model._meta.label_lower not in REPLICA_MODELS:
+            return 'default'
+        # reads inside a transaction on the primary (e.g. checkout locking stock) must see that transaction
+        if connections['default'].in_atomic_block:
+            return 'default'
+        replicas = replica_aliases()
+        return random.choice(replicas) if replicas else 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaMiddleware:
+    """
+    Lets the reads of safe requests go to replicas (unless the client wrote something a moment ago)
+    and pins a client to the primary after a successful write
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not replica_aliases():
+            return self.get_response(request)
+
+        safe = request.method in SAFE_METHODS
+        token = _use_replicas.set(safe and not is_pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _use_replicas.reset(token)
+
+        if not safe and response.status_code < 400:
+            pin_to_primary(request)
+        return response
+
+    async def __acall__(self, request):
+        if not replica_aliases():
+            return await self.get_response(request)
+
+        safe = request.method in SAFE_METHODS
+        # the flag is copied into the threads sync_to_async runs the ORM in
+        token = _use_replicas.set(safe and not await ais_pinned(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _use_replicas.reset(token)
+
+        if not safe and response.status_code < 400:
+            await apin_to_primary(request)
+        return response
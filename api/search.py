@@ -0,0 +1,199 @@
+import re
+from collections import defaultdict
+from django.db import connection
+from django.db.models import Q
+from .models import Product
+
+# Full-text product search without an external search service. The index is a side table keyed by
+# product id that holds the product name, category name and description:
+# - SQLite: an FTS5 virtual table, ranked with bm25()
+# - PostgreSQL: a table with a tsvector and a GIN index, ranked with ts_rank()
+# Other databases fall back to icontains filters without ranking.
+# The index is kept up to date by the signals in api/signals.py; after bulk inserts (which skip signals)
+# run `python manage.py rebuild_search_index`.
+
+SEARCH_TABLE = 'api_product_search'
+# at most this many matches are ranked and counted for facets, more than anyone pages through
+MAX_MATCHES = 1000
+MAX_TERMS = 10
+
+
+def search_terms(query):
+    """
+    Split the search text into lowercase words, punctuation is dropped so it can't break the match syntax
+    """
+    return re.findall(r'\w+', (query or '').lower())[:MAX_TERMS]
+
+
+class SQLiteSearch:
+    def create(self, cursor):
+        # prefix indexes make "shi*" as fast as a whole word
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            "name, category, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+    def index(self, cursor, rows):
+        rows = list(rows)
+        self.remove(cursor, [row[0] for row in rows])
+        cursor.executemany(f"INSERT INTO {SEARCH_TABLE} (rowid, name, category, description) VALUES (%s, %s, %s, %s)", rows)
+
+    def remove(self, cursor, product_ids):
+        product_ids = list(product_ids)
+        if product_ids:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(product_ids))})", product_ids)
+
+    def clear(self, cursor):
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+    def match(self, cursor, terms, limit):
+        # every word must match, the last one may be unfinished: blue shi -> "blue" "shi"*
+        expression = ' '.join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+        # a name match counts 10 times a description match, a category match 5 times
+        cursor.execute(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+            f"ORDER BY bm25({SEARCH_TABLE}, 10.0, 5.0, 1.0) LIMIT %s",
+            [expression, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearch:
+    DOCUMENT = ("setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+                "setweight(to_tsvector('simple', %s), 'C')")
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+            "product_id bigint PRIMARY KEY REFERENCES api_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING GIN (document)")
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+    def index(self, cursor, rows):
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (%s, {self.DOCUMENT}) "
+            "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+            list(rows),
+        )
+
+    def remove(self, cursor, product_ids):
+        product_ids = list(product_ids)
+        if product_ids:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)", [product_ids])
+
+    def clear(self, cursor):
+        cursor.execute(f"TRUNCATE {SEARCH_TABLE}")
+
+    def match(self, cursor, terms, limit):
+        expression = ' & '.join(f'{term}:*' if index == len(terms) - 1 else term for index, term in enumerate(terms))
+        cursor.execute(
+            f"SELECT product_id FROM {SEARCH_TABLE}, to_tsquery('simple', %s) query "
+            "WHERE document @@ query ORDER BY ts_rank(document, query) DESC, product_id LIMIT %s",
+            [expression, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class FallbackSearch:
+    # no index, every word has to appear in the name, category or description
+    def create(self, cursor):
+        pass
+
+    def drop(self, cursor):
+        pass
+
+    def index(self, cursor, rows):
+        pass
+
+    def remove(self, cursor, product_ids):
+        pass
+
+    def clear(self, cursor):
+        pass
+
+    def match(self, cursor, terms, limit):
+        queryset = Product.objects.all()
+        for term in terms:
+            queryset = queryset.filter(Q(name__icontains=term) | Q(category__name__icontains=term) | Q(description__icontains=term))
+        return list(queryset.order_by('id').values_list('id', flat=True)[:limit])
+
+
+def get_backend(vendor=None):
+    vendor = vendor or connection.vendor
+    if vendor == 'sqlite':
+        return SQLiteSearch()
+    if vendor == 'postgresql':
+        return PostgresSearch()
+    return FallbackSearch()
+
+
+def document_rows(products):
+    # (id, name, category, description), products need their category selected
+    return [(product.id, product.name, product.category.name if product.category else '', product.description) for product in products]
+
+
+def index_products(products):
+    with connection.cursor() as cursor:
+        get_backend().index(cursor, document_rows(products))
+
+
+def remove_products(product_ids):
+    with connection.cursor() as cursor:
+        get_backend().remove(cursor, product_ids)
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Index every product again, in batches. Returns the number of products indexed
+    """
+    backend = get_backend()
+    total = 0
+    with connection.cursor() as cursor:
+        backend.clear(cursor)
+        batch = []
+        for product in Product.objects.select_related('category').order_by('id').iterator(chunk_size=batch_size):
+            batch.append(product)
+            if len(batch) == batch_size:
+                backend.index(cursor, document_rows(batch))
+                total += len(batch)
+                batch = []
+        backend.index(cursor, document_rows(batch))
+    return total + len(batch)
+
+
+def matching_ids(query, limit=MAX_MATCHES):
+    """
+    Ids of the products matching the search text, best match first
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    with connection.cursor() as cursor:
+        return get_backend().match(cursor, terms, limit)
+
+
+def facet_counts(product_ids):
+    """
+    How many of the products are in each category, size and color, from one query over the products and their
+    available variants. A product with three black variants counts once for black
+    """
+    seen = {'category': defaultdict(set), 'size': defaultdict(set), 'color': defaultdict(set)}
+    rows = (Product.objects.filter(id__in=product_ids)
+            .values_list('id', 'category__name', 'variants__size', 'variants__color', 'variants__is_available'))
+    for product_id, category, size, color, variant_available in rows:
+        if category:
+            seen['category'][category].add(product_id)
+        if variant_available:
+            seen['size'][size].add(product_id)
+            seen['color'][color].add(product_id)
+    return {
+        facet: dict(sorted(((value, len(ids)) for value, ids in values.items()), key=lambda item: (-item[1], item[0])))
+        for facet, values in seen.items()
+    }
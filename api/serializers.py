@@ -1,45 +1,64 @@
 from rest_framework import serializers
 from .models import *
+from .images import rendition_urls
+# counts serializer time in the request metrics (api/instrumentation.py)
+from .instrumentation import TimedSerializerMixin
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['id', 'name', 'description']
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductVariantSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ProductVariant
+        fields = ['id', 'product', 'sku', 'size', 'color', 'stock_quantity', 'is_available']
+        read_only_fields = ['sku']
+
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     category = serializers.SlugRelatedField(slug_field='name', queryset=Category.objects.all())
+    # variants are added and restocked through /api/variants/
+    variants = ProductVariantSerializer(many=True, read_only=True)
+    # resized copies of image, {"webp": {"320": url, ...}, "jpeg": {...}}, use these instead of the original
+    images = serializers.SerializerMethodField()
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'price', 'category', 'size', 'color', 'stock_quantity', 'is_available', 'created_at', 'updated_at', 'unique_code', 'image']
+        fields = ['id', 'name', 'description', 'price', 'category', 'is_available', 'created_at', 'updated_at', 'unique_code', 'image', 'images', 'variants']
+
+    def get_images(self, product):
+        return rendition_urls(product, self.context.get('request'))
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     order = serializers.SlugRelatedField(slug_field='order_number', queryset=Order.objects.all())
     product = serializers.SlugRelatedField(slug_field='name', queryset=Product.objects.all())
+    variant = serializers.SlugRelatedField(slug_field='sku', read_only=True)
     class Meta:
         model = OrderItem
-        fields = ['id', 'order', 'product', 'quantity', 'price_at_purchase', 'color', 'size']
+        fields = ['id', 'order', 'product', 'variant', 'quantity', 'price_at_purchase', 'color', 'size']
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     customer = serializers.SlugRelatedField(slug_field='username', queryset=User.objects.all())
     items = OrderItemSerializer(many=True, read_only=True)
     class Meta:
         model = Order
         fields = ['id', 'customer', 'order_number', 'order_date', 'status', 'total_amount', 'shipping_address', 'payment_status', 'payment_method', 'items']
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     cart = serializers.SlugRelatedField(slug_field='cart_number', queryset=Cart.objects.all())
     product = serializers.SlugRelatedField(slug_field='name', queryset=Product.objects.all())
+    variant = serializers.SlugRelatedField(slug_field='sku', read_only=True)
     class Meta:
         model = CartItems
-        fields = ['id', 'cart', 'product', 'quantity', 'size', 'color']
+        fields = ['id', 'cart', 'product', 'variant', 'quantity', 'size', 'color']
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user = serializers.SlugRelatedField(slug_field='username', queryset=User.objects.all())
     cart_items = CartItemSerializer(many=True, read_only=True)
     class Meta:
         model = Cart
-        fields = ['id', 'user', 'created_at', 'updated_at', 'cart_number', 'cart_items']
+        fields = ['id', 'user', 'created_at', 'updated_at', 'cart_number', 'line_count', 'item_count', 'subtotal', 'cart_items']
+        read_only_fields = ['line_count', 'item_count', 'subtotal']
         
 class CheckoutSerializer(serializers.Serializer):
     shipping_address = serializers.CharField(required=True)
@@ -54,14 +73,64 @@ class CheckoutSerializer(serializers.Serializer):
         required=True
     )
 
-class PaymentSerializer(serializers.ModelSerializer):
+class DailySalesSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = DailySales
+        fields = ['id', 'day', 'payment_method', 'payment_status', 'orders', 'revenue']
+
+class PaymentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = ['id', 'order', 'stripe_payment_intent_id', 'amount', 'status', 'created_at']
 
 # model serializers map to the model, while serializer can be customized
 class AddToCartSerializer(serializers.Serializer):
-    product_code = serializers.CharField(max_length=6)
+    # product unique_code with size and color, or a variant sku (then size and color can be left out)
+    product_code = serializers.CharField(max_length=12)
     quantity = serializers.IntegerField(min_value=1)
-    size = serializers.CharField(max_length=20)
-    color = serializers.CharField(max_length=50)
\ No newline at end of file
+    size = serializers.CharField(max_length=20, required=False, default='')
+    color = serializers.CharField(max_length=50, required=False, default='', allow_blank=True)
+
+class CartOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['add', 'update', 'remove'])
+    product_code = serializers.CharField(max_length=12)
+    size = serializers.CharField(max_length=20, required=False, default='')
+    color = serializers.CharField(max_length=50, required=False, default='', allow_blank=True)
+    # add: how many to add, update: the new quantity (0 removes the line), remove: not needed
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, data):
+        if data['op'] == 'add' and not data.get('quantity'):
+            raise serializers.ValidationError({"quantity": "add needs a quantity of at least 1"})
+        if data['op'] == 'update' and data.get('quantity') is None:
+            raise serializers.ValidationError({"quantity": "update needs the new quantity"})
+        return data
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=200)
+
+
+class ProductImportSerializer(serializers.Serializer):
+    # one row of a product import (api/imports.py), every row is the whole product.
+    # Without unique_code a new product is created, with one the product with that code is created or replaced
+    unique_code = serializers.CharField(max_length=12, required=False)
+    name = serializers.CharField()
+    description = serializers.CharField(required=False, default='', allow_blank=True)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    # the category's name
+    category = serializers.CharField(max_length=100, required=False, allow_blank=True)
+    is_available = serializers.BooleanField(required=False, default=True)
+    # a name in the media storage, e.g. products/shirt.jpg, the file itself isn't uploaded by the import
+    image = serializers.CharField(max_length=100, required=False, default='', allow_blank=True)
+    # optional, one size/color of the product (a variant): a row per variant, the product columns repeated.
+    # The variant with the same size and color is created or its stock replaced, sku is generated when left out
+    sku = serializers.CharField(max_length=12, required=False)
+    size = serializers.ChoiceField(choices=Product.SIZE_CHOICES, required=False)
+    color = serializers.CharField(max_length=50, required=False, default='', allow_blank=True)
+    stock_quantity = serializers.IntegerField(min_value=0, required=False, default=0)
+
+    def validate(self, data):
+        if 'size' not in data and ('sku' in data or data['color'] or data['stock_quantity']):
+            raise serializers.ValidationError({"size": "A variant needs a size"})
+        return data
@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .models import Product, ProductVariant, Category, Cart, User, Order
+from .catalog import bump_catalog_version
+from .carts import refresh_cart_totals
+from .authentication import invalidate_token
+from .search import index_products, remove_products
+from .images import queue_renditions
+from .instrumentation import track_queries
+from . import analytics
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    # SQLITE_PRAGMAS from settings, on every new SQLite connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # count the queries of every connection for the request metrics
+    track_queries(connection)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductVariant)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(pre_save, sender=Product)
+def notice_image_upload(sender, instance, **kwargs):
+    # a newly uploaded file isn't written to storage yet (_committed is False) until the model is saved
+    instance._image_uploaded = bool(instance.image) and not instance.image._committed
+
+
+@receiver(post_save, sender=Product)
+def queue_image_renditions(sender, instance, **kwargs):
+    if getattr(instance, '_image_uploaded', False):
+        queue_renditions(instance)
+
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, **kwargs):
+    index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, **kwargs):
+    # the category name is part of every product's search text
+    if not created:
+        index_products(Product.objects.select_related('category').filter(category=instance))
+
+
+@receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    # deleting a category sets its products' category to NULL with an UPDATE, which sends no signals
+    instance._product_ids = list(Product.objects.filter(category=instance).values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def reindex_uncategorized_products(sender, instance, **kwargs):
+    index_products(Product.objects.select_related('category').filter(id__in=getattr(instance, '_product_ids', [])))
+
+
+@receiver(post_save, sender=Product)
+def refresh_carts_with_product(sender, instance, created, **kwargs):
+    # cart subtotals use the current price, one UPDATE for all carts holding the product
+    if not created:
+        refresh_cart_totals(Cart.objects.filter(cart_items__product=instance).distinct())
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # djoser's token/logout deletes the token
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def forget_tokens_of_changed_user(sender, instance, created, **kwargs):
+    # the cached user must not outlive a deactivation (or any other change to the user)
+    if not created:
+        for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+            invalidate_token(key)
+
+
+@receiver(pre_save, sender=Order)
+def notice_payment_change(sender, instance, **kwargs):
+    # saving an existing order with a new payment status or method moves it in the sales rollups.
+    # New orders are counted by place_order once their items exist
+    instance._sales_before = None
+    if instance.pk is None or kwargs.get('raw'):
+        return
+    old = Order.objects.filter(pk=instance.pk).values('payment_status', 'payment_method').first()
+    if old and (old['payment_status'], old['payment_method']) != (instance.payment_status, instance.payment_method):
+        instance._sales_before = (analytics.order_rows([instance.pk]), analytics.product_rows([instance.pk]))
+
+
+@receiver(post_save, sender=Order)
+def update_sales_rollups(sender, instance, created, **kwargs):
+    before = getattr(instance, '_sales_before', None)
+    if before is not None:
+        instance._sales_before = None
+        analytics.apply_changes(before[0], analytics.order_rows([instance.pk]), before[1], analytics.product_rows([instance.pk]))
+
+
+@receiver(pre_delete, sender=Order)
+def remove_from_sales_rollups(sender, instance, **kwargs):
+    # before the delete, while the order items still exist
+    analytics.remove_orders([instance.pk])
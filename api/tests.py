@@ -1,3 +1,1368 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import smtplib
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from PIL import Image
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import AsyncClient, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from . import benchmarks, instrumentation
+from .models import User, Category, Product, ProductVariant, Cart, CartItems, Order, OrderItem, Payment, EmailJob, StripeEvent, ImageRendition, StockReservation, DailySales, DailyProductSales
+from .outbox import claim_jobs, send_jobs, drain_outbox
+from .images import drain_image_jobs
+from .carts import add_item
+from .checkout import place_order, CheckoutError
+from .payments import apply_transitions
+from .inventory import expire_reservations
+from .authentication import local_tokens, token_cache_key
+from .imports import import_products
+from .renditions import render
+from .query_plans import full_scans
+from .search import rebuild_index, matching_ids, get_backend, search_terms, FallbackSearch
+from .ids import SnowflakeGenerator
+from .analytics import backfill
+from .urls import router
+from . import gateways
+from .gateways import StripeGateway, GatewayError, GatewayRejected, GatewayUnavailable
 
 # Create your tests here.
+
+
+class BenchmarkTests(TestCase):
+    def test_request_mix_runs_without_errors(self):
+        benchmarks.seed({'categories': 2, 'products': 20, 'users': 3, 'orders': 10})
+        report = benchmarks.run(requests=60)
+
+        self.assertEqual(set(report['endpoints']), set(benchmarks.DEFAULT_MIX))
+        for name, stats in report['endpoints'].items():
+            self.assertEqual(stats['errors'], 0, name)
+
+    def test_compare_flags_extra_queries_and_slower_p95(self):
+        baseline = {'endpoints': {'catalog': {'max_queries': 1, 'p95_ms': 10.0}}}
+        report = {'endpoints': {'catalog': {'max_queries': 2, 'p95_ms': 13.0}}}
+
+        self.assertEqual(len(benchmarks.compare(report, baseline, tolerance=0.2)), 2)
+        self.assertEqual(benchmarks.compare(report, baseline, tolerance=0.5), ['catalog: 1 -> 2 queries'])
+
+
+class SQLiteConcurrencyTests(TransactionTestCase):
+    """
+    Parallel add-to-cart and checkout requests must not fail with "database is locked"
+    (needs the SQLite performance profile in project/settings.py)
+    """
+    WORKERS = 8
+    ROUNDS = 10
+
+    def test_parallel_add_to_cart_and_checkout(self):
+        category = Category.objects.create(name='Stress')
+        product = Product.objects.create(name='Stress product', description='stress test', price=100, category=category)
+        variants = [
+            ProductVariant.objects.create(product=product, size=size, color='black', stock_quantity=1000)
+            for size in ('small', 'large')
+        ]
+        users = [User.objects.create(username=f'stress{i}', password='!') for i in range(self.WORKERS)]
+        failures = []
+        start = threading.Barrier(self.WORKERS)
+
+        def worker(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            start.wait()
+            try:
+                for round in range(self.ROUNDS):
+                    variant = variants[round % 2]
+                    for path, data in (
+                        ('/api/cart/add-to-cart/', {'product_code': variant.sku, 'quantity': 2, 'size': variant.size, 'color': 'black'}),
+                        ('/api/cart/checkout/', {'shipping_address': 'stress', 'payment_method': 'cod'}),
+                    ):
+                        try:
+                            response = client.post(path, data, format='json')
+                        except Exception as e:
+                            failures.append(f'{path}: {e}')
+                            continue
+                        if response.status_code >= 400 or 'error' in response.data:
+                            failures.append(f'{path}: {response.status_code} {response.data}')
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(Order.objects.count(), self.WORKERS * self.ROUNDS)
+        sold = self.WORKERS * self.ROUNDS * 2
+        self.assertEqual(sum(ProductVariant.objects.filter(product=product).values_list('stock_quantity', flat=True)), 2000 - sold)
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every GET endpoint of every viewset registered in api/urls.py must run the same number of queries
+    with SMALL and LARGE rows in every table. New viewsets and actions are picked up from the router,
+    an N+1 in a serializer makes the counts differ
+    """
+    SMALL = 10
+    LARGE = 1000
+    # query strings for actions that do nothing useful without one
+    PARAMS = {
+        'product-search': {'q': 'product'},
+        'product-autocomplete': {'q': 'prod'},
+        'product-catalog': {'size': 'small'},
+    }
+
+    def seed(self, count):
+        """
+        Add count rows to every table the API reads: categories, products with two variants each,
+        users with a cart line, orders with two items and a payment, and the sales rollups of the orders
+        """
+        start = Product.objects.count()
+        categories = Category.objects.bulk_create([Category(name=f'Category {start + i}') for i in range(count)])
+        products = Product.objects.bulk_create([
+            Product(name=f'Product {start + i}', description='query budget test', price=100, category=categories[i])
+            for i in range(count)
+        ])
+        variants = ProductVariant.objects.bulk_create([
+            ProductVariant(product=product, size=size, color='black', stock_quantity=10)
+            for product in products
+            for size in ('small', 'large')
+        ])
+        # no password, hashing a thousand of them would take minutes
+        users = User.objects.bulk_create([User(username=f'budget{start + i}', password='!') for i in range(count)])
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+        CartItems.objects.bulk_create([
+            CartItems(cart=cart, product=variant.product, variant=variant, size=variant.size, color=variant.color)
+            for cart, variant in zip(carts, variants)
+        ])
+        orders = Order.objects.bulk_create([
+            Order(customer=user, status='pending', total_amount=200, shipping_address='test', payment_status='pending', payment_method='visa')
+            for user in users
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=variant.product, variant=variant, quantity=1, price_at_purchase=100, size=variant.size, color=variant.color)
+            for order in orders
+            for variant in variants[:2]
+        ])
+        Payment.objects.bulk_create([
+            Payment(order=order, stripe_payment_intent_id=f'pi_{order.id}', amount=order.total_amount)
+            for order in orders
+        ])
+        # bulk inserts skip the signals that keep the search index and the sales rollups up to date
+        rebuild_index()
+        backfill()
+
+    def routes(self):
+        """
+        (url name, url) of the list, detail and GET actions of every registered viewset
+        """
+        for prefix, viewset, basename in router.registry:
+            basename = basename or router.get_default_basename(viewset)
+            model = viewset.queryset.model
+            pk = model.objects.order_by('pk').values_list('pk', flat=True).first()
+            yield f'{basename}-list', reverse(f'{basename}-list')
+            yield f'{basename}-detail', reverse(f'{basename}-detail', args=[pk])
+            for action in viewset.get_extra_actions():
+                if 'get' not in action.mapping:
+                    continue
+                name = f'{basename}-{action.url_name}'
+                yield name, reverse(name, args=[pk] if action.detail else [])
+
+    def query_counts(self, client):
+        counts = {}
+        for name, url in self.routes():
+            # cached catalog pages would make the second run free
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url, self.PARAMS.get(name, {}))
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            self.assertLess(response.status_code, 400, f'{name}: {response.status_code}')
+            counts[name] = len(queries)
+        return counts
+
+    def test_query_count_does_not_grow_with_rows(self):
+        staff = User.objects.create(username='staff', is_staff=True)
+        client = APIClient()
+        # staff see every order, so the order endpoints list all of them
+        client.force_authenticate(staff)
+
+        self.seed(self.SMALL)
+        small = self.query_counts(client)
+        self.seed(self.LARGE - self.SMALL)
+        large = self.query_counts(client)
+
+        for name, count in small.items():
+            with self.subTest(route=name):
+                self.assertEqual(large[name], count, f'{name} ran {count} queries with {self.SMALL} rows and {large[name]} with {self.LARGE}')
+
+    def test_every_registered_viewset_is_checked(self):
+        self.seed(1)
+        names = {name for name, url in self.routes()}
+        for prefix, viewset, basename in router.registry:
+            basename = basename or router.get_default_basename(viewset)
+            self.assertIn(f'{basename}-list', names)
+
+
+class QueryPlanTests(TestCase):
+    def test_full_scans_are_flagged(self):
+        self.assertEqual(full_scans(Product.objects.filter(description='cotton').explain()), ['api_product'])
+        self.assertEqual(full_scans(Order.objects.filter(customer_id=1).order_by('-order_date').explain()), [])
+        self.assertEqual(full_scans('Seq Scan on api_order  (cost=0.00..35.50 rows=10 width=4)'), ['api_order'])
+        self.assertEqual(full_scans('Index Scan using order_customer_idx on api_order'), [])
+
+    def test_hot_queries_use_indexes(self):
+        output = StringIO()
+        call_command('check_query_plans', stdout=output)
+        self.assertNotIn('FULL SCAN', output.getvalue())
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        instrumentation.metrics.reset()
+        self.addCleanup(instrumentation.metrics.reset)
+        Product.objects.create(name='Shirt', description='cotton', price=10)
+        self.client = APIClient()
+
+    def test_going_over_the_budget_logs_a_warning(self):
+        with self.settings(QUERY_BUDGETS={'product-list': 0}), self.assertLogs('api.instrumentation', 'WARNING') as logs:
+            self.client.get('/api/products/')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('GET /api/products/ (product-list)', logs.output[0])
+        self.assertIn('budget is 0. Most repeated:', logs.output[0])
+
+        with self.settings(QUERY_BUDGETS={'product-list': 100}), self.assertNoLogs('api.instrumentation', 'WARNING'):
+            self.client.get('/api/products/')
+
+    def test_metrics_show_the_histograms(self):
+        with self.settings(QUERY_BUDGETS={'product-list': 0}), self.assertLogs('api.instrumentation', 'WARNING'):
+            self.client.get('/api/products/')
+
+        self.assertEqual(self.client.get('/metrics/').status_code, 401)
+        self.client.force_authenticate(User.objects.create(username='staff', is_staff=True))
+        text = self.client.get('/metrics/').content.decode()
+        labels = 'view="product-list",method="GET"'
+        for name in ('api_request_duration_seconds', 'api_request_db_queries', 'api_request_db_seconds', 'api_request_serializer_seconds'):
+            self.assertIn(f'# TYPE {name} histogram', text)
+            self.assertIn(f'{name}_count{{{labels}}} 1', text)
+        self.assertIn(f'api_request_over_query_budget_total{{{labels}}} 1', text)
+
+
+class AdminTests(TestCase):
+    """
+    Admin change lists must run the same number of queries however many rows there are,
+    and the bulk order actions must be set-based and safe to repeat
+    """
+    CHANGE_LISTS = ['order', 'orderitem', 'cart', 'cartitems', 'payment', 'product', 'productvariant', 'category']
+
+    def setUp(self):
+        self.staff = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        self.client.force_login(self.staff)
+
+    def query_counts(self):
+        counts = {}
+        for model in self.CHANGE_LISTS:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(f'admin:api_{model}_changelist'))
+            self.assertEqual(response.status_code, 200, model)
+            counts[model] = len(queries)
+        return counts
+
+    def test_change_list_queries_do_not_grow_with_rows(self):
+        QueryBudgetTests().seed(5)
+        small = self.query_counts()
+        QueryBudgetTests().seed(95)
+        self.assertEqual(self.query_counts(), small)
+
+    def test_cancel_and_restock_only_restocks_once(self):
+        QueryBudgetTests().seed(3)
+        order_ids = list(Order.objects.values_list('pk', flat=True))
+        stock = dict(ProductVariant.objects.values_list('pk', 'stock_quantity'))
+        # every seeded order has one of each of the first two variants
+        sold = list(ProductVariant.objects.order_by('pk').values_list('pk', flat=True)[:2])
+        expected = {variant_id: quantity + (3 if variant_id in sold else 0) for variant_id, quantity in stock.items()}
+        for attempt in range(2):
+            self.client.post(reverse('admin:api_order_changelist'), {'action': 'cancel_and_restock', '_selected_action': order_ids})
+
+        self.assertEqual(set(Order.objects.values_list('status', flat=True)), {'cancelled'})
+        self.assertEqual(dict(ProductVariant.objects.values_list('pk', 'stock_quantity')), expected)
+
+
+class ProductImportTests(TestCase):
+    def test_export_imports_back_and_bad_rows_are_reported(self):
+        category = Category.objects.create(name='Shirts')
+        product = Product.objects.create(name='Shirt', description='cotton, blue', price='19.99', category=category, unique_code='SHIRT1')
+        staff = User.objects.create(username='staff', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(staff)
+
+        response = client.get(reverse('product-export'))
+        exported = b''.join(response.streaming_content).replace(b'19.99', b'24.50')
+        exported += b'NEW1,Hat,,5,Shirts,true,\r\nNEW2,,,abc,Shirts,true,\r\nNEW3,Sock,,2,Socks,true,\r\n'
+        upload = SimpleUploadedFile('products.csv', exported)
+        report = client.post(reverse('product-import'), {'file': upload}, format='multipart').data
+
+        self.assertEqual((report['rows'], report['created'], report['updated'], report['error_count']), (4, 1, 1, 2))
+        self.assertEqual([error['line'] for error in report['errors']], [4, 5])
+        product.refresh_from_db()
+        self.assertEqual(str(product.price), '24.50')
+        self.assertTrue(Product.objects.filter(unique_code='NEW1', category=category).exists())
+        self.assertFalse(Category.objects.filter(name='Socks').exists())
+
+    def test_variants_export_and_import_back_unchanged(self):
+        category = Category.objects.create(name='Shirts')
+        product = Product.objects.create(name='Shirt', description='cotton', price=100, category=category, unique_code='SHIRT1')
+        ProductVariant.objects.create(product=product, sku='SHIRT1S', size='small', color='black', stock_quantity=3)
+        ProductVariant.objects.create(product=product, sku='SHIRT1L', size='large', color='', stock_quantity=0)
+        Product.objects.create(name='Hat', description='wool', price=20, unique_code='HAT1')
+        staff = User.objects.create(username='staff', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(staff)
+
+        def variants():
+            return list(ProductVariant.objects.order_by('id').values_list('product_id', 'sku', 'size', 'color', 'stock_quantity'))
+
+        before = variants()
+        for export_format in ('csv', 'ndjson'):
+            response = client.get(reverse('product-export'), {'export_format': export_format})
+            upload = SimpleUploadedFile(f'products.{export_format}', b''.join(response.streaming_content))
+            report = client.post(reverse('product-import'), {'file': upload}, format='multipart').data
+
+            self.assertEqual((report['rows'], report['error_count']), (3, 0))
+            self.assertEqual((report['created'], report['updated'], report['variants_created'], report['variants_updated']), (0, 2, 0, 2))
+            self.assertEqual(variants(), before)
+            self.assertEqual(Product.objects.count(), 2)
+
+    def test_variant_rows_create_and_restock(self):
+        ProductVariant.objects.create(
+            product=Product.objects.create(name='Sock', description='', price=2, unique_code='SOCK1'),
+            sku='TAKEN1', size='small',
+        )
+        rows = [
+            (2, {'unique_code': 'SHIRT1', 'name': 'Shirt', 'price': '10', 'size': 'small', 'color': 'black', 'stock_quantity': '4'}),
+            (3, {'unique_code': 'SHIRT1', 'name': 'Shirt', 'price': '10', 'sku': 'SHIRT1L', 'size': 'large', 'stock_quantity': '1'}),
+            (4, {'unique_code': 'SHIRT1', 'name': 'Shirt', 'price': '10', 'sku': 'TAKEN1', 'size': 'medium'}),
+            (5, {'unique_code': 'SHIRT1', 'name': 'Shirt', 'price': '10', 'stock_quantity': '1'}),
+        ]
+        report = import_products(rows)
+        self.assertEqual((report['created'], report['variants_created'], report['error_count']), (1, 2, 2))
+        self.assertEqual([error['line'] for error in report['errors']], [5, 4])
+
+        report = import_products([(2, {'unique_code': 'SHIRT1', 'name': 'Shirt', 'price': '10', 'sku': 'SHIRT1L', 'size': 'large', 'stock_quantity': '9'})])
+        self.assertEqual((report['updated'], report['variants_updated'], report['error_count']), (1, 1, 0))
+        self.assertEqual(
+            sorted(ProductVariant.objects.filter(product__unique_code='SHIRT1').values_list('size', 'color', 'stock_quantity')),
+            [('large', '', 9), ('small', 'black', 4)],
+        )
+
+    def test_variant_rows_of_a_skipped_product_are_reported(self):
+        rows = [
+            (2, {'unique_code': 'HAT1', 'name': 'Hat', 'price': '5', 'category': 'Nope', 'size': 'small'}),
+            (3, {'unique_code': 'HAT1', 'name': 'Hat', 'price': '5', 'category': 'Nope', 'size': 'large'}),
+            (4, {'unique_code': 'HAT1', 'name': 'Hat', 'price': '5', 'category': 'Nope', 'size': 'medium'}),
+        ]
+        report = import_products(rows)
+        self.assertEqual(report['error_count'], 3)
+        self.assertEqual([error['line'] for error in report['errors']], [4, 2, 3])
+        self.assertIn('category', report['errors'][0]['errors'])
+        self.assertIn('see line 4', report['errors'][1]['errors']['unique_code'][0])
+        self.assertFalse(ProductVariant.objects.filter(product__unique_code='HAT1').exists())
+
+
+class ProductVariantTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Shirts')
+        self.product = Product.objects.create(name='Shirt', description='cotton', price=100, category=self.category, unique_code='ABC123')
+        # like migration 0013: the first variant of a grouped product kept the product's code as its sku
+        self.small = ProductVariant.objects.create(product=self.product, sku='ABC123', size='small', color='black', stock_quantity=5)
+        self.large = ProductVariant.objects.create(product=self.product, sku='LRG123', size='large', color='black', stock_quantity=5)
+        self.user = User.objects.create(username='customer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_product_code_with_options_wins_over_equal_sku(self):
+        response = self.client.post('/api/cart/add-to-cart/', {'product_code': 'ABC123', 'size': 'large', 'color': 'Black', 'quantity': 1}, format='json')
+        self.assertEqual(response.data['sku'], 'LRG123')
+
+        response = self.client.post('/api/cart/batch/', {'operations': [
+            {'op': 'add', 'product_code': 'ABC123', 'size': 'large', 'color': 'black', 'quantity': 1},
+            {'op': 'add', 'product_code': 'ABC123', 'quantity': 2},
+        ]}, format='json')
+        self.assertTrue(response.data['success'], response.data)
+        quantities = dict(CartItems.objects.values_list('variant__sku', 'quantity'))
+        self.assertEqual(quantities, {'LRG123': 2, 'ABC123': 2})
+
+    def test_only_staff_change_variants(self):
+        data = {'product': self.product.pk, 'size': 'medium', 'color': 'white', 'stock_quantity': 3}
+        self.assertEqual(self.client.post('/api/variants/', data, format='json').status_code, 403)
+        self.assertEqual(self.client.patch(f'/api/variants/{self.small.pk}/', {'stock_quantity': 999}, format='json').status_code, 403)
+        self.assertEqual(self.client.delete(f'/api/variants/{self.small.pk}/').status_code, 403)
+        self.assertEqual(self.client.get('/api/variants/').status_code, 200)
+
+        staff = APIClient()
+        staff.force_authenticate(User.objects.create(username='staff', is_staff=True))
+        response = staff.post('/api/variants/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['sku']), 12)
+        self.small.refresh_from_db()
+        self.assertEqual(self.small.stock_quantity, 5)
+
+    def test_variant_matrix(self):
+        response = APIClient().get(f'/api/products/{self.product.pk}/variants/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['sizes'], ['small', 'large'])
+        self.assertEqual(response.data['colors'], ['black'])
+        self.assertEqual(response.data['matrix']['black']['large'], {'sku': 'LRG123', 'stock_quantity': 5, 'is_available': True})
+        self.assertEqual(APIClient().get('/api/products/999999/variants/').status_code, 404)
+
+    def test_cart_lookups(self):
+        # a sku alone, a product code with its options, and options that don't exist
+        response = self.client.post('/api/cart/add-to-cart/', {'product_code': 'LRG123', 'quantity': 1}, format='json')
+        self.assertEqual(response.data['sku'], 'LRG123')
+        response = self.client.post('/api/cart/add-to-cart/', {'product_code': 'ABC123', 'size': 'small', 'color': 'black', 'quantity': 1}, format='json')
+        self.assertEqual(response.data['sku'], 'ABC123')
+        response = self.client.post('/api/cart/add-to-cart/', {'product_code': 'ABC123', 'size': 'medium', 'color': 'black', 'quantity': 1}, format='json')
+        self.assertIn('does not exist', response.data['error'])
+        response = self.client.post('/api/cart/add-to-cart/', {'product_code': 'LRG123', 'quantity': 6}, format='json')
+        self.assertIn('only has 5 pieces left', response.data['error'])
+
+
+class CatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        shirts = Category.objects.create(name='Shirts')
+        hats = Category.objects.create(name='Hats')
+        self.shirt = Product.objects.create(name='Shirt', description='cotton', price=20, category=shirts)
+        self.polo = Product.objects.create(name='Polo', description='pique', price=35, category=shirts)
+        self.hat = Product.objects.create(name='Hat', description='wool', price=10, category=hats)
+        ProductVariant.objects.create(product=self.shirt, size='large', color='Black', stock_quantity=3)
+        ProductVariant.objects.create(product=self.shirt, size='small', color='White', stock_quantity=3)
+        # a large black polo exists but can't be sold
+        ProductVariant.objects.create(product=self.polo, size='large', color='black', stock_quantity=3, is_available=False)
+        ProductVariant.objects.create(product=self.polo, size='small', color='black', stock_quantity=3)
+        ProductVariant.objects.create(product=self.hat, size='large', color='black', stock_quantity=3)
+        self.client = APIClient()
+
+    def names(self, **params):
+        return [product['name'] for product in self.client.get('/api/products/catalog/', params).data['results']]
+
+    def test_filters(self):
+        self.assertEqual(self.names(category='Shirts'), ['Polo', 'Shirt'])
+        self.assertEqual(self.names(size='large', color='black'), ['Hat', 'Shirt'])
+        self.assertEqual(self.names(color='white'), ['Shirt'])
+        self.assertEqual(self.names(min_price='15', max_price='30'), ['Shirt'])
+        self.assertEqual(self.names(category='Shirts', size='large', ordering='price'), ['Shirt'])
+        self.assertEqual(self.client.get('/api/products/catalog/', {'min_price': 'cheap'}).status_code, 400)
+
+    def test_cursor_pagination(self):
+        first = self.client.get('/api/products/catalog/', {'page_size': 2, 'ordering': 'price'}).data
+        self.assertEqual([product['name'] for product in first['results']], ['Hat', 'Shirt'])
+        self.assertIsNone(first['previous'])
+        second = self.client.get(first['next']).data
+        self.assertEqual([product['name'] for product in second['results']], ['Polo'])
+        self.assertIsNone(second['next'])
+
+    def test_saving_a_product_refreshes_the_cached_pages(self):
+        self.assertEqual(self.names(category='Hats'), ['Hat'])
+        self.hat.name = 'Beanie'
+        self.hat.save()
+        self.assertEqual(self.names(category='Hats'), ['Beanie'])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        tops = Category.objects.create(name='Tops')
+        # made first, so only the ranking puts the name match ahead of it
+        self.tee = Product.objects.create(name='Plain Tee', description='a blue shirt without buttons', price=8, category=tops)
+        self.shirt = Product.objects.create(name='Blue Shirt', description='cotton', price=10, category=tops)
+        self.sold_out = Product.objects.create(name='Shiny Shirt', description='silk', price=30, is_available=False)
+        Product.objects.create(name='Hat', description='wool', price=5)
+        self.client = APIClient()
+
+    def test_name_matches_rank_first(self):
+        response = self.client.get('/api/products/search/', {'q': 'blue shirt'})
+        self.assertEqual([product['id'] for product in response.data['results']], [self.shirt.id, self.tee.id])
+        self.assertEqual(response.data['facets']['category'], {'Tops': 2})
+
+    def test_autocomplete_matches_unfinished_words(self):
+        response = self.client.get('/api/products/autocomplete/', {'q': 'blue sh'})
+        self.assertEqual(response.data['suggestions'][0], {'id': self.shirt.id, 'name': 'Blue Shirt'})
+        # unavailable products are never suggested
+        response = self.client.get('/api/products/autocomplete/', {'q': 'shi'})
+        self.assertNotIn(self.sold_out.id, [suggestion['id'] for suggestion in response.data['suggestions']])
+
+    def test_index_follows_product_changes(self):
+        self.shirt.name = 'Red Shirt'
+        self.shirt.save()
+        self.assertEqual(matching_ids('blue'), [self.tee.id])
+        self.tee.delete()
+        self.assertEqual(matching_ids('blue'), [])
+
+    def test_fallback_backend_needs_every_word(self):
+        backend = get_backend('mysql')
+        self.assertIsInstance(backend, FallbackSearch)
+        self.assertEqual(backend.match(None, search_terms('Blue SHIRT!'), 10), [self.tee.id, self.shirt.id])
+        self.assertEqual(backend.match(None, search_terms('tops wool'), 10), [])
+
+
+class CodeGeneratorTests(TestCase):
+    def test_processes_on_one_host_get_their_own_worker_id(self):
+        # every generator claims its own slot, like two worker processes with the same ID_HOST_ID
+        with self.settings(ID_HOST_ID='3'):
+            first, second = SnowflakeGenerator(clock=lambda: 1750000000000), SnowflakeGenerator(clock=lambda: 1750000000000)
+        self.assertNotEqual(first.worker_id, second.worker_id)
+        self.assertEqual({first.worker_id >> 5, second.worker_id >> 5}, {3})
+        # the same millisecond and sequence in both, the codes still differ
+        codes = [generator.generate() for generator in (first, second) for i in range(100)]
+        self.assertEqual(len(set(codes)), len(codes))
+
+    def test_codes_sort_in_creation_order(self):
+        now = [1750000000000]
+        generator = SnowflakeGenerator(worker_id=7, clock=lambda: now[0])
+        codes = []
+        for i in range(5000):
+            codes.append(generator.generate())
+            if i % 1000 == 0:
+                now[0] += 1
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertEqual(sorted(codes), codes)
+        self.assertTrue(all(len(code) == 12 for code in codes))
+
+    def test_host_id_out_of_range(self):
+        with self.settings(ID_HOST_ID='32'), self.assertRaises(ImproperlyConfigured):
+            SnowflakeGenerator()
+
+    def test_host_id_is_required_unless_debug(self):
+        with self.settings(ID_HOST_ID=None, DEBUG=False), self.assertRaises(ImproperlyConfigured):
+            SnowflakeGenerator()
+        with self.settings(ID_HOST_ID=None, DEBUG=True):
+            self.assertEqual(SnowflakeGenerator().worker_id >> 5, 0)
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        raise smtplib.SMTPDataError(451, 'try again later')
+
+
+class UnreachableEmailBackend(locmem.EmailBackend):
+    def open(self):
+        raise ConnectionRefusedError('SMTP server unreachable')
+
+
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='buyer', email='buyer@example.com')
+        category = Category.objects.create(name='Shirts')
+        product = Product.objects.create(name='Shirt', description='cotton', price=100, category=category)
+        self.variant = ProductVariant.objects.create(product=product, size='small', color='black', stock_quantity=5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def checkout(self):
+        self.client.post('/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': 1}, format='json')
+        response = self.client.post('/api/cart/checkout/', {'shipping_address': 'ktm', 'payment_method': 'cod'}, format='json')
+        return EmailJob.objects.get(order_id=response.data['order_id'])
+
+    def test_checkout_queues_and_worker_sends(self):
+        job = self.checkout()
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(drain_outbox(), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('sent', 1))
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+        self.assertEqual(drain_outbox(), (0, 0))
+
+    def test_failures_back_off_then_dead_letter(self):
+        job = self.checkout()
+        delays = []
+        for attempt in range(5):
+            EmailJob.objects.filter(pk=job.pk).update(next_attempt_at=timezone.now())
+            before = timezone.now()
+            self.assertEqual(send_jobs(claim_jobs(10), FailingEmailBackend()), (0, 1))
+            job.refresh_from_db()
+            delays.append(round((job.next_attempt_at - before).total_seconds() / 60))
+        self.assertEqual(delays[:4], [1, 2, 4, 8])
+        self.assertEqual((job.status, job.attempts), ('failed', 5))
+        self.assertIn('try again later', job.last_error)
+        # a dead job is never picked up again
+        self.assertEqual(claim_jobs(10), [])
+
+    def test_unreachable_server_reschedules_the_batch(self):
+        job = self.checkout()
+        self.assertEqual(send_jobs(claim_jobs(10), UnreachableEmailBackend()), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertIn('unreachable', job.last_error)
+        self.assertGreater(job.next_attempt_at, timezone.now())
+
+
+class PaymentGatewayTests(TestCase):
+    """
+    The Stripe gateway against a local stub server (api/benchmarks.py), its breaker opens after 2 outages
+    """
+    def setUp(self):
+        self.stub = benchmarks.GatewayStub(0)
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        settings = self.settings(
+            STRIPE_API_BASE=self.stub.url, STRIPE_SECRET_KEY='sk_test_stub',
+            PAYMENT_GATEWAY_READ_TIMEOUT=0.2, PAYMENT_GATEWAY_FAILURE_THRESHOLD=2, PAYMENT_GATEWAY_RESET_SECONDS=60,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.gateway = StripeGateway()
+
+    def test_answers_through_the_stub(self):
+        self.assertEqual(self.gateway.payment_status('pi_1'), 'requires_action')
+        self.assertEqual(self.gateway.breaker.state, 'closed')
+
+    def test_timeouts_open_the_breaker(self):
+        self.stub.delay = 0.5
+        for attempt in range(2):
+            with self.assertRaises(GatewayError) as raised:
+                self.gateway.payment_status('pi_1')
+            self.assertNotIsInstance(raised.exception, GatewayRejected)
+        self.assertEqual(self.gateway.breaker.state, 'open')
+
+        # while open the gateway isn't called at all
+        calls = self.stub.calls
+        with self.assertRaises(GatewayUnavailable):
+            self.gateway.payment_status('pi_1')
+        self.assertEqual(self.stub.calls, calls)
+
+    def test_half_open_trial_reopens_or_closes(self):
+        self.stub.status = 500
+        for attempt in range(2):
+            with self.assertRaises(GatewayError):
+                self.gateway.payment_status('pi_1')
+        self.assertEqual(self.gateway.breaker.state, 'open')
+
+        # reset_seconds later one trial call goes through, it fails and the breaker opens again
+        self.gateway.breaker.opened_at -= 60
+        self.assertEqual(self.gateway.breaker.state, 'half-open')
+        with self.assertRaises(GatewayError):
+            self.gateway.payment_status('pi_1')
+        self.assertEqual(self.gateway.breaker.state, 'open')
+
+        # the next trial works and closes it
+        self.gateway.breaker.opened_at -= 60
+        self.stub.status = 200
+        self.assertEqual(self.gateway.payment_status('pi_1'), 'requires_action')
+        self.assertEqual(self.gateway.breaker.state, 'closed')
+
+    def test_refused_calls_dont_open_the_breaker(self):
+        self.stub.status = 400
+        for attempt in range(3):
+            with self.assertRaises(GatewayRejected):
+                self.gateway.payment_status('pi_1')
+        self.assertEqual(self.gateway.breaker.state, 'closed')
+
+
+def signed_event(event_id, event_type, intent_id, secret='whsec_test'):
+    """
+    A webhook body and its Stripe-Signature header, signed the way Stripe does it
+    """
+    payload = json.dumps({'id': event_id, 'type': event_type, 'data': {'object': {'id': intent_id, 'object': 'payment_intent'}}})
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return payload, f't={timestamp},v1={signature}'
+
+
+class PaymentTests(TestCase):
+    """
+    PaymentView against the local Stripe stub (api/benchmarks.py) and signed webhook events
+    """
+    def setUp(self):
+        self.stub = benchmarks.GatewayStub(0)
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        settings = self.settings(STRIPE_API_BASE=self.stub.url, STRIPE_SECRET_KEY='sk_test_stub', STRIPE_WEBHOOK_SECRET='whsec_test')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # gateways are kept per process, make new ones that talk to the stub
+        gateways._gateways.clear()
+        self.addCleanup(gateways._gateways.clear)
+
+        self.user = User.objects.create(username='payer')
+        self.order = Order.objects.create(customer=self.user, total_amount=100, shipping_address='ktm', payment_method='visa')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def webhook(self, event_id, event_type, intent_id, secret='whsec_test'):
+        payload, signature = signed_event(event_id, event_type, intent_id, secret)
+        return self.client.post('/api/payment/webhook/', payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=signature)
+
+    def test_create_is_idempotent(self):
+        first = self.client.post('/api/payment/', {'order_id': self.order.id}, format='json')
+        second = self.client.post('/api/payment/', {'order_id': self.order.id}, format='json')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_retry_after_a_failed_intent_makes_a_new_payment(self):
+        first = self.client.post('/api/payment/', {'order_id': self.order.id}, format='json').data
+        Payment.objects.filter(pk=first['id']).update(status='failed')
+
+        second = self.client.post('/api/payment/', {'order_id': self.order.id}, format='json').data
+        self.assertNotEqual(second['id'], first['id'])
+        self.assertEqual(second['status'], 'pending')
+        self.assertEqual(self.stub.calls, 2)
+
+        # retrying the new attempt gets it back
+        self.assertEqual(self.client.post('/api/payment/', {'order_id': self.order.id}, format='json').data['id'], second['id'])
+        self.assertEqual(self.stub.calls, 2)
+
+    def test_cash_on_delivery_is_a_bad_request(self):
+        Order.objects.filter(pk=self.order.pk).update(payment_method='cod')
+        response = self.client.post('/api/payment/', {'order_id': self.order.id}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('paid on delivery', response.data['error'])
+        self.assertEqual(self.stub.calls, 0)
+
+    def test_webhook_rejects_a_bad_signature(self):
+        response = self.webhook('evt_1', 'payment_intent.succeeded', 'pi_1', secret='whsec_other')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_duplicate_and_out_of_order_events(self):
+        payment = Payment.objects.create(order=self.order, stripe_payment_intent_id='pi_1', amount=100)
+
+        self.assertEqual(self.webhook('evt_2', 'payment_intent.succeeded', 'pi_1').status_code, 200)
+        # Stripe resends an event, and an older one arrives late: neither changes anything
+        self.assertEqual(self.webhook('evt_2', 'payment_intent.succeeded', 'pi_1').status_code, 200)
+        self.assertEqual(self.webhook('evt_1', 'payment_intent.processing', 'pi_1').status_code, 200)
+
+        payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual((self.order.payment_status, self.order.status), ('paid', 'processing'))
+        self.assertEqual(StripeEvent.objects.count(), 2)
+
+        response = self.client.post(f'/api/payment/{payment.id}/confirm/')
+        self.assertTrue(response.data['success'])
+        # confirm reads the webhook's status, it doesn't ask the gateway
+        self.assertEqual(self.stub.calls, 0)
+
+
+def jpeg(width, height, orientation=None):
+    image = Image.new('RGB', (width, height), 'red')
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+class RenditionTests(TestCase):
+    def test_sideways_photo_is_turned_upright(self):
+        # stored 1600x1200 with orientation 6: a portrait photo shown 1200 wide and 1600 high
+        sizes = {(width, height) for width, height, format, data in render(jpeg(1600, 1200, orientation=6), widths=[640, 1280])}
+        self.assertEqual(sizes, {(640, 853)})
+
+    def test_never_upscales(self):
+        renditions = render(jpeg(100, 50), widths=[160, 320])
+        self.assertEqual({(width, height) for width, height, format, data in renditions}, {(100, 50)})
+
+    def test_every_format_is_made(self):
+        renditions = render(jpeg(400, 200), widths=[160, 320], formats=['webp', 'jpeg'])
+
+        made = sorted((width, format, Image.open(BytesIO(data)).format) for width, height, format, data in renditions)
+        self.assertEqual(made, [(160, 'jpeg', 'JPEG'), (160, 'webp', 'WEBP'), (320, 'jpeg', 'JPEG'), (320, 'webp', 'WEBP')])
+
+    def test_worker_names_files_after_their_content(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        with self.settings(MEDIA_ROOT=media, IMAGE_RENDITION_WIDTHS=[160], IMAGE_RENDITION_FORMATS=['webp']):
+            product = Product.objects.create(name='Shirt', description='cotton', price=100, image=SimpleUploadedFile('shirt.jpg', jpeg(400, 200)))
+            self.assertEqual(drain_image_jobs(), (1, 0))
+
+            rendition = ImageRendition.objects.get(product=product)
+            with rendition.file.open('rb') as stored:
+                digest = hashlib.sha256(stored.read()).hexdigest()[:32]
+        self.assertEqual(rendition.file.name, f'products/renditions/{digest}.webp')
+        self.assertEqual((rendition.width, rendition.height), (160, 80))
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        self.user = User.objects.create_user(username='shopper', password='secret-password', email='shopper@example.com')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_cache_keeps_no_password_hash(self):
+        self.assertEqual(self.client.get('/api/auth/users/me/').data['email'], 'shopper@example.com')
+
+        cached = cache.get(token_cache_key(self.token.key))
+        self.assertEqual(cached, (self.user.id, 'shopper', True, False))
+        # later requests are answered from the cache, the deferred email is loaded when it is used
+        self.assertEqual(self.client.get('/api/auth/users/me/').data['email'], 'shopper@example.com')
+
+    def test_logout_forgets_the_token(self):
+        self.assertEqual(self.client.get('/api/auth/users/me/').status_code, 200)
+        self.assertEqual(self.client.post('/api/auth/token/logout/').status_code, 204)
+
+        self.assertIsNone(cache.get(token_cache_key(self.token.key)))
+        self.assertEqual(self.client.get('/api/auth/users/me/').status_code, 401)
+
+    def test_deleted_token_and_deactivated_user_are_refused(self):
+        self.assertEqual(self.client.get('/api/auth/users/me/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/users/me/').status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/users/me/').status_code, 200)
+        self.token.delete()
+        self.assertEqual(self.client.get('/api/auth/users/me/').status_code, 401)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    ReplicaRouter and ReplicaMiddleware with a replica alias that is the test database itself,
+    like DATABASE_REPLICA_URLS sets up in tests (TEST MIRROR). The alias only exists while these tests run,
+    it is added after the test runner has set up the test database.
+    A TransactionTestCase commits, so the replica's own connection sees the rows
+    """
+    @classmethod
+    def setUpClass(cls):
+        connections.settings['replica1'] = {**connections['default'].settings_dict, 'TEST': {'MIRROR': 'default'}}
+        cls.databases = {'default', 'replica1'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica1'].close()
+        del connections['replica1']
+        del connections.settings['replica1']
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Shirt', description='cotton', price=100)
+        self.variant = ProductVariant.objects.create(product=self.product, size='small', stock_quantity=5)
+        self.client = self.client_for('reader')
+
+    def client_for(self, username):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=User.objects.create(username=username)).key}')
+        return client
+
+    def tables_queried(self, client, method, path, data=None):
+        """
+        Make the request and return ({tables read on the primary}, {tables read on the replica})
+        """
+        with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica1']) as replica:
+            response = getattr(client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 400, response.data)
+
+        def tables(queries):
+            return {table for query in queries for table in ('api_product', 'api_cart', 'authtoken_token') if f'"{table}"' in query['sql']}
+        return tables(primary.captured_queries), tables(replica.captured_queries)
+
+    def test_get_reads_the_catalog_from_the_replica(self):
+        primary, replica = self.tables_queried(self.client, 'get', f'/api/products/{self.product.id}/')
+        self.assertEqual(replica, {'api_product'})
+        # authentication isn't a catalog read
+        self.assertNotIn('api_product', primary)
+
+    def test_writes_and_carts_stay_on_the_primary(self):
+        primary, replica = self.tables_queried(self.client, 'get', '/api/cart/')
+        self.assertEqual(replica, set())
+        self.assertIn('api_cart', primary)
+
+        primary, replica = self.tables_queried(self.client, 'post', '/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': 1})
+        self.assertEqual(replica, set())
+        self.assertIn('api_cart', primary)
+
+    def test_client_reads_from_the_primary_after_a_write(self):
+        self.tables_queried(self.client, 'post', '/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': 1})
+
+        primary, replica = self.tables_queried(self.client, 'get', f'/api/products/{self.product.id}/')
+        self.assertEqual(replica, set())
+        self.assertIn('api_product', primary)
+
+        # other clients still read from the replica
+        primary, replica = self.tables_queried(self.client_for('other'), 'get', f'/api/products/{self.product.id}/')
+        self.assertEqual(replica, {'api_product'})
+
+        # and so does the writer once READ_REPLICA_STICKY_SECONDS are over
+        cache.clear()
+        primary, replica = self.tables_queried(self.client, 'get', f'/api/products/{self.product.id}/')
+        self.assertEqual(replica, {'api_product'})
+
+
+class ConditionalRequestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Shirt', description='cotton', price=100)
+        self.variant = ProductVariant.objects.create(product=self.product, size='small', stock_quantity=5)
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.client = APIClient()
+
+    def test_etag_and_last_modified_then_304(self):
+        response = self.client.get(f'/api/products/{self.product.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', response)
+
+        again = self.client.get(f'/api/products/{self.product.id}/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+        self.assertEqual(again['ETag'], response['ETag'])
+
+        since = self.client.get(f'/api/products/{self.product.id}/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(since.status_code, 304)
+
+    def test_etag_changes_after_a_write(self):
+        detail = self.client.get(f'/api/products/{self.product.id}/')['ETag']
+        listing = self.client.get('/api/products/')['ETag']
+
+        self.client.force_authenticate(self.staff)
+        self.assertEqual(self.client.patch(f'/api/variants/{self.variant.id}/', {'stock_quantity': 2}, format='json').status_code, 200)
+        self.client.force_authenticate(None)
+
+        response = self.client.get(f'/api/products/{self.product.id}/', HTTP_IF_NONE_MATCH=detail)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], detail)
+        self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=listing).status_code, 200)
+
+    def test_cart_list_etag_only_follows_the_users_carts(self):
+        shopper, other = User.objects.create(username='shopper'), User.objects.create(username='other')
+        client, other_client = APIClient(), APIClient()
+        client.force_authenticate(shopper)
+        other_client.force_authenticate(other)
+        client.post('/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': 1}, format='json')
+
+        response = client.get('/api/cart/')
+        self.assertEqual([cart['user'] for cart in response.data], ['shopper'])
+        etag = response['ETag']
+
+        # someone else's cart changing doesn't invalidate this list
+        other_client.post('/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': 1}, format='json')
+        self.assertEqual(client.get('/api/cart/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        client.post('/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': 1}, format='json')
+        self.assertEqual(client.get('/api/cart/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class OrderVisibilityTests(TestCase):
+    """
+    Customers only see their own orders in the list, the detail and the export, staff see every order
+    """
+    def setUp(self):
+        product = Product.objects.create(name='Shirt', description='cotton', price=10)
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.alice_orders = [self.order(self.alice, product) for _ in range(3)]
+        self.bob_order = self.order(self.bob, product)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def order(self, customer, product):
+        order = Order.objects.create(customer=customer, total_amount=10, shipping_address='ktm', payment_method='cod')
+        OrderItem.objects.create(order=order, product=product, quantity=1, price_at_purchase=10, size='small')
+        return order
+
+    def test_list_is_paginated_and_only_has_own_orders(self):
+        first = self.client.get('/api/orders/', {'page_size': 2}).data
+        self.assertEqual(set(first), {'next', 'previous', 'results'})
+        self.assertIsNone(first['previous'])
+        second = self.client.get(first['next']).data
+        self.assertIsNone(second['next'])
+        seen = [order['id'] for order in first['results'] + second['results']]
+        # newest first
+        self.assertEqual(seen, [order.id for order in reversed(self.alice_orders)])
+
+    def test_other_customers_orders_are_not_found(self):
+        self.assertEqual(self.client.get(f'/api/orders/{self.alice_orders[0].id}/').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/orders/{self.bob_order.id}/').status_code, 404)
+
+    def test_export_only_has_own_orders(self):
+        for export_format in ('csv', 'ndjson'):
+            response = self.client.get('/api/orders/export/', {'export_format': export_format})
+            content = b''.join(response.streaming_content).decode()
+            for order in self.alice_orders:
+                self.assertIn(order.order_number, content)
+            self.assertNotIn(self.bob_order.order_number, content)
+
+    def test_staff_see_every_order(self):
+        self.client.force_authenticate(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(len(self.client.get('/api/orders/').data['results']), 4)
+        self.assertEqual(self.client.get(f'/api/orders/{self.bob_order.id}/').status_code, 200)
+
+
+class CartTotalsTests(TransactionTestCase):
+    """
+    The stored cart totals (line_count, item_count, subtotal) stay right while add-to-cart requests
+    for the same lines run at the same time, e.g. a double click
+    """
+    WORKERS = 6
+    ROUNDS = 5
+
+    def test_concurrent_adds_keep_the_totals(self):
+        shirt = Product.objects.create(name='Shirt', description='cotton', price='12.50')
+        variants = [ProductVariant.objects.create(product=shirt, size=size, stock_quantity=1000) for size in ('small', 'large')]
+        user = User.objects.create(username='clicker')
+        cart = Cart.objects.create(user=user)
+        failures = []
+        start = threading.Barrier(self.WORKERS)
+
+        def worker(number):
+            client = APIClient()
+            client.force_authenticate(user)
+            start.wait()
+            try:
+                for round in range(self.ROUNDS):
+                    variant = variants[(number + round) % 2]
+                    response = client.post('/api/cart/add-to-cart/', {'product_code': variant.sku, 'quantity': 2}, format='json')
+                    if 'error' in response.data:
+                        failures.append(response.data['error'])
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        added = self.WORKERS * self.ROUNDS * 2
+        self.assertEqual(sum(CartItems.objects.filter(cart=cart).values_list('quantity', flat=True)), added)
+        cart.refresh_from_db()
+        self.assertEqual((cart.line_count, cart.item_count, str(cart.subtotal)), (2, added, '750.00'))
+
+
+class CartBatchTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name='Shirt', description='cotton', price=10, unique_code='SHIRT1')
+        self.small = ProductVariant.objects.create(product=self.product, size='small', color='black', stock_quantity=5)
+        self.large = ProductVariant.objects.create(product=self.product, size='large', color='black', stock_quantity=5)
+        self.medium = ProductVariant.objects.create(product=self.product, size='medium', color='black', stock_quantity=5)
+        self.user = User.objects.create(username='batcher')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.client.post('/api/cart/add-to-cart/', {'product_code': self.medium.sku, 'quantity': 1}, format='json')
+
+    def test_failed_operations_are_reported_and_the_rest_applied(self):
+        response = self.client.post('/api/cart/batch/', {'operations': [
+            {'op': 'add', 'product_code': 'SHIRT1', 'size': 'small', 'color': 'Black', 'quantity': 2},
+            {'op': 'add', 'product_code': 'NOPE99', 'size': 'small', 'quantity': 1},
+            {'op': 'add', 'product_code': self.large.sku, 'quantity': 9},
+            {'op': 'remove', 'product_code': self.medium.sku},
+        ]}, format='json')
+
+        self.assertFalse(response.data['success'])
+        results = response.data['results']
+        self.assertEqual([result['success'] for result in results], [True, False, False, True])
+        self.assertEqual((results[0]['sku'], results[0]['quantity']), (self.small.sku, 2))
+        self.assertIn('does not exist', results[1]['error'])
+        self.assertIn('only has 5 pieces left', results[2]['error'])
+
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(dict(cart.cart_items.values_list('variant_id', 'quantity')), {self.small.id: 2})
+        self.assertEqual((cart.line_count, cart.item_count, str(cart.subtotal)), (1, 2, '20.00'))
+        self.assertEqual((response.data['total_in_cart'], response.data['item_count']), (1, 2))
+
+    def test_add_to_an_existing_line_query_count(self):
+        # variant, cart, the line UPDATE with the stock check in it, the cart totals UPDATE,
+        # the line and cart read back, plus the savepoint and its release
+        with self.assertNumQueries(7):
+            response = self.client.post('/api/cart/add-to-cart/', {'product_code': self.medium.sku, 'quantity': 2}, format='json')
+        self.assertEqual((response.data['quantity'], response.data['item_count'], response.data['subtotal']), (3, 3, '30.00'))
+
+        response = self.client.post('/api/cart/add-to-cart/', {'product_code': self.medium.sku, 'quantity': 3}, format='json')
+        self.assertEqual(response.data['error'], 'Shirt only has 5 pieces left')
+        self.assertEqual(Cart.objects.get(user=self.user).item_count, 3)
+
+    def test_invalid_operations_change_nothing(self):
+        response = self.client.post('/api/cart/batch/', {'operations': [
+            {'op': 'add', 'product_code': self.small.sku, 'quantity': 1},
+            {'op': 'add', 'product_code': self.large.sku},
+        ]}, format='json')
+
+        self.assertIn('operations', response.data)
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.line_count, cart.item_count), (1, 1))
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='Shirt', description='cotton', price=10)
+        self.variants = [ProductVariant.objects.create(product=product, size=f'size {number}', stock_quantity=5) for number in range(5)]
+
+    def cart_with(self, username, lines):
+        user = User.objects.create(username=username)
+        cart = Cart.objects.create(user=user)
+        for variant, quantity in lines:
+            add_item(cart, variant, quantity)
+        return user
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        one_line = self.cart_with('one', [(self.variants[0], 1)])
+        many_lines = self.cart_with('many', [(variant, 2) for variant in self.variants])
+
+        with CaptureQueriesContext(connection) as queries:
+            place_order(one_line, '123st ktm', 'cod')
+        with self.assertNumQueries(len(queries)):
+            order = place_order(many_lines, '123st ktm', 'cod')
+        self.assertEqual(order.items.count(), 5)
+
+    def test_every_short_line_is_reported(self):
+        user = self.cart_with('shopper', [(self.variants[0], 2), (self.variants[1], 4), (self.variants[2], 3)])
+        ProductVariant.objects.filter(pk=self.variants[1].pk).update(stock_quantity=1)
+        ProductVariant.objects.filter(pk=self.variants[2].pk).update(is_available=False)
+
+        with self.assertRaises(CheckoutError) as raised:
+            place_order(user, '123st ktm', 'cod')
+
+        failed = {item['sku']: (item['quantity'], item['stock_left']) for item in raised.exception.failed_items}
+        self.assertEqual(failed, {self.variants[1].sku: (4, 1), self.variants[2].sku: (3, None)})
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(ProductVariant.objects.get(pk=self.variants[0].pk).stock_quantity, 5)
+        self.assertEqual(Cart.objects.get(user=user).item_count, 9)
+
+
+class StockReservationTests(TestCase):
+    """
+    Stock reserved by a cart in checkout can't be added to other carts until it is released or expires
+    """
+    def setUp(self):
+        product = Product.objects.create(name='Shirt', description='cotton', price=10)
+        self.variant = ProductVariant.objects.create(product=product, size='small', stock_quantity=5)
+        self.buyer = APIClient()
+        self.buyer.force_authenticate(User.objects.create(username='buyer'))
+        self.other = APIClient()
+        self.other.force_authenticate(User.objects.create(username='other'))
+        self.add(self.buyer, 3)
+        self.assertTrue(self.buyer.post('/api/cart/reserve/').data['success'])
+
+    def add(self, client, quantity):
+        return client.post('/api/cart/add-to-cart/', {'product_code': self.variant.sku, 'quantity': quantity}, format='json')
+
+    def test_reserved_stock_limits_other_carts(self):
+        self.assertEqual(self.add(self.other, 3).data['error'], 'Shirt only has 2 pieces left')
+        self.assertTrue(self.add(self.other, 2).data['success'])
+        # the 2 already in the line count, so one more is too many
+        self.assertEqual(self.add(self.other, 1).data['error'], 'Shirt only has 2 pieces left')
+        self.assertEqual(CartItems.objects.get(cart__user__username='other').quantity, 2)
+
+    def test_expired_reservations_free_the_stock(self):
+        self.assertEqual(expire_reservations(), 0)
+        self.assertEqual(expire_reservations(now=timezone.now() + timedelta(hours=1)), 1)
+        self.assertTrue(self.add(self.other, 5).data['success'])
+
+    def test_checkout_releases_the_reservation(self):
+        response = self.buyer.post('/api/cart/checkout/', {'shipping_address': '123st ktm', 'payment_method': 'cod'}, format='json')
+        self.assertTrue(response.data['success'])
+        self.assertFalse(StockReservation.objects.exists())
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock_quantity, 2)
+        self.assertTrue(self.add(self.other, 2).data['success'])
+        self.assertEqual(self.add(self.other, 1).data['error'], 'Shirt only has 2 pieces left')
+
+
+class AsyncViewTests(TestCase):
+    """
+    The async payment and checkout views (api/async_views.py), with the gateway calls going to the Stripe stub
+    """
+    def setUp(self):
+        self.stub = benchmarks.GatewayStub(0)
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        # no webhook secret, so confirm asks the gateway
+        settings = self.settings(STRIPE_API_BASE=self.stub.url, STRIPE_SECRET_KEY='sk_test_stub', STRIPE_WEBHOOK_SECRET='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # the async gateway client belongs to the event loop of the test that made it
+        gateways._gateways.clear()
+        self.addCleanup(gateways._gateways.clear)
+        cache.clear()
+
+        self.user = User.objects.create(username='async-shopper', email='shopper@example.com')
+        self.headers = {'Authorization': f'Token {Token.objects.create(user=self.user).key}'}
+        product = Product.objects.create(name='Shirt', description='cotton', price=25)
+        self.variant = ProductVariant.objects.create(product=product, size='small', stock_quantity=5)
+        cart = Cart.objects.create(user=self.user)
+        add_item(cart, self.variant, 2)
+
+    def post(self, path, data=None, headers=None):
+        return AsyncClient().post(path, data or {}, content_type='application/json', headers=self.headers if headers is None else headers)
+
+    async def test_requires_a_token(self):
+        response = await self.post('/api/async/cart/checkout/', headers={})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_checkout_then_pay_and_confirm(self):
+        response = await self.post('/api/async/cart/checkout/', {'shipping_address': 'ktm', 'payment_method': 'visa'})
+        data = response.json()
+        self.assertTrue(data['success'], data)
+        self.assertEqual(data['total_amount'], '50.00')
+        self.assertEqual(await EmailJob.objects.filter(order_id=data['order_id']).acount(), 1)
+
+        first = (await self.post('/api/async/payment/', {'order_id': data['order_id']})).json()
+        second = (await self.post('/api/async/payment/', {'order_id': data['order_id']})).json()
+        self.assertEqual(first['id'], second['id'])
+        self.assertTrue(first['client_secret'].endswith('_secret'))
+        self.assertEqual(self.stub.calls, 1)
+
+        response = await self.post(f"/api/async/payment/{first['id']}/confirm/")
+        self.assertEqual(response.json(), {'error': 'Payment not completed. Status: pending'})
+        self.assertEqual(self.stub.calls, 2)
+
+    async def test_gateway_errors(self):
+        order = await Order.objects.acreate(customer=self.user, total_amount=50, shipping_address='ktm', payment_method='cod')
+        response = await self.post('/api/async/payment/', {'order_id': order.id})
+        self.assertEqual(response.status_code, 400)
+
+        await Order.objects.filter(pk=order.pk).aupdate(payment_method='visa')
+        self.stub.status = 500
+        response = await self.post('/api/async/payment/', {'order_id': order.id})
+        self.assertEqual(response.status_code, 502)
+        self.assertFalse(await Payment.objects.filter(order=order).aexists())
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        customer = User.objects.create(username='buyer')
+        for number, price in enumerate((30, 20)):
+            product = Product.objects.create(name=f'Product {number}', description='', price=price)
+            order = Order.objects.create(customer=customer, total_amount=price, shipping_address='ktm', payment_method='cod')
+            OrderItem.objects.create(order=order, product=product, quantity=1, price_at_purchase=price, size='small')
+        backfill()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='staff', is_staff=True))
+
+    def test_top_products_limit_is_kept_between_1_and_100(self):
+        for limit, count in (('-1', 1), ('0', 1), ('1', 1), ('1000', 2)):
+            response = self.client.get('/api/analytics/products/', {'limit': limit})
+            self.assertEqual(response.status_code, 200, limit)
+            self.assertEqual(len(response.data), count, limit)
+        self.assertEqual(response.data[0]['revenue'], '30.00')
+
+        response = self.client.get('/api/analytics/products/', {'limit': 'ten'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SalesRollupTests(TestCase):
+    """
+    After every kind of order change the rollups kept by deltas match a fresh backfill()
+    """
+    def setUp(self):
+        category = Category.objects.create(name='Tops')
+        shirt = Product.objects.create(name='Shirt', description='cotton', price=10, category=category)
+        hat = Product.objects.create(name='Hat', description='wool', price=7)
+        self.shirt = ProductVariant.objects.create(product=shirt, size='small', stock_quantity=20)
+        self.hat = ProductVariant.objects.create(product=hat, size='one size', stock_quantity=20)
+        self.buyers = [User.objects.create(username=f'buyer{number}') for number in range(2)]
+
+    def checkout(self, user, method, lines):
+        cart, _ = Cart.objects.get_or_create(user=user)
+        for variant, quantity in lines:
+            add_item(cart, variant, quantity)
+        return place_order(user, '123st ktm', method)
+
+    def rollups(self):
+        return (
+            sorted(DailySales.objects.values_list('day', 'payment_method', 'payment_status', 'orders', 'revenue')),
+            sorted(DailyProductSales.objects.values_list('day', 'product_id', 'category_id', 'payment_method', 'payment_status', 'orders', 'units', 'revenue')),
+        )
+
+    def assertMatchesBackfill(self):
+        kept = self.rollups()
+        backfill()
+        self.assertEqual(kept, self.rollups())
+
+    def test_rollups_match_a_backfill(self):
+        first = self.checkout(self.buyers[0], 'visa', [(self.shirt, 2), (self.hat, 1)])
+        second = self.checkout(self.buyers[1], 'cod', [(self.shirt, 3)])
+        self.assertMatchesBackfill()
+        self.assertEqual(DailySales.objects.get(payment_method='visa').revenue, 27)
+
+        Payment.objects.create(order=first, stripe_payment_intent_id='pi_1', amount=first.total_amount)
+        apply_transitions({'pi_1': 'payment_intent.succeeded'})
+        self.assertMatchesBackfill()
+        self.assertEqual(DailySales.objects.get(payment_method='visa').payment_status, 'paid')
+
+        second.payment_status = 'paid'
+        second.payment_method = 'mastercard'
+        second.save()
+        self.assertMatchesBackfill()
+        self.assertFalse(DailySales.objects.filter(payment_method='cod').exists())
+
+        first.delete()
+        self.assertMatchesBackfill()
+        self.assertEqual(DailyProductSales.objects.get().units, 3)
+
+
+class LaggingReplicaTests(TransactionTestCase):
+    """
+    A replica that is a copy of the test database taken before a write, like a replica that lags behind.
+    Responses cached or tagged under the catalog version must not be filled from it
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_path = os.path.join(tempfile.gettempdir(), 'kazi_test_replica.sqlite3')
+        connections.settings['replica1'] = {**connections['default'].settings_dict, 'NAME': cls.replica_path}
+        cls.databases = {'default', 'replica1'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica1'].close()
+        del connections['replica1']
+        del connections.settings['replica1']
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(cls.replica_path + suffix):
+                os.remove(cls.replica_path + suffix)
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Shirt', description='cotton', price=10)
+        # the replica stops here
+        connections['replica1'].close()
+        connections['default'].ensure_connection()
+        with sqlite3.connect(self.replica_path) as replica:
+            connections['default'].connection.backup(replica)
+        self.client = APIClient()
+
+    def test_catalog_is_not_cached_from_a_lagging_replica(self):
+        self.assertEqual(self.client.get('/api/products/catalog/').data['results'][0]['price'], '10.00')
+
+        self.product.price = 20
+        self.product.save()
+
+        self.assertEqual(self.client.get('/api/products/catalog/').data['results'][0]['price'], '20.00')
+        self.assertEqual(self.client.get('/api/products/').data[0]['price'], '20.00')
+        # the product page reads the replica, its version comes from the same rows as its data
+        self.assertEqual(self.client.get(f'/api/products/{self.product.id}/').data['price'], '10.00')
@@ -1,15 +1,22 @@
 from django.urls import path, include
-from .views import ProductView, OrderView, CategoryView, CartView, PaymentView
+from .views import ProductView, ProductVariantView, OrderView, CategoryView, CartView, PaymentView, AnalyticsView
 from rest_framework.routers import DefaultRouter
+from . import async_views
 
 router = DefaultRouter()
 
 router.register(r'products', ProductView)
+router.register(r'variants', ProductVariantView)
 router.register(r'category', CategoryView)
 router.register(r'orders', OrderView, basename='order')
 router.register(r'payment', PaymentView, basename='payment')
 router.register(r'cart', CartView, basename='cart')
+router.register(r'analytics', AnalyticsView, basename='analytics')
 
 urlpatterns = [
     path('', include(router.urls)),
+    # async versions of the payment and checkout endpoints for ASGI servers (api/async_views.py)
+    path('async/payment/', async_views.create_payment, name='async-payment-create'),
+    path('async/payment/<int:pk>/confirm/', async_views.confirm_payment, name='async-payment-confirm'),
+    path('async/cart/checkout/', async_views.checkout, name='async-cart-checkout'),
 ]
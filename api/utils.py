@@ -1,5 +1,6 @@
 import random
 
+# old 6 character codes, new rows use api.ids.generate_code. Kept because the first migrations reference it
 def generate_random_code():
     possible_characters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
     short_code = ''
@@ -14,9 +15,9 @@ from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.conf import settings
 
-def send_order_confirmation_email(order, request=None):
+def build_order_confirmation_email(order, order_link='#'):
     """
-    Send order confirmation email to customer
+    Build (but don't send) the order confirmation email for an order
     """
     customer = order.customer
     order_items = order.items.all()
@@ -41,7 +42,7 @@ def send_order_confirmation_email(order, request=None):
             }
             for item in order_items
         ],
-        'order_link': f'http://localhost:8000/api/orders/{order.id}/' if request else '#',
+        'order_link': order_link,
         'current_year': order.order_date.year,
     }
     
@@ -61,11 +62,9 @@ def send_order_confirmation_email(order, request=None):
     )
     
     email.attach_alternative(html_content, "text/html")
-    
-    try:
-        email.send()
-        print(f"✅ Order confirmation email sent to {customer.email}")
-        return True
-    except Exception as e:
-        print(f"❌ Failed to send email: {str(e)}")
-        return False
\ No newline at end of file
+    return email
+
+
+def get_order_link(order):
+    return f"{settings.SITE_URL.rstrip('/')}/api/orders/{order.id}/"
+
@@ -1,40 +1,299 @@
 from django.shortcuts import render
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, action
-from rest_framework.viewsets import ModelViewSet
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
-from .models import Category, Product, Order, OrderItem, User, Cart, Payment, CartItems
-from .serializers import CategorySerializer, ProductSerializer, OrderSerializer, CheckoutSerializer, CartSerializer, PaymentSerializer, AddToCartSerializer
-from django.db import transaction
-from .utils import send_order_confirmation_email
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, IsAdminUser, AllowAny
+from .models import Category, Product, ProductVariant, Order, OrderItem, User, Cart, Payment, CartItems, DailySales
+from .serializers import CategorySerializer, ProductSerializer, ProductVariantSerializer, OrderSerializer, CheckoutSerializer, CartSerializer, PaymentSerializer, AddToCartSerializer, CartBatchSerializer, DailySalesSerializer
+from .checkout import place_order, CheckoutError, validate_cart_items
+from .inventory import available_stock, reserve_cart, release_cart, reservation_ttl, is_sellable
+from django.utils import timezone
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import MultiPartParser
+from .exports import orders_to_csv, orders_to_ndjson, products_to_csv, products_to_ndjson
+from .imports import import_products, read_rows, guess_format, FORMATS as IMPORT_FORMATS
+from .carts import add_item, apply_operations, find_variants
+from .payments import record_events, process_pending_events, apply_transitions, parse_webhook, idempotency_key, payment_attempt, FINAL_PAYMENT_STATUSES
+from django.conf import settings
+from .gateways import get_gateway, GatewayError, GatewayRejected
+from .catalog import CatalogPagination, filter_products, catalog_cache_key, CATALOG_CACHE_SECONDS
+from .search import matching_ids, facet_counts
+from .permissions import IsStaffOrReadOnly
+from .conditional import ConditionalMixin, product_version, row_version, rows_version, catalog_list_version
+from functools import partial
+from . import analytics
+import csv
+import io
+import logging
 import stripe
-import os
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+
+logger = logging.getLogger('api.views')
 
 # Create your views here.
 
-class CategoryView(ModelViewSet):
+class CategoryView(ConditionalMixin, ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
 
+    # list and detail answer 304 Not Modified when the client has the current version (api/conditional.py)
+    def list(self, request, *args, **kwargs):
+        return self.answer_conditionally(request, catalog_list_version('categories'), partial(super().list, request, *args, **kwargs), primary=True)
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs['pk']
+        version = row_version(Category.objects.filter(pk=pk), ['id', 'updated_at']) if str(pk).isdigit() else None
+        return self.answer_conditionally(request, version, partial(super().retrieve, request, *args, **kwargs))
 
-class ProductView(ModelViewSet):
-    queryset = Product.objects.all()
+
+class ProductView(ConditionalMixin, ModelViewSet):
+    # select_related so the category name in ProductSerializer doesn't cost one query per product,
+    # and the variants of a whole page come in one extra query
+    queryset = Product.objects.select_related('category').prefetch_related(
+        Prefetch('variants', queryset=ProductVariant.objects.order_by('id')),
+        'renditions',
+    )
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
 
-class OrderView(ModelViewSet):
-    queryset = Order.objects.prefetch_related('items__product').all()
+    # list, detail, variants and catalog answer 304 Not Modified when the client has the current version,
+    # found with a cheap query instead of serializing the products (api/conditional.py)
+    def list(self, request, *args, **kwargs):
+        return self.answer_conditionally(request, catalog_list_version('products'), partial(super().list, request, *args, **kwargs), primary=True)
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs['pk']
+        version = product_version(Product.objects.filter(pk=pk)) if str(pk).isdigit() else None
+        return self.answer_conditionally(request, version, partial(super().retrieve, request, *args, **kwargs))
+
+    # /api/products/search
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        """
+        Full-text search over product name, category and description, best match first.
+        The last word may be unfinished (blue shi finds "Blue Shirt"). The catalog filters can be added,
+        facets count the matches per category, size and color before those filters
+        GET /api/products/search/?q=blue shirt&size=large&limit=20
+        """
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            return Response({"error": "limit must be a number"})
+
+        ids = matching_ids(request.query_params.get('q', ''))
+        # apply the filters on ids only, then load just the products of the page
+        allowed = set(filter_products(Product.objects.filter(id__in=ids), request.query_params).values_list('id', flat=True))
+        ids_left = [product_id for product_id in ids if product_id in allowed]
+        products = self.get_queryset().in_bulk(ids_left[:limit])
+
+        return Response({
+        "count": len(ids_left),
+        "results": self.get_serializer([products[product_id] for product_id in ids_left[:limit]], many=True).data,
+        "facets": facet_counts(ids)
+        })
+
+    # /api/products/autocomplete
+    @action(detail=False, methods=['get'], url_path='autocomplete')
+    def autocomplete(self, request):
+        """
+        Product names for a search box while the user types
+        GET /api/products/autocomplete/?q=blu
+        """
+        ids = matching_ids(request.query_params.get('q', ''), limit=10)
+        names = dict(Product.objects.filter(id__in=ids, is_available=True).values_list('id', 'name'))
+        return Response({"suggestions": [
+            {"id": product_id, "name": names[product_id]} for product_id in ids if product_id in names
+        ]})
+
+    # /api/products/{id}/variants
+    @action(detail=True, methods=['get'], url_path='variants')
+    def variants(self, request, pk=None):
+        """
+        The product with every size/color and its stock, in one query (plus one for the image renditions
+        and one for its version, a client with the current version gets 304 Not Modified)
+        GET /api/products/{id}/variants/
+        {
+            ...product fields...,
+            "sizes": ["small", "medium"],
+            "colors": ["black", "white"],
+            "matrix": {"black": {"small": {"sku": "...", "stock_quantity": 3, "is_available": true}, ...}, ...}
+        }
+        """
+        if not str(pk).isdigit():
+            return Response({"error": "Product not found"}, status=404)
+        return self.answer_conditionally(request, product_version(Product.objects.filter(pk=pk)), partial(self.variant_matrix, pk))
+
+    def variant_matrix(self, pk):
+        variants = list(ProductVariant.objects.select_related('product__category').prefetch_related('product__renditions')
+                        .filter(product_id=pk).order_by('id'))
+        if variants:
+            product = variants[0].product
+        else:
+            # a product without variants yet, still answer with the product
+            product = Product.objects.select_related('category').prefetch_related('renditions').filter(pk=pk).first()
+            if product is None:
+                return Response({"error": "Product not found"}, status=404)
+        # hand the variants we already have to the serializer instead of letting it query them again
+        product._prefetched_objects_cache = {'variants': variants}
+
+        data = self.get_serializer(product).data
+        size_order = [choice for choice, label in Product.SIZE_CHOICES]
+        data['sizes'] = sorted({variant.size for variant in variants}, key=size_order.index)
+        data['colors'] = sorted({variant.color for variant in variants})
+        data['matrix'] = {}
+        for variant in variants:
+            data['matrix'].setdefault(variant.color, {})[variant.size] = {
+                "sku": variant.sku,
+                "stock_quantity": variant.stock_quantity,
+                "is_available": variant.is_available,
+            }
+        return Response(data)
+
+    # /api/products/catalog
+    @action(detail=False, methods=['get'], url_path='catalog')
+    def catalog(self, request):
+        """
+        Paginated and filterable product listing for the shop front, cached per query
+        GET /api/products/catalog/?category=Shirts&size=large&color=black&min_price=500&max_price=2000&is_available=true&ordering=price&cursor=...
+        """
+        return self.answer_conditionally(request, catalog_list_version('catalog'), partial(self.catalog_page, request), primary=True)
+
+    def catalog_page(self, request):
+        # answer_conditionally runs this with reads from the primary, the page is cached under the current catalog version
+        cache_key = catalog_cache_key(request.query_params)
+        data = cache.get(cache_key)
+        if data is None:
+            queryset = filter_products(self.get_queryset(), request.query_params)
+            paginator = CatalogPagination()
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            data = paginator.get_paginated_response(self.get_serializer(page, many=True).data).data
+            cache.set(cache_key, data, CATALOG_CACHE_SECONDS)
+        return Response(data)
+
+    # /api/products/export
+    @action(detail=False, methods=['get'], url_path='export', permission_classes=[IsAdminUser])
+    def export(self, request):
+        """
+        Download every product without loading them into memory at once, in the format the import reads
+        GET /api/products/export/?export_format=csv (default) or ?export_format=ndjson
+        """
+        export_format = request.query_params.get('export_format', 'csv')
+        queryset = Product.objects.all()
+        if export_format == 'csv':
+            response = StreamingHttpResponse(products_to_csv(queryset), content_type='text/csv')
+        elif export_format == 'ndjson':
+            response = StreamingHttpResponse(products_to_ndjson(queryset), content_type='application/x-ndjson')
+        else:
+            return Response({"error": "export_format must be csv or ndjson"})
+        response['Content-Disposition'] = f'attachment; filename="products.{export_format}"'
+        return response
+
+    # /api/products/import
+    @action(detail=False, methods=['post'], url_path='import', url_name='import', permission_classes=[IsAdminUser], parser_classes=[MultiPartParser])
+    def import_file(self, request):
+        """
+        Create or update products from an uploaded CSV or NDJSON file (see api/imports.py), rows matched by unique_code
+        POST /api/products/import/ multipart: file=@products.csv, optional format=csv|ndjson and create_categories=true
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "Upload the products as 'file'"})
+        file_format = request.data.get('format') or guess_format(upload.name)
+        if file_format not in IMPORT_FORMATS:
+            return Response({"error": "format must be csv or ndjson"})
+
+        # big uploads are in a temporary file, rows are read from it a chunk at a time
+        stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+        create_categories = str(request.data.get('create_categories', '')).lower() in ('1', 'true', 'yes')
+        try:
+            report = import_products(read_rows(stream, file_format), create_categories=create_categories)
+        except (UnicodeDecodeError, csv.Error) as e:
+            return Response({"error": f"Can't read the file: {e}"})
+        return Response(report)
+
+class ProductVariantView(ModelViewSet):
+    # sizes/colors of products, staff add and restock them here
+    queryset = ProductVariant.objects.select_related('product').order_by('id')
+    serializer_class = ProductVariantSerializer
+    permission_classes = [IsStaffOrReadOnly]
+
+class OrderPagination(CursorPagination):
+    # keyset pagination, page N costs the same as page 1 even with years of orders
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-order_date', '-id')
+
+
+class OrderView(ConditionalMixin, ModelViewSet):
+    queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OrderPagination
+
+    def get_queryset(self):
+        # customers only see their own orders, staff see everything
+        queryset = Order.objects.select_related('customer').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('product', 'variant'))
+        )
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(customer=self.request.user)
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        # 304 Not Modified when the client has the current version of the order (api/conditional.py).
+        # Orders have no updated_at, the version is made of the columns that change after checkout
+        pk = kwargs['pk']
+        version = row_version(self.get_queryset().filter(pk=pk), ['id', 'status', 'payment_status', 'payment_method', 'shipping_address', 'total_amount'], with_catalog=True) if str(pk).isdigit() else None
+        return self.answer_conditionally(request, version, partial(super().retrieve, request, *args, **kwargs))
+
+    # /api/orders/export
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request):
+        """
+        Download all orders without loading them into memory at once
+        GET /api/orders/export/?export_format=csv (default) or ?export_format=ndjson
+        """
+        export_format = request.query_params.get('export_format', 'csv')
+        queryset = self.get_queryset().order_by('order_date', 'id')
+        if export_format == 'csv':
+            response = StreamingHttpResponse(orders_to_csv(queryset), content_type='text/csv')
+        elif export_format == 'ndjson':
+            response = StreamingHttpResponse(orders_to_ndjson(queryset), content_type='application/x-ndjson')
+        else:
+            return Response({"error": "export_format must be csv or ndjson"})
+        response['Content-Disposition'] = f'attachment; filename="orders.{export_format}"'
+        return response
 
 
-class CartView(ModelViewSet):
-    queryset = Cart.objects.all()
+class CartView(ConditionalMixin, ModelViewSet):
+    queryset = Cart.objects.select_related('user').prefetch_related(
+        Prefetch('cart_items', queryset=CartItems.objects.select_related('product', 'variant'))
+    )
     serializer_class = CartSerializer
     permission_classes = [IsAuthenticated]
-    
+
+    def get_queryset(self):
+        # customers only see their own carts, staff see everything.
+        # The list's ETag is made from these rows too, so other customers' carts don't change it
+        queryset = super().get_queryset()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(user=self.request.user)
+        return queryset
+
+    # list and detail answer 304 Not Modified when the client has the current version (api/conditional.py),
+    # every cart change moves updated_at (api/carts.py) and product changes move the catalog version
+    def list(self, request, *args, **kwargs):
+        return self.answer_conditionally(request, rows_version(self.get_queryset()), partial(super().list, request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs['pk']
+        version = row_version(self.get_queryset().filter(pk=pk), ['id', 'updated_at', 'line_count', 'item_count', 'subtotal'], with_catalog=True) if str(pk).isdigit() else None
+        return self.answer_conditionally(request, version, partial(super().retrieve, request, *args, **kwargs))
+
     # /api/cart/checkout
     @action(detail=False, methods=['post'], url_path='checkout')
     def checkout(self, request):
@@ -54,86 +313,102 @@ class CartView(ModelViewSet):
         # Get validated data
         shipping_address = serializer.validated_data['shipping_address']
         payment_method = serializer.validated_data['payment_method']
-        cart_items = None 
         try:
-            # transaction.atomic() ensures all database operations succeed together or fail together.
-            # Without atomic = Buying items one by one. if you fail on item 3, you still have items 1-2 in your cart
-            # With atomic = All items scanned together at checkout. if any item fails, entire transaction cancels
-            with transaction.atomic():  
-                # 1. Get user's cart
-                cart = Cart.objects.get(user=request.user)
-                # get all cart items from the cart of user with optimization
-                cart_items = cart.cart_items.select_related('product').all()
-
-                # 2. Validate cart items
-                # Check if the cart items is not empty
-                if not cart_items.exists():
-                    return Response({"error": "Cart is empty"})
-                # check if available and stock quantity
-                total_amount = 0
-                for item in cart_items:
-                    if not item.product.is_available:
-                        return Response({"error": f"{item.product.name} is no longer available"})
-                    if item.product.stock_quantity < item.quantity:
-                        return Response({"error": f"Not enough stock for {item.product.name} stock left {item.product.stock_quantity}"})
-                    
-                    # calculate the total amout from the products
-                    total_amount += item.quantity * item.product.price
-                
-                # 3. Create order
-                order = Order.objects.create(
-                    customer = request.user,
-                    status = 'pending',
-                    total_amount = total_amount,
-                    shipping_address = shipping_address,
-                    payment_method = payment_method,
-                    payment_status='pending'
-                )
-
-                # 4. Convert cart items to order items
-                for cart_item in cart_items:
-                    OrderItem.objects.create(
-                        order = order,
-                        product = cart_item.product,
-                        quantity = cart_item.quantity,
-                        price_at_purchase = cart_item.product.price,
-                        size = cart_item.size,
-                        color = cart_item.color
-                    )
-
-                    # 5. Update inventory
-                    cart_item.product.stock_quantity -= cart_item.quantity
-                    cart_item.product.save()
-
-                # Send Email
-                try:
-                    send_order_confirmation_email(order, request)
-                except Exception as e:
-                    print(f"Email sending failed (but order created): {str(e)}")
-                    # Don't fail the whole checkout if email fails
-
-                # 6. Clear cart
-                cart.cart_items.all().delete()
-
-                # 7. Return order details
-                return Response({
-                "success": True,
-                "message": "Order created successfully",
-                "order_number": order.order_number,
-                "total_amount": str(total_amount),
-                "order_id": order.id
-                })
-            
+            # place_order() runs everything inside transaction.atomic(), so all database operations
+            # succeed together or fail together. It uses a fixed number of queries no matter how many items are in the cart
+            order = place_order(request.user, shipping_address, payment_method)
         except Cart.DoesNotExist:
             return Response({"error": "Cart not found"})
+        except CheckoutError as e:
+            return Response({"error": e.message, "failed_items": e.failed_items})
         except  Exception as e:
             return Response({"error": f"Checkout failed: {str(e)}"})
 
+        # Return order details
+        return Response({
+        "success": True,
+        "message": "Order created successfully",
+        "order_number": order.order_number,
+        "total_amount": str(order.total_amount),
+        "order_id": order.id
+        })
+
+    # /api/cart/reserve
+    @action(detail=False, methods=['post'], url_path='reserve')
+    def reserve(self, request):
+        """
+        Hold the stock of everything in the cart while the user fills in the checkout form
+        POST /api/cart/reserve/
+        """
+        try:
+            cart = Cart.objects.get(user=request.user)
+        except Cart.DoesNotExist:
+            return Response({"error": "Cart not found"})
+
+        cart_items = list(cart.cart_items.select_related('product', 'variant__product'))
+        if not cart_items:
+            return Response({"error": "Cart is empty"})
+
+        ttl = reservation_ttl()
+        short = reserve_cart(cart, cart_items, ttl)
+        if short:
+            return Response({"error": "Some items in your cart can't be reserved", "failed_items": validate_cart_items(cart_items, short)})
+
+        return Response({
+        "success": True,
+        "message": "Cart reserved",
+        "expires_at": timezone.now() + ttl
+        })
+
+    # /api/cart/release
+    @action(detail=False, methods=['post'], url_path='release')
+    def release(self, request):
+        """
+        Give back the stock held for the cart
+        POST /api/cart/release/
+        """
+        try:
+            cart = Cart.objects.get(user=request.user)
+        except Cart.DoesNotExist:
+            return Response({"error": "Cart not found"})
+
+        return Response({"success": True, "released": release_cart(cart)})
+
+    # /api/cart/batch
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        """
+        Change several cart lines in one request, e.g. to sync a cart that was edited offline
+        POST /api/cart/batch/
+        {
+            "operations": [
+                {"op": "add", "product_code": "ABC123", "size": "large", "color": "black", "quantity": 2},
+                {"op": "update", "product_code": "XYZ789", "size": "small", "color": "red", "quantity": 1},
+                {"op": "remove", "product_code": "QWE456", "size": "medium", "color": "blue"}
+            ]
+        }
+        """
+        serializer = CartBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors)
+
+        cart, created = Cart.objects.get_or_create(user=request.user)
+        results = apply_operations(cart, serializer.validated_data['operations'])
+        cart.refresh_from_db(fields=['line_count', 'item_count', 'subtotal'])
+
+        return Response({
+        "success": all(result['success'] for result in results),
+        "results": results,
+        "total_in_cart": cart.line_count,
+        "item_count": cart.item_count,
+        "subtotal": str(cart.subtotal)
+        })
+
     # api/cart/add-to-cart
     @action(detail=False, methods=['post'], url_path='add-to-cart')
     def add_to_cart(self, request):
         """
-        Add product to cart using product unique_code
+        Add product to cart using product unique_code plus size and color, or the variant sku alone
         POST /api/cart/add-item/
         {
             "product_code": "ABC123",
@@ -155,31 +430,25 @@ class CartView(ModelViewSet):
         color = serializer.validated_data['color']
 
         try:
-            product = Product.objects.get(unique_code=product_code)
-            current_price = product.price
+            # find the size/color of the product (the variant), or the variant by its sku
+            variant = find_variants([(product_code, size, color)]).get((product_code, size, color))
+            if variant is None:
+                raise ProductVariant.DoesNotExist
+            product = variant.product
             # check if user has cart, if not create a cart for user
-            try:
-                cart = Cart.objects.get(user=request.user)
-            except Cart.DoesNotExist:
-                cart = Cart.objects.create(user=request.user)
-                print(f"Created new cart for user: {request.user.username}")
+            cart, created = Cart.objects.get_or_create(user=request.user)
+            if created:
+                logger.debug("Created new cart for user: %s", request.user.username)
 
             # check if product is available
-            if product.is_available == False:
+            if not is_sellable(variant):
                 return Response({"error": f"{product.name} is not available"})
-            # check if product has appropriate quantity
-            if product.stock_quantity < quantity:
-                return Response({"error": f"{product.name} only has {product.stock_quantity} pieces left"})
-            # check if product is already on cart
-            
-            cart_item = CartItems.objects.filter(cart=cart, product=product, size=size, color=color).first()
-            if cart_item:
-                # udpate the quantity
-                cart_item.quantity += quantity
-                cart_item.save()
-            else:
-                # Create new if doesn't exist
-                cart_item = CartItems.objects.create(cart=cart, product=product, size=size, color=color,quantity=quantity)
+            # add to the line already in the cart or create it, and update the cart totals.
+            # check_stock makes sure the line (with what is already in it) fits in the stock,
+            # stock held by other carts in checkout doesn't count
+            cart_item = add_item(cart, variant, quantity, check_stock=True)
+            if cart_item is None:
+                return Response({"error": f"{product.name} only has {available_stock(variant, exclude_cart=cart)} pieces left"})
 
             return Response({
             "success": True,
@@ -187,15 +456,18 @@ class CartView(ModelViewSet):
             "cart_item_id": cart_item.id,
             "product": product.name,
             "product_code": product.unique_code,
+            "sku": variant.sku,
             "quantity": cart_item.quantity,
-            "size": size,
-            "color": color,
-            "total_in_cart": cart.cart_items.count()
+            "size": variant.size,
+            "color": variant.color,
+            "total_in_cart": cart_item.cart.line_count,
+            "item_count": cart_item.cart.item_count,
+            "subtotal": str(cart_item.cart.subtotal)
             })
 
 
-        except Product.DoesNotExist:
-            return Response({"error": f"{product.name} with {product.code} does not exist"})
+        except ProductVariant.DoesNotExist:
+            return Response({"error": f"Product with code {product_code} in {size}/{color} does not exist"})
         except Exception as e:
             return Response({"error": f"Failed to add to cart: {str(e)}"})
 
@@ -214,31 +486,39 @@ class PaymentView(ModelViewSet):
         try:
             # first we get the order of which we are going to process the payment
             order = Order.objects.get(id=order_id, customer=request.user)
+        except Order.DoesNotExist:
+            return Response({"error": "Order not found"})
 
-            # now we create Stripe PaymentIntent
-            intent = stripe.PaymentIntent.create(
-                amount=int(order.total_amount * 100),
-                currency='usd',
-                metadata={
-                    'order_id': order.id,
-                    'customer_id': request.user.id
-                }
-            )
+        # a retry (double click, flaky network) for the same order and amount gets the payment we already made,
+        # unless that one failed or was cancelled, then this is a new attempt with a new payment
+        key = idempotency_key(order, payment_attempt(order))
+        payment = Payment.objects.filter(idempotency_key=key).first()
+        if payment is None:
+            # now we create the payment at the gateway for the order's payment method (Stripe for cards),
+            # the idempotency key makes the gateway return the same payment if two requests race past the check above
+            try:
+                intent = get_gateway(order.payment_method).create_payment(order, key)
+            except GatewayRejected as e:
+                # the order can't be paid this way (cash on delivery, a declined card...)
+                return Response({"error": str(e)}, status=400)
+            except GatewayError as e:
+                return Response({"error": str(e)}, status=502)
 
-            # create a payment object 
-            payment = Payment.objects.create(
-                order = order,
-                stripe_payment_intent_id=intent.id,
-                amount=order.total_amount
+            # create a payment object
+            payment, created = Payment.objects.get_or_create(
+                idempotency_key=key,
+                defaults={
+                    'order': order,
+                    'stripe_payment_intent_id': intent['id'],
+                    'amount': order.total_amount,
+                    'client_secret': intent['client_secret'],
+                }
             )
 
-            serializer = self.get_serializer(payment)
-            response_data = serializer.data
-            response_data['client_secret'] = intent.client_secret
-            return Response(response_data)
-                    
-        except Order.DoesNotExist:
-            return Response({"error": "Order not found"})
+        serializer = self.get_serializer(payment)
+        response_data = serializer.data
+        response_data['client_secret'] = payment.client_secret
+        return Response(response_data)
 
     # custom endpoint with only POST /api/payment/{id}/confirm/
     @action(detail=True, methods=['post'])
@@ -246,21 +526,24 @@ class PaymentView(ModelViewSet):
         """
         Confirm payment status
         POST /api/payment/{id}/confirm/
+        The status comes from Stripe webhooks (see webhook below), so this doesn't call Stripe.
+        Without STRIPE_WEBHOOK_SECRET (local development) it still asks Stripe directly
         """
         payment = self.get_object()
-        
-        # Check payment status with Stripe
-        intent = stripe.PaymentIntent.retrieve(payment.stripe_payment_intent_id)
-        
-        if intent.status == 'succeeded':
-            payment.status = 'completed'
-            payment.save()
-            
-            # Update order status
-            payment.order.payment_status = 'paid'
-            payment.order.status = 'processing'
-            payment.order.save()
-            
+
+        if not settings.STRIPE_WEBHOOK_SECRET and payment.status not in FINAL_PAYMENT_STATUSES:
+            # Check payment status with the gateway
+            try:
+                status = get_gateway(payment.order.payment_method).payment_status(payment.stripe_payment_intent_id)
+            except GatewayRejected as e:
+                # e.g. the payment method has no gateway
+                return Response({"error": str(e)}, status=400)
+            except GatewayError as e:
+                return Response({"error": str(e)}, status=502)
+            apply_transitions({payment.stripe_payment_intent_id: f'payment_intent.{status}'})
+            payment.refresh_from_db()
+
+        if payment.status == 'completed':
             return Response({
                 "success": True,
                 "message": "Payment confirmed successfully",
@@ -268,6 +551,98 @@ class PaymentView(ModelViewSet):
             })
         else:
             return Response({
-                "error": f"Payment not completed. Status: {intent.status}"
+                "error": f"Payment not completed. Status: {payment.status}"
             })
-    
\ No newline at end of file
+
+    # POST /api/payment/webhook/
+    @action(detail=False, methods=['post'], url_path='webhook', permission_classes=[AllowAny], authentication_classes=[])
+    def webhook(self, request):
+        """
+        Receives payment_intent.* events from Stripe. The signature is checked with STRIPE_WEBHOOK_SECRET,
+        events are stored once by event id and applied to payments and orders in bulk
+        """
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            return Response({"error": "Webhooks are not configured"}, status=503)
+        try:
+            event = parse_webhook(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''), settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, stripe.error.SignatureVerificationError):
+            return Response({"error": "Invalid webhook"}, status=400)
+
+        record_events([event])
+        process_pending_events()
+        return Response({"success": True})
+
+
+class AnalyticsView(ReadOnlyModelViewSet):
+    """
+    Sales dashboards for staff, answered from the daily rollups in api/analytics.py, never from the orders.
+    Every endpoint takes ?start=YYYY-MM-DD&end=YYYY-MM-DD (default the last 30 days), ?payment_status= and ?payment_method=
+    GET /api/analytics/ - the rollup rows (day, payment method, payment status)
+    """
+    queryset = DailySales.objects.order_by('-day', 'payment_method', 'payment_status')
+    serializer_class = DailySalesSerializer
+    permission_classes = [IsAdminUser]
+
+    def list(self, request):
+        try:
+            filters = analytics.sales_filters(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)})
+        return Response(self.get_serializer(self.get_queryset().filter(**filters), many=True).data)
+
+    # /api/analytics/daily
+    @action(detail=False, methods=['get'], url_path='daily')
+    def daily(self, request):
+        """
+        Orders and revenue per day
+        GET /api/analytics/daily/
+        """
+        try:
+            filters = analytics.sales_filters(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)})
+        return Response(analytics.daily_totals(filters))
+
+    # /api/analytics/categories
+    @action(detail=False, methods=['get'], url_path='categories')
+    def categories(self, request):
+        """
+        Units and revenue per category per day
+        GET /api/analytics/categories/
+        """
+        try:
+            filters = analytics.sales_filters(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)})
+        return Response(analytics.category_totals(filters))
+
+    # /api/analytics/products
+    @action(detail=False, methods=['get'], url_path='products')
+    def products(self, request):
+        """
+        Best selling products by revenue
+        GET /api/analytics/products/?limit=10 (1 to 100)
+        """
+        try:
+            filters = analytics.sales_filters(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)})
+        try:
+            # kept between 1 and 100 like the search limit, a negative slice would fail in the database query
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 100)
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=400)
+        return Response(analytics.top_products(filters, limit))
+
+    # /api/analytics/payment-methods
+    @action(detail=False, methods=['get'], url_path='payment-methods')
+    def payment_methods(self, request):
+        """
+        Orders and revenue per payment method and payment status
+        GET /api/analytics/payment-methods/
+        """
+        try:
+            filters = analytics.sales_filters(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)})
+        return Response(analytics.payment_totals(filters))
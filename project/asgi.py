@@ -5,6 +5,9 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+Run it with an ASGI server, e.g. `uvicorn project.asgi:application --workers 4`, to serve the
+async payment and checkout views (api/async_views.py) without a thread per request
 """
 
 import os